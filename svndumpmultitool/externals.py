@@ -8,10 +8,16 @@
 
 from __future__ import absolute_import
 
+import anydbm
+import collections
+import itertools
 import logging
 import re
-import subprocess
 
+from svn import core as svn_core
+from svn import fs as svn_fs
+
+from svndumpmultitool import svndump
 from svndumpmultitool import util
 
 LOGGER = logging.getLogger(__name__)
@@ -59,25 +65,11 @@ class ExternalsDescription(object):
 
   def SourceExists(self):
     """Tests whether the srcpath exists at srcrev in srcrepo."""
-    cmd = [
-        'svn',
-        'ls',  # svn info can be really slow for old revs
-        util.FileURL(self.srcrepo, self.srcpath, self.srcrev),
-        ]
-
-    svn_ls = util.Popen(*cmd, stderr=subprocess.PIPE)
-
-    # We don't care about output, only exit code
-    svn_ls.stdout.read()
-    svn_ls.stdout.close()
-    svn_ls.stderr.read()
-    svn_ls.stderr.close()
-
-    if util.CheckExitCode(svn_ls, allow_failure=True):
+    if _SourceExists(self.srcrepo, self.srcpath, self.srcrev):
+      return True
+    else:
       LOGGER.warning('%s points to a non-existent location', self)
       return False
-    else:
-      return True
 
   def __repr__(self):
     return 'ExternalsDescription(%r, %r, %r, %r, %r)' % (
@@ -97,6 +89,128 @@ class ExternalsDescription(object):
             and self.srcpeg == other.srcpeg)
 
 
+# Number of answers kept in memory by ExternalsDescription.SourceExists
+SOURCE_EXISTS_CACHE_SIZE = 4096
+# {(repository path, path, revision): bool} from least to most recently used
+_SOURCE_EXISTS = collections.OrderedDict()
+# Answers of SourceExists kept on disk, see OpenSourceExistsCache
+_SOURCE_EXISTS_DB = []
+# Name of the file opened by OpenSourceExistsCache
+_SOURCE_EXISTS_FILENAME = []
+# Files inherited from a parent process, see DetachSourceExistsCache
+_DETACHED_SOURCE_EXISTS_DB = []
+# The file opened again for reading in a forked process
+_READ_ONLY_SOURCE_EXISTS_DB = []
+# {cache file key: '1' or '0'} looked up by a forked process since
+# PopUnstoredSourceExists was last called
+_UNSTORED_SOURCE_EXISTS = {}
+
+
+def OpenSourceExistsCache(filename):
+  """Keep the answers of ExternalsDescription.SourceExists in a file.
+
+  Whether a path exists in a given revision never changes, so a later run can
+  reuse the answers instead of looking them up again. Answers are keyed by the
+  UUID of the repository, so moving or replacing a repository is safe.
+
+  Args:
+    filename: path of the cache file, which is created if it does not exist
+  """
+  CloseSourceExistsCache()
+  _SOURCE_EXISTS_DB.append(anydbm.open(filename, 'c'))
+  _SOURCE_EXISTS_FILENAME.append(filename)
+
+
+def CloseSourceExistsCache():
+  """Close the file opened by OpenSourceExistsCache, if any."""
+  while _SOURCE_EXISTS_DB:
+    _SOURCE_EXISTS_DB.pop().close()
+  while _READ_ONLY_SOURCE_EXISTS_DB:
+    _READ_ONLY_SOURCE_EXISTS_DB.pop().close()
+  del _SOURCE_EXISTS_FILENAME[:]
+
+
+def DetachSourceExistsCache():
+  """Stop writing to the file opened by OpenSourceExistsCache.
+
+  This is for processes forked from the one that opened the file: closing it
+  there would write out the parent's state of the file over the parent's
+  later writes. The file is opened again, read-only, if possible. Answers
+  that are not in it are kept until PopUnstoredSourceExists is called, so
+  that they can be passed to the parent process to store (see
+  StoreSourceExists).
+  """
+  _DETACHED_SOURCE_EXISTS_DB.extend(_SOURCE_EXISTS_DB)
+  del _SOURCE_EXISTS_DB[:]
+  if _SOURCE_EXISTS_FILENAME and not _READ_ONLY_SOURCE_EXISTS_DB:
+    try:
+      _READ_ONLY_SOURCE_EXISTS_DB.append(
+          anydbm.open(_SOURCE_EXISTS_FILENAME[0], 'r'))
+    except (anydbm.error, EnvironmentError):
+      # e.g. the file is locked by the parent
+      LOGGER.debug('Could not read %s', _SOURCE_EXISTS_FILENAME[0])
+
+
+def PopUnstoredSourceExists():
+  """Take the answers a forked process could not store in the cache file.
+
+  Returns:
+    an opaque dict to pass to StoreSourceExists in the parent process
+  """
+  answers = dict(_UNSTORED_SOURCE_EXISTS)
+  _UNSTORED_SOURCE_EXISTS.clear()
+  return answers
+
+
+def StoreSourceExists(answers):
+  """Store answers from PopUnstoredSourceExists in the cache file, if open."""
+  if _SOURCE_EXISTS_DB:
+    for db_key, value in answers.iteritems():
+      _SOURCE_EXISTS_DB[0][db_key] = value
+
+
+def _SourceExists(repo, path, rev):
+  """Tests whether path exists at rev (None for HEAD) in repo.
+
+  The SOURCE_EXISTS_CACHE_SIZE most recently used answers are kept in memory.
+  """
+  key = (repo, path, rev)
+  try:
+    exists = _SOURCE_EXISTS.pop(key)
+  except KeyError:
+    exists = _CheckSource(repo, path, rev)
+    while len(_SOURCE_EXISTS) >= SOURCE_EXISTS_CACHE_SIZE:
+      _SOURCE_EXISTS.popitem(last=False)
+  _SOURCE_EXISTS[key] = exists
+  return exists
+
+
+def _CheckSource(repo, path, rev):
+  """Look up whether path exists at rev in repo, using the cache file if open."""
+  try:
+    fs_ptr = svndump.OpenRepository(repo)
+    if rev is None:
+      rev = svn_fs.youngest_rev(fs_ptr)
+    db = _SOURCE_EXISTS_DB or _READ_ONLY_SOURCE_EXISTS_DB
+    if db or _DETACHED_SOURCE_EXISTS_DB:
+      db_key = '%s@%d:%s' % (svn_fs.get_uuid(fs_ptr), rev, path)
+    if db:
+      try:
+        return db[0][db_key] == '1'
+      except KeyError:
+        pass
+    root = svndump.RevisionRoot(repo, rev)
+    exists = svn_fs.check_path(root, path) != svn_core.svn_node_none
+  except svn_core.SubversionException:
+    # The repository or the revision does not exist
+    return False
+  if _SOURCE_EXISTS_DB:
+    _SOURCE_EXISTS_DB[0][db_key] = '1' if exists else '0'
+  elif _DETACHED_SOURCE_EXISTS_DB:
+    _UNSTORED_SOURCE_EXISTS[db_key] = '1' if exists else '0'
+  return exists
+
+
 def _SanitizeRev(rev):
   """Coerces a value into a revision number or None.
 
@@ -539,3 +653,242 @@ def FromRev(repo, rev, path, externals_map):
   # If the property doesn't exist and causes an error, that's ok
   util.CheckExitCode(svnlook_pg, allow_failure=True)
   return Parse(repo, rev, path, value, externals_map)
+
+
+# The value ExternalsState.Lookup gives when svn:externals must be looked up
+# in the repository (see FromRev)
+UNKNOWN = object()
+# Number of revisions before the latest one read in which ExternalsState can
+# look up svn:externals (older state is looked up in the repository)
+EXTERNALS_HISTORY = 10000
+
+
+class ExternalsState(object):
+  """Tracks the svn:externals property of every path as a dump is read.
+
+  Every Record read from the dump (before filtering) is passed to Update, so
+  the value of svn:externals on any path in any of the last EXTERNALS_HISTORY
+  revisions read can be found without asking the repository. Only state from
+  before that, or from before the first revision of the dump, is unknown:
+  Lookup then gives UNKNOWN.
+
+  Only paths whose svn:externals may differ from that of their parent
+  directory are kept, with two kinds of events each, in the order they
+  happened:
+  - values: the svn:externals property of the path itself was set to a value
+    (None if the property was removed)
+  - wipes: everything at and below the path was replaced, with None (e.g. by
+    a delete or by adding a new directory) or with the value that paths in a
+    copied tree have if they have no values of their own
+  The value of a path is given by the latest of its own values and the wipes
+  of it and its ancestors. Copies from within the dump replicate the events
+  of the source subtree at the destination. Events that can no longer be
+  told apart from later ones in the history kept are pruned as revisions go
+  by.
+  """
+
+  def __init__(self, first_rev):
+    """Create a new ExternalsState.
+
+    Args:
+      first_rev: the number of the first revision in the dump
+    """
+    # Revisions before the first one are only empty in a dump of the
+    # entire history
+    self._default = None if first_rev <= 1 else UNKNOWN
+    self._first_rev = first_rev
+    # {path: [(rev, sequence number, value)]} in the order they happened
+    self._values = {}
+    self._wipes = {}
+    # {path: set of child paths}, for every path with events at or below it
+    self._children = {}
+    self._seq = 0
+    self._latest_rev = first_rev
+    # The revision that events were last pruned for (see _Prune)
+    self._pruned_rev = first_rev
+
+  def Lookup(self, path, rev):
+    """Return the value of svn:externals on path in rev.
+
+    Returns:
+      the property value, None if the property is not set, or UNKNOWN
+    """
+    if rev < self._latest_rev - EXTERNALS_HISTORY:
+      return UNKNOWN
+    best = _Latest(self._values.get(path), rev)
+    wipe = self._LatestWipe(path, rev)
+    if wipe is not None and (best is None or wipe[1] > best[1]):
+      best = wipe
+    return best[2] if best is not None else self._default
+
+  def Update(self, rev, record):
+    """Apply the changes made by a Record read from the dump.
+
+    Args:
+      rev: the revision that the Record belongs to
+      record: a svndump.Record
+    """
+    if rev > self._latest_rev:
+      self._latest_rev = rev
+      if rev - self._pruned_rev >= 2 * EXTERNALS_HISTORY:
+        self._Prune(rev - EXTERNALS_HISTORY)
+    path = record.headers['Node-path']
+    action = record.headers['Node-action']
+    if action in ('delete', 'replace'):
+      if path in self._children:
+        # Hide the svn:externals of the old subtree
+        self._Add(self._wipes, path, rev, None)
+      if action == 'delete':
+        return
+    if record.headers.get('Node-kind') == 'file':
+      return
+    if action in ('add', 'replace'):
+      if 'Node-copyfrom-path' in record.headers:
+        self._Copy(record.headers['Node-copyfrom-path'],
+                   int(record.headers['Node-copyfrom-rev']), path, rev)
+      elif self._Baseline(path, rev) is not None:
+        # Nothing in a new directory has svn:externals yet
+        self._Add(self._wipes, path, rev, None)
+    if record.HasProperty('svn:externals'):
+      self._Add(self._values, path, rev, record.props['svn:externals'])
+    elif (record.HasProps()
+          and record.headers.get('Prop-delta') != 'true'
+          and self.Lookup(path, rev) is not None):
+      # A full properties block without svn:externals removes it
+      self._Add(self._values, path, rev, None)
+
+  def _Copy(self, srcpath, srcrev, dstpath, rev):
+    """Replicate the state of a subtree at srcrev under dstpath."""
+    known = (srcrev >= self._first_rev
+             and srcrev >= self._latest_rev - EXTERNALS_HISTORY)
+    base = self._Baseline(srcpath, srcrev) if known else UNKNOWN
+    if base != self._Baseline(dstpath, rev):
+      self._Add(self._wipes, dstpath, rev, base)
+    if not known:
+      return
+    subtree = self._Subtree(srcpath)
+    # Wipes first, so that the values copied are never hidden by them
+    for path in subtree:
+      if _Latest(self._wipes.get(path), srcrev) is not None:
+        self._Add(self._wipes, _Rebase(path, srcpath, dstpath), rev,
+                  self._Baseline(path, srcrev))
+    for path in subtree:
+      if _Latest(self._values.get(path), srcrev) is not None:
+        self._Add(self._values, _Rebase(path, srcpath, dstpath), rev,
+                  self.Lookup(path, srcrev))
+
+  def _Subtree(self, root):
+    """Return the paths with events at or below root, parents first."""
+    subtree = []
+    stack = [root] if root in self._children else []
+    while stack:
+      path = stack.pop()
+      if path in self._values or path in self._wipes:
+        subtree.append(path)
+      stack.extend(self._children[path])
+    return subtree
+
+  def _Baseline(self, path, rev):
+    """Return the value of paths below path that have no values of their own."""
+    wipe = self._LatestWipe(path, rev)
+    return wipe[2] if wipe is not None else self._default
+
+  def _LatestWipe(self, path, rev):
+    """Return the latest (rev, sequence number, value) wiping path in rev."""
+    best = None
+    while True:
+      wipe = _Latest(self._wipes.get(path), rev)
+      if wipe is not None and (best is None or wipe[1] > best[1]):
+        best = wipe
+      if not path:
+        break
+      path = path.rpartition('/')[0]
+    return best
+
+  def _Add(self, events, path, rev, value):
+    self._Link(path)
+    self._seq += 1
+    events.setdefault(path, []).append((rev, self._seq, value))
+
+  def _Link(self, path):
+    """Add path and its ancestors to self._children."""
+    child = None
+    while path not in self._children:
+      self._children[path] = set([child]) if child is not None else set()
+      if not path:
+        return
+      child = path
+      path = path.rpartition('/')[0]
+    if child is not None:
+      self._children[path].add(child)
+
+  def _Prune(self, horizon):
+    """Forget the events that make no difference in horizon or later.
+
+    For each path, only the latest events by horizon can still be found, and
+    only if they are not hidden by a later wipe and if they change the value
+    that the path would have without them.
+    """
+    stack = [('', 0, self._default)] if '' in self._children else []
+    while stack:
+      path, hidden_seq, base = stack.pop()
+      wipes = self._Split(self._wipes, path, horizon)
+      if wipes is not None:
+        old, new = wipes
+        if old is not None and old[1] > hidden_seq:
+          hidden_seq = old[1]
+          if old[2] != base:
+            base = old[2]
+            new.insert(0, old)
+        self._Store(self._wipes, path, new)
+      values = self._Split(self._values, path, horizon)
+      if values is not None:
+        old, new = values
+        if old is not None and old[1] > hidden_seq and old[2] != base:
+          new.insert(0, old)
+        self._Store(self._values, path, new)
+      for child in self._children[path]:
+        stack.append((child, hidden_seq, base))
+    self._children.clear()
+    for path in itertools.chain(self._values, self._wipes):
+      self._Link(path)
+    self._pruned_rev = horizon
+
+  @staticmethod
+  def _Split(events, path, horizon):
+    """Split the events of a path into the latest by horizon and later ones.
+
+    Returns:
+      None if path has no events, otherwise a tuple (old, new) of the latest
+      event by horizon (or None) and a list of the events after it
+    """
+    path_events = events.get(path)
+    if path_events is None:
+      return None
+    new = [event for event in path_events if event[0] > horizon]
+    old = path_events[-len(new) - 1] if len(new) < len(path_events) else None
+    return old, new
+
+  @staticmethod
+  def _Store(events, path, path_events):
+    if path_events:
+      events[path] = path_events
+    else:
+      del events[path]
+
+
+def _Latest(events, rev):
+  """Return the last of a path's events that happened by rev, or None."""
+  if events:
+    for event in reversed(events):
+      if event[0] <= rev:
+        return event
+  return None
+
+
+def _Rebase(path, oldroot, newroot):
+  """Move a path from below oldroot to the same place below newroot."""
+  if path == oldroot:
+    return newroot
+  relative_path = path[len(oldroot) + 1:] if oldroot else path
+  return (newroot + '/' + relative_path) if newroot else relative_path
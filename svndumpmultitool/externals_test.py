@@ -8,11 +8,16 @@
 
 from __future__ import absolute_import
 
+import os
+import random
+import shutil
+import tempfile
 import unittest
 
 import mock
 
 from svndumpmultitool import externals
+from svndumpmultitool import svndump
 from svndumpmultitool import test_utils
 
 # Static data
@@ -135,28 +140,168 @@ class SanitizeRevTest(unittest.TestCase):
       externals._SanitizeRev('1.0')
 
 
-@mock.patch('subprocess.Popen', new=test_utils.MockPopen)
+class FakeSubversionException(Exception):
+  pass
+
+
+@mock.patch.object(svndump, 'svn_core')
+@mock.patch.object(svndump, 'svn_repos')
+@mock.patch.object(svndump, 'svn_fs')
+@mock.patch.object(externals, 'svn_core')
+@mock.patch.object(externals, 'svn_fs')
 class ExternalsDescriptionSourceExistsTest(unittest.TestCase):
-  def testExists(self):
-    with test_utils.MockPopen.ExpectCommands({
-        'cmd': ('svn', 'ls', 'file:///svn/foo/baz@1'),
-        'stdout': 'some output',
-        'stderr': ''
-        }):
-      ed = ExternalsDescriptionFromDefaults(srcrev=1)
-      self.assertEquals(ed.SourceExists(), True)
+
+  def setUp(self):
+    svndump.CloseRepositories()
+    externals._SOURCE_EXISTS.clear()
+
+  def tearDown(self):
+    svndump.CloseRepositories()
+    externals._SOURCE_EXISTS.clear()
+    externals.CloseSourceExistsCache()
+
+  def MockFS(self, fs, core, nodes):
+    """Make fs.check_path find the (rev, path) pairs in nodes."""
+    core.svn_node_none = 'none'
+    core.SubversionException = FakeSubversionException
+    fs.youngest_rev.return_value = 5
+    fs.get_uuid.return_value = 'uuid'
+    fs.check_path.side_effect = (
+        lambda root, path: 'dir' if (root, path) in nodes else 'none')
+
+  def testExists(self, fs, core, svndump_fs, unused_repos, unused_core):
+    self.MockFS(fs, core, [(1, 'baz')])
+    svndump_fs.revision_root.side_effect = lambda fs_ptr, rev: rev
+    ed = ExternalsDescriptionFromDefaults(srcrev=1)
+    self.assertEquals(ed.SourceExists(), True)
+    svndump_fs.revision_root.assert_called_once_with(mock.ANY, 1)
 
   @mock.patch.object(externals, 'LOGGER')
-  def testDoesNotExist(self, logger):
-    with test_utils.MockPopen.ExpectCommands({
-        'cmd': ('svn', 'ls', 'file:///svn/foo/baz@1'),
-        'stdout': '',
-        'stderr': 'error!',
-        'returncode': 1
-        }):
-      ed = ExternalsDescriptionFromDefaults(srcrev=1)
-      self.assertEquals(ed.SourceExists(), False)
-      self.assertEquals(logger.warning.call_count, 1)
+  def testDoesNotExist(self, logger, fs, core, svndump_fs, unused_repos,
+                       unused_core):
+    self.MockFS(fs, core, [])
+    svndump_fs.revision_root.side_effect = lambda fs_ptr, rev: rev
+    ed = ExternalsDescriptionFromDefaults(srcrev=1)
+    self.assertEquals(ed.SourceExists(), False)
+    self.assertEquals(logger.warning.call_count, 1)
+
+  @mock.patch.object(externals, 'LOGGER')
+  def testBadRevision(self, logger, fs, core, svndump_fs, unused_repos,
+                      unused_core):
+    self.MockFS(fs, core, [])
+    svndump_fs.revision_root.side_effect = FakeSubversionException
+    ed = ExternalsDescriptionFromDefaults(srcrev=10)
+    self.assertEquals(ed.SourceExists(), False)
+    self.assertEquals(logger.warning.call_count, 1)
+
+  def testHead(self, fs, core, svndump_fs, unused_repos, unused_core):
+    self.MockFS(fs, core, [(5, 'baz')])
+    svndump_fs.revision_root.side_effect = lambda fs_ptr, rev: rev
+    ed = ExternalsDescriptionFromDefaults(srcrev='HEAD')
+    self.assertEquals(ed.SourceExists(), True)
+
+  def testMemoized(self, fs, core, svndump_fs, unused_repos, unused_core):
+    self.MockFS(fs, core, [(1, 'baz')])
+    svndump_fs.revision_root.side_effect = lambda fs_ptr, rev: rev
+    self.assertEquals(
+        ExternalsDescriptionFromDefaults(srcrev=1).SourceExists(), True)
+    self.assertEquals(
+        ExternalsDescriptionFromDefaults(dstpath='x', srcrev=1).SourceExists(),
+        True)
+    self.assertEquals(fs.check_path.call_count, 1)
+    self.assertEquals(
+        ExternalsDescriptionFromDefaults(srcrev=2).SourceExists(), False)
+    self.assertEquals(fs.check_path.call_count, 2)
+
+  @mock.patch.object(externals, 'SOURCE_EXISTS_CACHE_SIZE', 2)
+  def testLeastRecentlyUsedIsEvicted(self, fs, core, svndump_fs,
+                                     unused_repos, unused_core):
+    self.MockFS(fs, core, [])
+    svndump_fs.revision_root.side_effect = lambda fs_ptr, rev: rev
+    for rev in (1, 2, 1, 3):  # 3 evicts 2
+      ExternalsDescriptionFromDefaults(srcrev=rev).SourceExists()
+    self.assertEquals(fs.check_path.call_count, 3)
+    ExternalsDescriptionFromDefaults(srcrev=1).SourceExists()
+    self.assertEquals(fs.check_path.call_count, 3)
+    ExternalsDescriptionFromDefaults(srcrev=2).SourceExists()
+    self.assertEquals(fs.check_path.call_count, 4)
+
+  def testCacheFile(self, fs, core, svndump_fs, unused_repos, unused_core):
+    self.MockFS(fs, core, [(1, 'baz')])
+    svndump_fs.revision_root.side_effect = lambda fs_ptr, rev: rev
+    tmpdir = tempfile.mkdtemp()
+    try:
+      filename = os.path.join(tmpdir, 'cache')
+      externals.OpenSourceExistsCache(filename)
+      self.assertEquals(
+          ExternalsDescriptionFromDefaults(srcrev=1).SourceExists(), True)
+      self.assertEquals(
+          ExternalsDescriptionFromDefaults(srcrev=None).SourceExists(), False)
+      externals.CloseSourceExistsCache()
+      self.assertEquals(fs.check_path.call_count, 2)
+
+      # A later run gets its answers from the file
+      externals._SOURCE_EXISTS.clear()
+      externals.OpenSourceExistsCache(filename)
+      self.assertEquals(
+          ExternalsDescriptionFromDefaults(srcrev=1).SourceExists(), True)
+      self.assertEquals(
+          ExternalsDescriptionFromDefaults(srcrev=5).SourceExists(), False)
+      self.assertEquals(fs.check_path.call_count, 2)
+
+      # Answers from another repository are not reused
+      externals._SOURCE_EXISTS.clear()
+      fs.get_uuid.return_value = 'other'
+      ExternalsDescriptionFromDefaults(srcrev=1).SourceExists()
+      self.assertEquals(fs.check_path.call_count, 3)
+    finally:
+      externals.CloseSourceExistsCache()
+      shutil.rmtree(tmpdir)
+
+  def testDetachCacheFile(self, fs, core, svndump_fs, unused_repos,
+                          unused_core):
+    self.MockFS(fs, core, [(1, 'baz')])
+    svndump_fs.revision_root.side_effect = lambda fs_ptr, rev: rev
+    tmpdir = tempfile.mkdtemp()
+    try:
+      filename = os.path.join(tmpdir, 'cache')
+      externals.OpenSourceExistsCache(filename)
+      ExternalsDescriptionFromDefaults(srcrev=1).SourceExists()
+      externals.CloseSourceExistsCache()
+      externals._SOURCE_EXISTS.clear()
+
+      externals.OpenSourceExistsCache(filename)
+      db = externals._SOURCE_EXISTS_DB[0]
+      externals.DetachSourceExistsCache()
+      # Answers in the file are still read...
+      self.assertEquals(
+          ExternalsDescriptionFromDefaults(srcrev=1).SourceExists(), True)
+      self.assertEquals(fs.check_path.call_count, 1)
+      # ...but new ones are only kept for the parent process to store
+      self.assertEquals(
+          ExternalsDescriptionFromDefaults(srcrev=2).SourceExists(), False)
+      self.assertEquals(fs.check_path.call_count, 2)
+      self.assertEquals(len(db), 1)
+      answers = externals.PopUnstoredSourceExists()
+      self.assertEquals(answers, {'uuid@2:baz': '0'})
+      self.assertEquals(externals.PopUnstoredSourceExists(), {})
+      externals.CloseSourceExistsCache()
+      self.assertIn(db, externals._DETACHED_SOURCE_EXISTS_DB)
+
+      externals.StoreSourceExists(answers)  # Ignored without a file
+      externals.OpenSourceExistsCache(filename)
+      externals.StoreSourceExists(answers)
+      externals._SOURCE_EXISTS.clear()
+      self.assertEquals(
+          ExternalsDescriptionFromDefaults(srcrev=2).SourceExists(), False)
+      self.assertEquals(fs.check_path.call_count, 2)
+    finally:
+      externals.CloseSourceExistsCache()
+      # This process is the one that opened the file, so it must close it
+      while externals._DETACHED_SOURCE_EXISTS_DB:
+        externals._DETACHED_SOURCE_EXISTS_DB.pop().close()
+      externals._UNSTORED_SOURCE_EXISTS.clear()
+      shutil.rmtree(tmpdir)
 
 
 class DiffTest(unittest.TestCase):
@@ -545,5 +690,203 @@ class FromRevTest(unittest.TestCase):
     self.assertEquals(result, expected)
 
 
+class ExternalsStateTest(unittest.TestCase):
+  def setUp(self):
+    self.state = externals.ExternalsState(1)
+
+  def Update(self, rev, path, action, value=None, props=False, copy=None,
+             kind='dir', delta=False):
+    record = svndump.Record(path=path, action=action,
+                            kind=kind if action != 'delete' else None)
+    if value is not None:
+      record.SetProperty('svn:externals', value)
+    elif props:
+      record.props = {}
+    if delta:
+      record.headers['Prop-delta'] = 'true'
+    if copy:
+      record.headers['Node-copyfrom-path'], record.headers[
+          'Node-copyfrom-rev'] = copy
+    self.state.Update(rev, record)
+
+  def testSetAndChange(self):
+    self.Update(1, 'trunk', 'add', 'a a')
+    self.Update(3, 'trunk', 'change', 'b b')
+    self.assertIsNone(self.state.Lookup('trunk', 0))
+    self.assertEquals(self.state.Lookup('trunk', 1), 'a a')
+    self.assertEquals(self.state.Lookup('trunk', 2), 'a a')
+    self.assertEquals(self.state.Lookup('trunk', 3), 'b b')
+    self.assertIsNone(self.state.Lookup('branches', 3))
+
+  def testRemovedByFullPropsBlock(self):
+    self.Update(1, 'trunk', 'add', 'a a')
+    self.Update(2, 'trunk', 'change', props=True, delta=True)
+    self.assertEquals(self.state.Lookup('trunk', 2), 'a a')
+    self.Update(3, 'trunk', 'change', props=True)
+    self.assertIsNone(self.state.Lookup('trunk', 3))
+
+  def testDeleteSubtree(self):
+    self.Update(1, 'trunk/a', 'add', 'a a')
+    self.Update(1, 'trunk-b', 'add', 'b b')
+    self.Update(2, 'trunk', 'delete')
+    self.assertEquals(self.state.Lookup('trunk/a', 1), 'a a')
+    self.assertIsNone(self.state.Lookup('trunk/a', 2))
+    self.assertEquals(self.state.Lookup('trunk-b', 2), 'b b')
+
+  def testReplace(self):
+    self.Update(1, 'trunk', 'add', 'a a')
+    self.Update(1, 'trunk/x', 'add', 'x x')
+    self.Update(2, 'trunk', 'replace', 'b b')
+    self.assertEquals(self.state.Lookup('trunk', 2), 'b b')
+    self.assertIsNone(self.state.Lookup('trunk/x', 2))
+
+  def testCopy(self):
+    self.Update(1, 'trunk', 'add', 'a a')
+    self.Update(1, 'trunk/x', 'add', 'x x')
+    self.Update(2, 'trunk/x', 'change', props=True)
+    self.Update(3, 'branches/b1', 'add', copy=('trunk', '1'))
+    self.Update(3, 'branches/b2', 'add', copy=('trunk', '2'))
+    self.assertIsNone(self.state.Lookup('branches/b1', 2))
+    self.assertEquals(self.state.Lookup('branches/b1', 3), 'a a')
+    self.assertEquals(self.state.Lookup('branches/b1/x', 3), 'x x')
+    self.assertEquals(self.state.Lookup('branches/b2', 3), 'a a')
+    self.assertIsNone(self.state.Lookup('branches/b2/x', 3))
+
+  def testCopyWithProps(self):
+    self.Update(1, 'trunk', 'add', 'a a')
+    self.Update(2, 'branches/b1', 'add', 'b b', copy=('trunk', '1'))
+    self.assertEquals(self.state.Lookup('branches/b1', 2), 'b b')
+
+  def testIncrementalDump(self):
+    state = externals.ExternalsState(10)
+    self.assertIs(state.Lookup('trunk', 9), externals.UNKNOWN)
+    self.state = state
+    self.Update(10, 'trunk', 'change', 'a a')
+    self.Update(10, 'new', 'add')
+    self.Update(11, 'trunk', 'delete')
+    self.Update(11, 'tags/t1', 'add', copy=('branches/b1', '5'))
+    self.assertEquals(state.Lookup('trunk', 10), 'a a')
+    self.assertIsNone(state.Lookup('trunk', 11))
+    self.assertIs(state.Lookup('branches', 11), externals.UNKNOWN)
+    self.assertIs(state.Lookup('tags/t1/x', 11), externals.UNKNOWN)
+    self.assertIs(state.Lookup('tags/t1', 10), externals.UNKNOWN)
+    # Directories added in the dump are known not to have svn:externals
+    self.assertIsNone(state.Lookup('new', 10))
+    self.assertIsNone(state.Lookup('new/sub', 10))
+    self.assertIs(state.Lookup('new', 9), externals.UNKNOWN)
+
+  def testCopyInIncrementalDump(self):
+    self.state = externals.ExternalsState(10)
+    self.Update(10, 'a', 'add')
+    self.Update(10, 'a/b', 'add')
+    self.Update(11, 'c', 'add', copy=('a/b', '10'))
+    self.assertIsNone(self.state.Lookup('c', 11))
+    self.assertIsNone(self.state.Lookup('c/d', 11))
+
+  def testIncrementalDumpKeepsLittleState(self):
+    self.state = externals.ExternalsState(10)
+    self.Update(10, 'old', 'delete')
+    self.Update(10, 'old/sub', 'replace')
+    self.Update(10, 'new', 'add')
+    self.Update(10, 'new/sub', 'add')
+    self.Update(10, 'new/sub2', 'replace')
+    self.Update(10, 'new/file', 'add', kind='file')
+    self.assertEquals(self.state._values, {})
+    self.assertEquals(sorted(self.state._wipes), ['new', 'old/sub'])
+
+  def testFilesAreIgnored(self):
+    self.Update(1, 'trunk/f', 'add', props=True, kind='file')
+    self.assertEquals(self.state._children, {})
+
+  @mock.patch.object(externals, 'EXTERNALS_HISTORY', 2)
+  def testHistoryIsPruned(self):
+    self.Update(1, 'trunk', 'add', 'a a')
+    self.Update(1, 'trunk/x', 'add', 'x x')
+    self.Update(2, 'trunk', 'change', 'b b')
+    self.Update(3, 'trunk/x', 'delete')
+    for rev in xrange(4, 9):
+      self.Update(rev, 'r%d' % rev, 'add')
+    self.assertEquals(self.state._values, {'trunk': [(2, 3, 'b b')]})
+    self.assertEquals(self.state._wipes, {})
+    self.assertEquals(self.state._children, {'': set(['trunk']),
+                                             'trunk': set()})
+    self.assertIs(self.state.Lookup('trunk', 5), externals.UNKNOWN)
+    self.assertEquals(self.state.Lookup('trunk', 6), 'b b')
+    self.assertIsNone(self.state.Lookup('trunk/x', 6))
+    # A copy from beyond the history has to be looked up in the repository
+    self.Update(8, 'branches/b1', 'add', copy=('trunk', '2'))
+    self.assertIs(self.state.Lookup('branches/b1', 8), externals.UNKNOWN)
+    self.Update(8, 'branches/b2', 'add', copy=('trunk', '6'))
+    self.assertEquals(self.state.Lookup('branches/b2', 8), 'b b')
+
+  def testMatchesSnapshots(self):
+    """Compare with the full state of every revision of a random history."""
+    rng = random.Random(42)
+    for first_rev in (1, 5):
+      for history in (1, 3, 1000):
+        with mock.patch.object(externals, 'EXTERNALS_HISTORY', history):
+          self.CheckRandomHistory(rng, first_rev)
+
+  def CheckRandomHistory(self, rng, first_rev):
+    self.state = externals.ExternalsState(first_rev)
+    # {rev: {directory: value of svn:externals}}, where only the root is known
+    # to exist before the dump
+    snapshots = {first_rev - 1: {
+        '': None if first_rev == 1 else externals.UNKNOWN}}
+    for rev in xrange(first_rev, first_rev + 60):
+      tree = dict(snapshots[rev - 1])
+      for unused_i in xrange(rng.randint(1, 3)):
+        path = rng.choice(sorted(tree))
+        if not path or rng.random() < 0.4:
+          if path.count('/') >= 2:
+            continue
+          path = (path + '/' if path else '') + rng.choice('abc')
+        if path not in tree:
+          action = 'add'
+        else:
+          action = rng.choice(('change', 'delete', 'replace'))
+        if action in ('delete', 'replace'):
+          for below in [below for below in tree if _IsBelow(below, path)]:
+            del tree[below]
+        if action == 'delete':
+          self.Update(rev, path, action)
+          continue
+        copy = None
+        if action != 'change' and rng.random() < 0.5:
+          srcrev = rng.randint(
+              max(first_rev - 1, rev - externals.EXTERNALS_HISTORY), rev - 1)
+          sources = sorted(source for source in snapshots[srcrev]
+                           if source and not _IsBelow(path, source)
+                           or source == path)
+          if sources:
+            srcpath = rng.choice(sources)
+            copy = (srcpath, str(srcrev))
+            for below, value in snapshots[srcrev].iteritems():
+              if _IsBelow(below, srcpath):
+                tree[path + below[len(srcpath):]] = value
+        if copy is None and action != 'change':
+          tree[path] = None
+        choice = rng.random()
+        if choice < 0.4:
+          tree[path] = rng.choice(('x x', 'y y'))
+          self.Update(rev, path, action, tree[path], copy=copy)
+        elif choice < 0.6:
+          # A full properties block without svn:externals
+          tree[path] = None
+          self.Update(rev, path, action, props=True, copy=copy)
+        else:
+          self.Update(rev, path, action, props=True, delta=True, copy=copy)
+      snapshots[rev] = tree
+      for old_rev in xrange(
+          max(first_rev - 1, rev - externals.EXTERNALS_HISTORY), rev + 1):
+        for path, value in snapshots[old_rev].iteritems():
+          self.assertEquals(self.state.Lookup(path, old_rev), value,
+                            (rev, old_rev, path))
+
+
+def _IsBelow(path, root):
+  return path == root or path.startswith(root + '/')
+
+
 if __name__ == '__main__':
   unittest.main()
@@ -4,14 +4,17 @@
 # license that can be found in the LICENSE file or at
 # http://opensource.org/licenses/MIT
 
-"""Utility functions that call out to SVN command-line tools."""
+"""Utility functions that query SVN repositories."""
 
 from __future__ import absolute_import
 
+import collections
 import logging
-import urllib
 
-from svndumpmultitool import util
+from svn import core as svn_core
+from svn import fs as svn_fs
+
+from svndumpmultitool import svndump
 
 LOGGER = logging.getLogger(__name__)
 
@@ -20,10 +23,6 @@ class Error(Exception):
   """Parent class for this module's errors."""
 
 
-class UnknownDiff(Error):
-  """svn diff includes an unrecognized action."""
-
-
 def ExtractNodeKinds(srcrepo, srcrev, srcpath):
   """Creates a mapping of path to kind (dir or file).
 
@@ -37,43 +36,183 @@ def ExtractNodeKinds(srcrepo, srcrev, srcpath):
     given path and whose values are 'dir' for directories and 'file' for files
 
   This information is necessary to construct new Records relating to paths in
-  the repository to fill the Node-kind header. Unfortunately, this information
-  does not seem to be available from Subversion any other way.
+  the repository to fill the Node-kind header.
   """
   nodes = {}
-  cmd = [
-      'svnlook',
-      'tree',
-      '--full-paths',
-      '-r%s' % srcrev,
-      srcrepo,
-      srcpath,
-      ]
-  svnlook_tree = util.Popen(*cmd)
-  with svnlook_tree.stdout as path_stream:
-    for path in path_stream:
-      path = path.rstrip('\n')
-      # Ignore blank lines
-      if not path:
-        continue
-      # Special case the root path
-      if path == srcpath + '/':
-        nodes[''] = 'dir'
-        continue
-      elif path == srcpath:
-        nodes[''] = 'file'
-        continue
-      # Strip off the root path + /
-      path = path[len(srcpath) + 1:].rstrip('\n')
-      # Check for trailing /
-      if path.endswith('/'):
-        nodes[path[:-1]] = 'dir'
-      else:
-        nodes[path] = 'file'
-  util.CheckExitCode(svnlook_tree)
+
+  def Visit(path, kind):
+    nodes[path] = kind
+    return True
+
+  WalkTree(srcrepo, srcrev, srcpath, Visit)
+  return nodes
+
+
+def WalkTree(srcrepo, srcrev, srcpath, visit):
+  """Visit the nodes of a tree in a repository, skipping unwanted subtrees.
+
+  Args:
+    srcrepo: path to the source repository
+    srcrev: revision number
+    srcpath: path within the source repository
+    visit: a callable that is passed the path of each node relative to
+           srcpath ('' for srcpath itself) and its kind ('dir' or 'file').
+           The children of a directory are only visited if visit returns True
+           for it.
+
+  Parents are visited before their children and siblings are visited in
+  sorted order. Since no subtree is listed unless visit asks for it, the cost
+  of a walk is proportional to the part of the tree that is of interest.
+  """
+  root = svndump.RevisionRoot(srcrepo, srcrev)
+  if not svn_fs.is_dir(root, srcpath):
+    visit('', 'file')
+    return
+  stack = [('', srcpath, True)]
+  while stack:
+    path, full_path, is_dir = stack.pop()
+    if not is_dir:
+      visit(path, 'file')
+    elif visit(path, 'dir'):
+      entries = svn_fs.dir_entries(root, full_path)
+      for name in sorted(entries, reverse=True):
+        stack.append((_JoinPath(path, name), _JoinPath(full_path, name),
+                      entries[name].kind == svn_core.svn_node_dir))
+
+
+def _JoinPath(parent, name):
+  """Join a repository path ('' for the root) and a child's name."""
+  return (parent + '/' + name) if parent else name
+
+
+def CompareTrees(repo, oldpath, oldrev, newpath, newrev):
+  """Find the differences between two trees in a repository.
+
+  Args:
+    repo: path to the repository
+    oldpath: path within the repository to compare from
+    oldrev: revision number to compare from, or None for HEAD
+    newpath: path within the repository to compare to
+    newrev: revision number to compare to, or None for HEAD
+
+  Returns:
+    a dict {path relative to oldpath and newpath: (contents_op, props_op)}
+    in the format returned by Diff
+
+  Subtrees whose node revisions are the same in both trees are identical and
+  are skipped without being listed, so the cost of a comparison is
+  proportional to the size of the change rather than the size of the trees.
+  Like svn diff, the ancestry of nodes is ignored: a node that was replaced by
+  one of the same kind is compared by content. A node that was replaced by
+  one of a different kind is reported as deleted only, as svn diff reports
+  the delete after the add.
+  """
+  if oldrev is None or newrev is None:
+    youngest = svn_fs.youngest_rev(svndump.OpenRepository(repo))
+    oldrev = youngest if oldrev is None else oldrev
+    newrev = youngest if newrev is None else newrev
+  old_root = svndump.RevisionRoot(repo, oldrev)
+  new_root = svndump.RevisionRoot(repo, newrev)
+  changes = {}
+  stack = [('', oldpath, svn_fs.check_path(old_root, oldpath),
+            newpath, svn_fs.check_path(new_root, newpath))]
+  while stack:
+    path, old_full, old_kind, new_full, new_kind = stack.pop()
+    if old_kind == svn_core.svn_node_none:
+      if new_kind != svn_core.svn_node_none:
+        _ListAdds(new_root, path, new_full, new_kind, changes)
+      continue
+    if new_kind != old_kind:
+      # Children of a deleted directory are deleted along with it
+      changes[path] = ('delete', None)
+      continue
+    if not svn_fs.compare_ids(svn_fs.node_id(old_root, old_full),
+                              svn_fs.node_id(new_root, new_full)):
+      continue
+    if svn_fs.props_changed(old_root, old_full, new_root, new_full):
+      props_op = 'modify'
+    else:
+      props_op = None
+    contents_op = None
+    if new_kind == svn_core.svn_node_dir:
+      old_entries = svn_fs.dir_entries(old_root, old_full)
+      new_entries = svn_fs.dir_entries(new_root, new_full)
+      for name in set(old_entries).union(new_entries):
+        old_entry = old_entries.get(name)
+        new_entry = new_entries.get(name)
+        stack.append((
+            _JoinPath(path, name),
+            _JoinPath(old_full, name),
+            old_entry.kind if old_entry else svn_core.svn_node_none,
+            _JoinPath(new_full, name),
+            new_entry.kind if new_entry else svn_core.svn_node_none))
+    elif svn_fs.contents_changed(old_root, old_full, new_root, new_full):
+      contents_op = 'modify'
+    if contents_op or props_op:
+      changes[path] = (contents_op, props_op)
+  return changes
+
+
+def _ListAdds(root, path, full_path, kind, changes):
+  """Add every node of a tree to the changes made by CompareTrees as added."""
+  stack = [(path, full_path, kind)]
+  while stack:
+    path, full_path, kind = stack.pop()
+    # Like svn diff, adds of nodes that have properties are listed as changing
+    # the properties too
+    if svn_fs.node_proplist(root, full_path):
+      changes[path] = ('add', 'modify')
+    else:
+      changes[path] = ('add', None)
+    if kind == svn_core.svn_node_dir:
+      entries = svn_fs.dir_entries(root, full_path)
+      for name in entries:
+        stack.append((_JoinPath(path, name), _JoinPath(full_path, name),
+                      entries[name].kind))
+
+
+def ListNodes(srcrepo, srcrev, srcpath):
+  """List what svndump.IterRecordsFromPath reads from a tree, except text.
+
+  Args:
+    srcrepo: path to the source repository
+    srcrev: revision number
+    srcpath: path within the source repository
+
+  Returns:
+    a list of (path, kind, props, md5) for each node, parents before children.
+    path is relative to srcpath ('' for srcpath itself), kind is 'dir' or
+    'file', props is a dict and md5 is the hex checksum of a file's text
+    content (None for directories).
+
+  Unlike Records, the list can be pickled, so a tree can be walked in another
+  process and turned into Records by svndump.IterRecordsFromNodes.
+  """
+  root = svndump.RevisionRoot(srcrepo, srcrev)
+  nodes = []
+
+  def Visit(path, kind):
+    full_path = _JoinPath(srcpath, path) if path else srcpath
+    props = {key: str(value) for key, value
+             in svn_fs.node_proplist(root, full_path).iteritems()}
+    if kind == 'file':
+      md5 = svn_fs.file_md5_checksum(root, full_path).encode('hex_codec')
+    else:
+      md5 = None
+    nodes.append((path, kind, props, md5))
+    return True
+
+  WalkTree(srcrepo, srcrev, srcpath, Visit)
   return nodes
 
 
+# Number of results kept by Diff
+DIFF_CACHE_SIZE = 256
+# {(repo, oldpath, oldrev, newpath, newrev): changes} ordered from least to
+# most recently used
+_DIFFS = collections.OrderedDict()
+
+
 def Diff(repo, oldpath, oldrev, newpath, newrev):
   """Figure out what changed between two revisions of a directory.
 
@@ -92,65 +231,22 @@ def Diff(repo, oldpath, oldrev, newpath, newrev):
     The second part of the value is the type of change that was done to the
     properties of the path ('modify' or None).
 
-  Raises:
-    UnknownDiff: if an operation is encountered that is not recognized
-
   If a parent and child path are both deleted, only the parent will be included
   in the output. Only paths for which the contents or properties have changed
   will be returned.
+
+  The trees are compared in-process by CompareTrees. The results of
+  the DIFF_CACHE_SIZE most recent comparisons are kept, since externals
+  pinned to the same revisions are diffed again for every path they are
+  defined on.
   """
-  # This prefix will be stripped off the beginning of each path. The portion
-  # after file:// must be %-quoted, but file:// would turn into file%3A// if
-  # quoted. We strip the unquoted version, so here we just take the length so we
-  # know how much to strip off.
-  prefix_len = 1 + len(  # Add 1 for trailing /
-      util.FileURL(repo, oldpath, None, quote=False))
-  contents_ops = {' ': None, 'A': 'add', 'M': 'modify', 'D': 'delete'}
-  props_ops = {' ': None, 'M': 'modify'}
-  svn_diff = util.Popen('svn',
-                        'diff',
-                        '--summarize',
-                        '--old=' + util.FileURL(repo, oldpath, oldrev),
-                        '--new=' + util.FileURL(repo, newpath, newrev))
-  deleted = {}
-  changes = {}
-  with svn_diff.stdout as diff_stream:
-    for line in diff_stream:
-      line = line.rstrip('\n')
-
-      if line[0] not in contents_ops:
-        raise UnknownDiff('Unknown contents operation "%s" in svn diff'
-                          % line[0])
-      if line[1] not in props_ops:
-        raise UnknownDiff('Unknown properties operation "%s" in svn diff'
-                          % line[0])
-
-      contents_op = contents_ops[line[0]]
-      props_op = props_ops[line[1]]
-
-      # Find the correct starting point
-      path = line[line.find('file://'):]
-      # Unquote %-quoted characters
-      path = urllib.unquote(path)
-      # Chop off the prefix and trailing slash (if there is no trailing slash,
-      # it will return an empty string like we want in that case)
-      path = path[prefix_len:]
-
-      # Split out deleted so we can do recursive deletes as one operation
-      if contents_op == 'delete':
-        deleted[path] = (contents_op, props_op)
-      else:
-        changes[path] = (contents_op, props_op)
-
-  util.CheckExitCode(svn_diff)
-
-  # Ignore children of directories being deleted
-  for path in deleted:
-    if '/' in path:
-      parent = path[0:path.rfind('/')]
-      # Ignore paths whose parent dir got deleted
-      if parent in deleted:
-        continue
-    # Merge non-redundant deletes back into changes
-    changes[path] = deleted[path]
-  return changes
+  key = (repo, oldpath, oldrev, newpath, newrev)
+  try:
+    changes = _DIFFS.pop(key)
+  except KeyError:
+    changes = CompareTrees(repo, oldpath, oldrev, newpath, newrev)
+    while len(_DIFFS) >= DIFF_CACHE_SIZE:
+      _DIFFS.popitem(last=False)
+  _DIFFS[key] = changes
+  # Callers get their own copy to change as they please
+  return dict(changes)
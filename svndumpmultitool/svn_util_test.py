@@ -8,12 +8,14 @@
 
 from __future__ import absolute_import
 
-import subprocess
+import io
+import StringIO
 import unittest
 
 import mock
 
 from svndumpmultitool import svn_util
+from svndumpmultitool import svndump
 from svndumpmultitool import test_utils
 
 # Static data
@@ -21,20 +23,23 @@ MAIN_REPO = '/svn/zoo'
 MAIN_REPO_REV = 5
 
 
-@mock.patch('subprocess.Popen', new=test_utils.MockPopen)
 class ExtractNodeKindsTest(unittest.TestCase):
-  def testDir(self):
-    with test_utils.MockPopen.ExpectCommands({
-        'cmd': ('svnlook', 'tree', '--full-paths', '-r%s' % MAIN_REPO_REV,
-                MAIN_REPO, 'foo'),
-        'stdout': ('foo/\n'
-                   'foo/dir1/\n'
-                   'foo/dir1/file1\n'
-                   'foo/dir1/file2\n'
-                   'foo/dir2/\n'
-                   'foo/file3\n\n'),
-        }):
-      result = svn_util.ExtractNodeKinds(MAIN_REPO, MAIN_REPO_REV, 'foo')
+  def setUp(self):
+    svndump.CloseRepositories()
+
+  @test_utils.PatchSvn(svndump, svn_util)
+  def testDir(self, fs, unused_repos, core):
+    test_utils.MockTree(fs, core, {
+        '': 'dir',
+        'foo': 'dir',
+        'foo/dir1': 'dir',
+        'foo/dir1/file1': 'file',
+        'foo/dir1/file2': 'file',
+        'foo/dir2': 'dir',
+        'foo/file3': 'file',
+        'bar': 'file',
+        })
+    result = svn_util.ExtractNodeKinds(MAIN_REPO, MAIN_REPO_REV, 'foo')
     expected = {
         '': 'dir',
         'dir1': 'dir',
@@ -45,75 +50,248 @@ class ExtractNodeKindsTest(unittest.TestCase):
         }
     self.assertEqual(result, expected)
 
-  def testFile(self):
-    with test_utils.MockPopen.ExpectCommands({
-        'cmd': ('svnlook', 'tree', '--full-paths', '-r%s' % MAIN_REPO_REV,
-                MAIN_REPO, 'foo'),
-        'stdout': 'foo\n'
-        }):
-      result = svn_util.ExtractNodeKinds(MAIN_REPO, MAIN_REPO_REV, 'foo')
+  @test_utils.PatchSvn(svndump, svn_util)
+  def testFile(self, fs, unused_repos, core):
+    test_utils.MockTree(fs, core, {'': 'dir', 'foo': 'file'})
+    result = svn_util.ExtractNodeKinds(MAIN_REPO, MAIN_REPO_REV, 'foo')
     self.assertEqual(result, {'': 'file'})
 
-  def testFails(self):
-    with self.assertRaises(subprocess.CalledProcessError):
-      with test_utils.MockPopen.ExpectCommands({
-          'cmd': ('svnlook', 'tree', '--full-paths', '-r%s' % MAIN_REPO_REV,
-                  MAIN_REPO, 'foo'),
-          'stdout': 'foo\n',
-          'returncode': 1
-          }):
-        svn_util.ExtractNodeKinds(MAIN_REPO, MAIN_REPO_REV, 'foo')
 
+class WalkTreeTest(unittest.TestCase):
+  NODES = {
+      '': 'dir',
+      'branches': 'dir',
+      'branches/bar': 'dir',
+      'branches/bar/file': 'file',
+      'branches/bar/foo': 'dir',
+      'branches/bar/foo/a': 'file',
+      'branches/bar/other': 'dir',
+      'branches/bar/other/b': 'file',
+      }
 
-@mock.patch('subprocess.Popen', new=test_utils.MockPopen)
-class DiffTest(unittest.TestCase):
-  def testNormal(self):
-    with test_utils.MockPopen.ExpectCommands({
-        'cmd': ('svn', 'diff', '--summarize',
-                '--old=file://%s/%s@%s' % (MAIN_REPO, 'foo', MAIN_REPO_REV - 1),
-                '--new=file://%s/%s@%s' % (MAIN_REPO, 'foo', MAIN_REPO_REV)),
-        'stdout': ('A   file://' + MAIN_REPO + '/foo/added\n'
-                   'M   file://' + MAIN_REPO + '/foo/contents-changed\n'
-                   ' M  file://' + MAIN_REPO + '/foo/props-changed\n'
-                   'MM  file://' + MAIN_REPO + '/foo/both-changed\n'
-                   'D   file://' + MAIN_REPO + '/foo/deleted-dir\n'
-                   'D   file://' + MAIN_REPO + '/foo/deleted-dir/file\n'
-                   'D   file://' + MAIN_REPO + '/foo/dir/deleted\n')
-        }):
-      results = svn_util.Diff(MAIN_REPO,
-                              'foo', MAIN_REPO_REV - 1,
-                              'foo', MAIN_REPO_REV)
-    expected = {
-        'added': ('add', None),
+  def setUp(self):
+    svndump.CloseRepositories()
+
+  @test_utils.PatchSvn(svndump, svn_util)
+  def testWalk(self, fs, unused_repos, core):
+    test_utils.MockTree(fs, core, self.NODES)
+    visited = []
+    svn_util.WalkTree(MAIN_REPO, MAIN_REPO_REV, 'branches/bar',
+                      lambda *node: visited.append(node) or True)
+    self.assertEquals(visited, [('', 'dir'),
+                                ('file', 'file'),
+                                ('foo', 'dir'),
+                                ('foo/a', 'file'),
+                                ('other', 'dir'),
+                                ('other/b', 'file')])
+
+  @test_utils.PatchSvn(svndump, svn_util)
+  def testPrune(self, fs, unused_repos, core):
+    test_utils.MockTree(fs, core, self.NODES)
+    visited = []
+    visit = lambda path, _: visited.append(path) or path != 'branches'
+    svn_util.WalkTree(MAIN_REPO, MAIN_REPO_REV, '', visit)
+    self.assertEquals(visited, ['', 'branches'])
+    fs.dir_entries.assert_called_once_with(mock.ANY, '')
+
+  @test_utils.PatchSvn(svndump, svn_util)
+  def testFile(self, fs, unused_repos, core):
+    test_utils.MockTree(fs, core, self.NODES)
+    visited = []
+    svn_util.WalkTree(MAIN_REPO, MAIN_REPO_REV, 'branches/bar/file',
+                      lambda *node: visited.append(node) or True)
+    self.assertEquals(visited, [('', 'file')])
+
+
+class CompareTreesTest(unittest.TestCase):
+  OLD = {
+      '': ('dir', None, {}),
+      'foo': ('dir', None, {}),
+      'foo/same': ('file', 'a', {}),
+      'foo/contents-changed': ('file', 'a', {}),
+      'foo/props-changed': ('file', 'a', {}),
+      'foo/both-changed': ('file', 'a', {}),
+      'foo/deleted-dir': ('dir', None, {}),
+      'foo/deleted-dir/file': ('file', 'a', {}),
+      'foo/dir': ('dir', None, {}),
+      'foo/dir/deleted': ('file', 'a', {}),
+      'foo/dir/kept': ('file', 'a', {}),
+      'foo/kind-changed': ('file', 'a', {}),
+      'foo/unchanged': ('dir', None, {}),
+      'foo/unchanged/file': ('file', 'a', {}),
+      }
+  NEW = {
+      '': ('dir', None, {}),
+      'foo': ('dir', None, {}),
+      'foo/same': ('file', 'a', {}),
+      'foo/contents-changed': ('file', 'b', {}),
+      'foo/props-changed': ('file', 'a', {'p': 'v'}),
+      'foo/both-changed': ('file', 'b', {'p': 'v'}),
+      'foo/added': ('file', 'a', {}),
+      'foo/added-dir': ('dir', None, {'p': 'v'}),
+      'foo/added-dir/file': ('file', 'a', {}),
+      'foo/dir': ('dir', None, {}),
+      'foo/dir/kept': ('file', 'a', {}),
+      'foo/kind-changed': ('dir', None, {}),
+      'foo/unchanged': ('dir', None, {}),
+      'foo/unchanged/file': ('file', 'a', {}),
+      }
+
+  def setUp(self):
+    svndump.CloseRepositories()
+
+  def tearDown(self):
+    svndump.CloseRepositories()
+
+  @test_utils.PatchSvn(svndump, svn_util)
+  def testCompare(self, fs, unused_repos, core):
+    test_utils.MockRevisions(fs, core, {1: self.OLD, 2: self.NEW})
+    changes = svn_util.CompareTrees(MAIN_REPO, 'foo', 1, 'foo', 2)
+    self.assertEquals(changes, {
         'contents-changed': ('modify', None),
         'props-changed': (None, 'modify'),
         'both-changed': ('modify', 'modify'),
+        'added': ('add', None),
+        'added-dir': ('add', 'modify'),
+        'added-dir/file': ('add', None),
         'deleted-dir': ('delete', None),
         'dir/deleted': ('delete', None),
-        }
-    self.assertEqual(results, expected)
-
-  def testBadContentsOp(self):
-    with test_utils.MockPopen.ExpectCommands({
-        'cmd': ('svn', 'diff', '--summarize',
-                '--old=file://%s/%s@%s' % (MAIN_REPO, 'foo', MAIN_REPO_REV - 1),
-                '--new=file://%s/%s@%s' % (MAIN_REPO, 'foo', MAIN_REPO_REV)),
-        'stdout': 'X  file://' + MAIN_REPO + '/foo/unknown\n'
-        }), self.assertRaises(svn_util.UnknownDiff):
-      svn_util.Diff(MAIN_REPO,
-                    'foo', MAIN_REPO_REV - 1,
-                    'foo', MAIN_REPO_REV)
-
-  def testBadPropsOp(self):
-    with test_utils.MockPopen.ExpectCommands({
-        'cmd': ('svn', 'diff', '--summarize',
-                '--old=file://%s/%s@%s' % (MAIN_REPO, 'foo', MAIN_REPO_REV - 1),
-                '--new=file://%s/%s@%s' % (MAIN_REPO, 'foo', MAIN_REPO_REV)),
-        'stdout': ' X file://' + MAIN_REPO + '/foo/unknown\n'
-        }), self.assertRaises(svn_util.UnknownDiff):
-      svn_util.Diff(MAIN_REPO,
-                    'foo', MAIN_REPO_REV - 1,
-                    'foo', MAIN_REPO_REV)
+        'kind-changed': ('delete', None),
+        })
+    # Identical subtrees are not listed
+    listed = [args[1] for args, _ in fs.dir_entries.call_args_list]
+    self.assertNotIn('foo/unchanged', listed)
+    self.assertNotIn('foo/deleted-dir', listed)
+
+  @test_utils.PatchSvn(svndump, svn_util)
+  def testUnchanged(self, fs, unused_repos, core):
+    test_utils.MockRevisions(fs, core, {1: self.OLD, 2: self.OLD})
+    self.assertEquals(svn_util.CompareTrees(MAIN_REPO, 'foo', 1, 'foo', 2), {})
+    self.assertEquals(fs.dir_entries.call_count, 0)
+
+  @test_utils.PatchSvn(svndump, svn_util)
+  def testRootChanged(self, fs, unused_repos, core):
+    new = dict(self.OLD)
+    new['foo'] = ('dir', None, {'p': 'v'})
+    test_utils.MockRevisions(fs, core, {1: self.OLD, 2: new})
+    self.assertEquals(svn_util.CompareTrees(MAIN_REPO, 'foo', 1, 'foo', 2),
+                      {'': (None, 'modify')})
+
+  @test_utils.PatchSvn(svndump, svn_util)
+  def testDifferentPaths(self, fs, unused_repos, core):
+    new = dict(self.OLD)
+    new['bar'] = ('dir', None, {})
+    new['bar/same'] = ('file', 'a', {})
+    new['bar/added'] = ('file', 'a', {})
+    test_utils.MockRevisions(fs, core, {1: self.OLD, 2: new})
+    changes = svn_util.CompareTrees(MAIN_REPO, 'foo/unchanged', 1, 'bar', 2)
+    self.assertEquals(changes, {'file': ('delete', None),
+                                'same': ('add', None),
+                                'added': ('add', None)})
+
+  @test_utils.PatchSvn(svndump, svn_util)
+  def testHead(self, fs, unused_repos, core):
+    test_utils.MockRevisions(fs, core, {1: self.OLD, 2: self.NEW})
+    self.assertEquals(svn_util.CompareTrees(MAIN_REPO, 'foo', 1, 'foo', None),
+                      svn_util.CompareTrees(MAIN_REPO, 'foo', 1, 'foo', 2))
+    self.assertEquals(svn_util.CompareTrees(MAIN_REPO, 'foo', None, 'foo', 2),
+                      {})
+
+  @test_utils.PatchSvn(svndump, svn_util)
+  def testFile(self, fs, unused_repos, core):
+    test_utils.MockRevisions(fs, core, {1: self.OLD, 2: self.NEW})
+    self.assertEquals(
+        svn_util.CompareTrees(MAIN_REPO, 'foo/both-changed', 1,
+                              'foo/both-changed', 2),
+        {'': ('modify', 'modify')})
+
+
+class ListNodesTest(unittest.TestCase):
+  NODES = {
+      '': ('dir', None, {}),
+      'foo': ('dir', None, {'fooprop': 'fooval'}),
+      'foo/file': ('file', 'text', {}),
+      'foo/skip': ('dir', None, {}),
+      'foo/skip/file': ('file', 'text', {}),
+      'foo/zed': ('dir', None, {}),
+      'foo/zed/file': ('file', 'text', {}),
+      'foo/a': ('file', 'text', {}),
+      }
+
+  def setUp(self):
+    svndump.CloseRepositories()
+
+  def Serialize(self, records):
+    output = StringIO.StringIO()
+    # Not sorted: both functions must yield the Records in the same order
+    for record in records:
+      record.Write(output, None)
+    return output.getvalue()
+
+  @test_utils.PatchSvn(svndump, svn_util)
+  def testSameAsIterRecordsFromPath(self, fs, unused_repos, core):
+    test_utils.MockRevisions(fs, core, {MAIN_REPO_REV: self.NODES})
+    core.svn_stream_read = lambda stream, size: stream.read(size)
+    fs.file_md5_checksum.side_effect = lambda root, path: root[path][1]
+    fs.file_length.side_effect = lambda root, path: len(root[path][1])
+    fs.file_contents.side_effect = lambda root, path: io.BytesIO(
+        root[path][1])
+    nodes = svn_util.ListNodes(MAIN_REPO, MAIN_REPO_REV, 'foo')
+    self.assertEquals([node[0] for node in nodes],
+                      ['', 'a', 'file', 'skip', 'skip/file', 'zed',
+                       'zed/file'])
+    self.assertFalse(fs.file_contents.called)
+    prune = lambda path: path == 'bar/skip'
+    self.assertEquals(
+        self.Serialize(svndump.IterRecordsFromNodes(
+            MAIN_REPO, MAIN_REPO_REV, 'foo', 'bar', svndump.Record.EXTERNALS,
+            nodes, prune)),
+        self.Serialize(svndump.IterRecordsFromPath(
+            MAIN_REPO, MAIN_REPO_REV, 'foo', 'bar', svndump.Record.EXTERNALS,
+            prune)))
+
+
+class DiffTest(unittest.TestCase):
+  def setUp(self):
+    svn_util._DIFFS.clear()
+
+  def tearDown(self):
+    svn_util._DIFFS.clear()
+
+  @mock.patch.object(svn_util, 'CompareTrees')
+  def testCompares(self, compare):
+    compare.return_value = {'added': ('add', None)}
+    results = svn_util.Diff(MAIN_REPO,
+                            'foo', MAIN_REPO_REV - 1,
+                            'foo', MAIN_REPO_REV)
+    self.assertEqual(results, {'added': ('add', None)})
+    compare.assert_called_once_with(MAIN_REPO,
+                                    'foo', MAIN_REPO_REV - 1,
+                                    'foo', MAIN_REPO_REV)
+
+  @mock.patch.object(svn_util, 'CompareTrees')
+  def testMemoized(self, compare):
+    compare.return_value = {'added': ('add', None)}
+    results = svn_util.Diff(MAIN_REPO, 'foo', 1, 'foo', 2)
+    # Changing the results does not change what later callers get
+    del results['added']
+    self.assertEqual(svn_util.Diff(MAIN_REPO, 'foo', 1, 'foo', 2),
+                     {'added': ('add', None)})
+    self.assertEqual(compare.call_count, 1)
+    svn_util.Diff(MAIN_REPO, 'foo', 1, 'bar', 2)
+    self.assertEqual(compare.call_count, 2)
+
+  @mock.patch.object(svn_util, 'DIFF_CACHE_SIZE', 2)
+  @mock.patch.object(svn_util, 'CompareTrees')
+  def testLeastRecentlyUsedIsEvicted(self, compare):
+    compare.return_value = {}
+    for rev in (1, 2, 1, 3):  # 3 evicts 2
+      svn_util.Diff(MAIN_REPO, 'foo', rev, 'foo', 4)
+    self.assertEqual(compare.call_count, 3)
+    svn_util.Diff(MAIN_REPO, 'foo', 1, 'foo', 4)
+    self.assertEqual(compare.call_count, 3)
+    svn_util.Diff(MAIN_REPO, 'foo', 2, 'foo', 4)
+    self.assertEqual(compare.call_count, 4)
 
 
 if __name__ == '__main__':
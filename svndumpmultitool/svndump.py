@@ -11,9 +11,17 @@ http://svn.apache.org/repos/asf/subversion/trunk/notes/dump-load-format.txt
 
 from __future__ import absolute_import
 
+import abc
 import collections
-import md5
+import functools
+import hashlib
+import io
+import itertools
+import mmap
+from multiprocessing import pool as mp_pool
+import os
 import sys
+import tempfile
 
 from svn import core as svn_core
 from svn import fs as svn_fs
@@ -28,21 +36,317 @@ class PropsParseError(Error):
   """Failure to parse a Record's properties block."""
 
 
+class TextUnavailableError(Error):
+  """A Record's text content was discarded while reading it."""
+
+
+# Size of the pieces in which deferred text content is read and copied
+CHUNK_SIZE = 1 << 20
+# Text content larger than this that has to be read from a stream that cannot
+# seek back to it is kept in a temporary file instead of in memory
+SPOOL_THRESHOLD = 64 << 20
+# Size of the buffer in which RecordWriter collects output
+WRITE_BUFFER_SIZE = 1 << 20
+# Text content smaller than this is not worth handing to another thread to
+# compute its checksums
+CHECKSUM_THREAD_THRESHOLD = 256 << 10
+# The most Records a RecordWriter holds while checksums are computed
+MAX_PENDING_RECORDS = 1024
+# The most bytes of text content that those Records hold in memory, unless a
+# single Record holds more
+MAX_PENDING_TEXT = 64 << 20
+
+
+class _DeferredText(object):
+  """Text content that is not held in memory until it is needed.
+
+  Subclasses must set self.length and implement Chunks().
+  """
+  __metaclass__ = abc.ABCMeta
+
+  def __len__(self):
+    return self.length
+
+  @abc.abstractmethod
+  def Chunks(self):
+    """Yield the content as a series of strings."""
+
+  def Read(self):
+    """Return the entire content as a single string."""
+    return ''.join(self.Chunks())
+
+  def WriteTo(self, stream):
+    """Copy the content to a writeable file-like object."""
+    for chunk in self.Chunks():
+      stream.write(chunk)
+
+
+class _StreamSlice(_DeferredText):
+  """Text content located at a known offset within a seekable stream."""
+
+  def __init__(self, stream, offset, length):
+    self.stream = stream
+    self.offset = offset
+    self.length = length
+
+  def Chunks(self):
+    done = 0
+    while done < self.length:
+      # Other readers share the stream, so always return it to where it was.
+      position = self.stream.tell()
+      self.stream.seek(self.offset + done)
+      try:
+        data = self.stream.read(min(CHUNK_SIZE, self.length - done))
+      finally:
+        self.stream.seek(position)
+      if not data:
+        raise EOFError('Reached EOF while reading text content')
+      done += len(data)
+      yield data
+
+
+class _MappedSlice(_DeferredText):
+  """Text content located within a memory-mapped dump file (see MapFile)."""
+
+  def __init__(self, mapping, offset, length):
+    self.mapping = mapping
+    self.offset = offset
+    self.length = length
+
+  def Chunks(self):
+    end = self.offset + self.length
+    for start in xrange(self.offset, end, CHUNK_SIZE):
+      yield self.mapping[start:min(start + CHUNK_SIZE, end)]
+
+  def WriteTo(self, stream):
+    if isinstance(stream, (file, io.BufferedIOBase, io.RawIOBase)):
+      # Real files accept a buffer, so the mapped pages go straight to the OS
+      # without being copied into a Python string first.
+      stream.write(buffer(self.mapping, self.offset, self.length))
+    else:
+      _DeferredText.WriteTo(self, stream)
+
+
+class _SVNFileText(_DeferredText):
+  """The content of a file in an SVN repository revision root."""
+
+  def __init__(self, root, path):
+    self.root = root
+    self.path = path
+    self.length = svn_fs.file_length(root, path)
+
+  def Chunks(self):
+    stream = svn_fs.file_contents(self.root, self.path)
+    while True:
+      data = svn_core.svn_stream_read(stream, CHUNK_SIZE)
+      if not data:
+        break
+      yield data
+
+
+def _FileText(fileobj):
+  """Wrap the rest of a seekable file as deferred text content."""
+  offset = fileobj.tell()
+  fileobj.seek(0, os.SEEK_END)
+  length = fileobj.tell() - offset
+  fileobj.seek(offset)
+  return _StreamSlice(fileobj, offset, length)
+
+
+def SpoolText(chunks, threshold=None):
+  """Collect text content, spilling it to a temporary file if it is large.
+
+  Args:
+    chunks: an iterable of strings that make up the content
+    threshold: the largest content, in bytes, to keep in memory (default
+               SPOOL_THRESHOLD)
+
+  Returns:
+    the content as a str if it is no larger than threshold, otherwise an
+    object backed by a temporary file that can be assigned to Record.text
+  """
+  if threshold is None:
+    threshold = SPOOL_THRESHOLD
+  chunks = iter(chunks)
+  held = []
+  size = 0
+  for chunk in chunks:
+    held.append(chunk)
+    size += len(chunk)
+    if size > threshold:
+      break
+  else:
+    return ''.join(held)
+  spool = tempfile.TemporaryFile(prefix='svndump')
+  for chunk in itertools.chain(held, chunks):
+    spool.write(chunk)
+  del held[:]
+  spool.flush()
+  spool.seek(0)
+  return _FileText(spool)
+
+
+class _DiscardedText(_DeferredText):
+  """Text content that was skipped on a stream that cannot seek back to it."""
+
+  def __init__(self, length):
+    self.length = length
+
+  def Chunks(self):
+    raise TextUnavailableError('Text content was discarded while reading')
+
+
+class _TrackedDict(collections.OrderedDict):
+  """An OrderedDict that remembers whether it was modified after creation."""
+
+  def __init__(self, *args, **kwargs):
+    collections.OrderedDict.__init__(self, *args, **kwargs)
+    self.modified = False
+
+  def __setitem__(self, key, value, **kwargs):
+    self.modified = True
+    collections.OrderedDict.__setitem__(self, key, value, **kwargs)
+
+  def __delitem__(self, key, **kwargs):
+    self.modified = True
+    collections.OrderedDict.__delitem__(self, key, **kwargs)
+
+  def clear(self):
+    self.modified = True
+    collections.OrderedDict.clear(self)
+
+
+# Header layouts (tuples of interned header names) shared between _Headers
+_LAYOUTS = {}
+# Headers whose values repeat often enough to be worth interning
+_INTERNED_VALUE_HEADERS = frozenset(['Node-kind', 'Node-action', 'Prop-delta',
+                                     'Text-delta'])
+
+
+def _Layout(keys):
+  """Return the shared copy of a tuple of header names."""
+  return _LAYOUTS.setdefault(keys, keys)
+
+
+class _Headers(object):
+  """A compact ordered mapping from header names to values.
+
+  Dump files repeat the same handful of header names in the same handful of
+  orders for every node, so instead of a dict of its own, each _Headers keeps
+  a plain list of values. The names, in order, are a tuple of interned strings
+  that is shared by every _Headers with the same layout. Names are looked up
+  by position in the tuple, which is fast for the few headers a Record has.
+
+  Like _TrackedDict, it remembers whether it was modified after creation.
+  """
+  __slots__ = ('_keys', '_values', 'modified')
+
+  def __init__(self):
+    self._keys = ()
+    self._values = []
+    self.modified = False
+
+  def __getitem__(self, key):
+    try:
+      return self._values[self._keys.index(key)]
+    except ValueError:
+      raise KeyError(key)
+
+  def __setitem__(self, key, value):
+    self.modified = True
+    if key in _INTERNED_VALUE_HEADERS and type(value) is str:
+      value = intern(value)
+    try:
+      self._values[self._keys.index(key)] = value
+    except ValueError:
+      self._keys = _Layout(self._keys + (intern(key),))
+      self._values.append(value)
+
+  def __delitem__(self, key):
+    try:
+      index = self._keys.index(key)
+    except ValueError:
+      raise KeyError(key)
+    self.modified = True
+    self._keys = _Layout(self._keys[:index] + self._keys[index+1:])
+    del self._values[index]
+
+  def __contains__(self, key):
+    return key in self._keys
+
+  def __iter__(self):
+    return iter(self._keys)
+
+  def __len__(self):
+    return len(self._keys)
+
+  def __eq__(self, other):
+    if isinstance(other, _Headers):
+      return self._keys == other._keys and self._values == other._values
+    return dict(self.iteritems()) == other
+
+  def __ne__(self, other):
+    return not self == other
+
+  __hash__ = None
+
+  def __repr__(self):
+    return '_Headers(%r)' % self.items()
+
+  def get(self, key, default=None):
+    try:
+      return self._values[self._keys.index(key)]
+    except ValueError:
+      return default
+
+  def pop(self, key, *default):
+    try:
+      value = self[key]
+    except KeyError:
+      if default:
+        return default[0]
+      raise
+    del self[key]
+    return value
+
+  def keys(self):
+    return list(self._keys)
+
+  def values(self):
+    return list(self._values)
+
+  def items(self):
+    return zip(self._keys, self._values)
+
+  def iteritems(self):
+    return itertools.izip(self._keys, self._values)
+
+
 class Record(object):
   """A record of RFC822-ish headers-plus-data from an SVN dump file.
 
   Attributes:
-    headers: {str: str} OrderedDict representing the headers section
+    headers: {str: str} ordered mapping representing the headers section
     props: {str: str} OrderedDict representing the properties section, or None
-           if no properties section
-    text: str text content or None if no text content
+           if no properties section. Records read from a dump file only parse
+           their properties when this is first accessed.
+    text: str text content or None if no text content. Records read from a
+          seekable stream only load their text when this is first accessed.
+          It may also be set to a seekable file object positioned at the
+          start of the content (or to the result of SpoolText), which Write
+          then copies in chunks without loading it into memory.
     source: constant value for internal use only representing the source of the
             Record (see comments on DUMP, COPY, EXTERNALS).
+    dirty: False if the Record was read from a dump file and has not been
+           modified since, so it can be written back exactly as it was read.
   """
   DUMP = 0  # Record was read from the dump file being filtered
   COPY = 1  # Record was created to dereference a copy action
   EXTERNALS = 2  # Record was internalize an external path
 
+  # There can be millions of Records in memory at once.
+  __slots__ = ('headers', 'source', '_text', '_props', '_proptext', '_raw')
+
   def __init__(self, path=None, action=None, kind=None, source=DUMP):
     """Create a new Record.
 
@@ -55,9 +359,14 @@ class Record(object):
     path, action, and kind arguments are merely helpers to set the most commonly
     used headers.
     """
-    self.headers = collections.OrderedDict()
-    self.text = None
-    self.props = None
+    self.headers = _Headers()
+    self._text = None
+    self._props = None
+    # The properties block read from a dump file until props is accessed
+    self._proptext = None
+    # (header block, props block) exactly as read, or None if not read or if
+    # the text or props have been replaced since
+    self._raw = None
     self.source = source
     if path is not None:
       self.headers['Node-path'] = path
@@ -66,6 +375,87 @@ class Record(object):
     if kind is not None:
       self.headers['Node-kind'] = kind
 
+  @property
+  def text(self):
+    if isinstance(self._text, _DeferredText):
+      self._text = self._text.Read()
+    return self._text
+
+  @text.setter
+  def text(self, value):
+    if value is not None and not isinstance(value, (basestring,
+                                                     _DeferredText)):
+      value = _FileText(value)
+    self._text = value
+    self._raw = None
+
+  def HasText(self):
+    """Does the Record have text content? Unlike text, never loads it."""
+    return self._text is not None
+
+  def CopyTextFrom(self, other):
+    """Give the Record the same text content as another without loading it."""
+    self.text = other._text
+
+  def LoadRepositoryText(self):
+    """Read text content that is still in an SVN repository.
+
+    Records generated from a repository (e.g. by IterRecordsFromPath) only
+    read their text when they are written. SVN repository objects must not be
+    used by two threads at once, so this must be called on the thread that
+    uses the repository before the Record is handed to another thread. Large
+    content is spilled to a temporary file (see SpoolText).
+    """
+    if isinstance(self._text, _SVNFileText):
+      # Not a modification, so _raw stays valid
+      self._text = SpoolText(self._text.Chunks())
+
+  def HeldTextSize(self):
+    """Return the number of bytes of text content held in memory."""
+    return len(self._text) if type(self._text) is str else 0
+
+  def _SpillText(self, stream):
+    """Move text content held in memory to the end of a temporary file."""
+    if type(self._text) is str:
+      stream.seek(0, os.SEEK_END)
+      offset = stream.tell()
+      stream.write(self._text)
+      # Not a modification, so _raw stays valid
+      self._text = _StreamSlice(stream, offset, len(self._text))
+
+  @property
+  def props(self):
+    if self._proptext is not None:
+      self._props = _ParseProps(self._proptext)
+      self._proptext = None
+    return self._props
+
+  @props.setter
+  def props(self, value):
+    self._props = value
+    self._proptext = None
+    self._raw = None
+
+  def HasProps(self):
+    """Does the Record have a properties block? Unlike props, never parses it."""
+    return self._props is not None or self._proptext is not None
+
+  def HasProperty(self, key):
+    """Does the properties block set or delete key?
+
+    Unlike checking props, this does not parse a properties block that has not
+    been parsed yet.
+    """
+    if self._proptext is not None:
+      return _PropsContainKey(self._proptext, key)
+    return self._props is not None and key in self._props
+
+  @property
+  def dirty(self):
+    return (self._raw is None
+            or self.headers.modified
+            or (self._props is not None and self._props.modified))
+
   def DeleteHeader(self, key):
     """Delete a header if it exists."""
     self.headers.pop(key, None)
@@ -78,21 +468,29 @@ class Record(object):
 
   def DeleteProperty(self, key):
     """Delete a property if it exists."""
-    if self.props and key in self.props:
+    if self.HasProperty(key):
       del self.props[key]
 
   def _GeneratePropText(self):
     """Create a property block from self.props or empty string if it is None."""
-    if self.props is None:
+    if self._proptext is not None:
+      # Never parsed, so it can't have been modified
+      return self._proptext
+    if self._props is None:
       return ''
-    proptext = ''
+    # Collect the pieces and join them once; values are never copied into a
+    # format string since they can be several megabytes (e.g. svn:mergeinfo).
+    parts = []
     for key, val in self.props.iteritems():
       if val is None:
-        proptext += 'D %d\n%s\n' % (len(key), key)
+        parts.append('D %d\n%s\n' % (len(key), key))
       else:
-        proptext += 'K %d\n%s\nV %d\n%s\n' % (len(key), key, len(str(val)), val)
-    proptext += 'PROPS-END\n'
-    return proptext
+        val = str(val)
+        parts.append('K %d\n%s\nV %d\n' % (len(key), key, len(val)))
+        parts.append(val)
+        parts.append('\n')
+    parts.append('PROPS-END\n')
+    return ''.join(parts)
 
   def _FixHeaders(self, proptext, revmap):
     """Recompute headers that depend on other headers or text content.
@@ -104,39 +502,30 @@ class Record(object):
     Revision remapping also happens here, but probably it should happen in
     _FilterRev() instead because _FixHeaders should be idempotent.
 
-    SVN supports both MD5 and SHA1 checksums. MD5 is good enough to check for
-    corruption, we're not worried about sabotage, it is slightly faster than
-    SHA1, and compatible with older SVN repositories that don't have SHA1
-    support.  We never modify the content, so we don't need to recompute the
-    header if it already exists.
+    Missing checksums are computed by _ComputeChecksums. We never modify the
+    content, so we don't need to recompute them if they already exist.
     """
     if proptext:
       self.headers['Prop-content-length'] = str(len(proptext))
     else:
       self.DeleteHeader('Prop-content-length')
     # Delete or add Text-content headers as necessary.
-    if self.text is None:
+    if self._text is None:
       # Remove text-related headers since there is no text.
       self.DeleteHeader('Text-content-length')
       self.DeleteHeader('Text-content-md5')
       self.DeleteHeader('Text-content-sha1')
       self.DeleteHeader('Text-delta')
     else:
-      self.headers['Text-content-length'] = str(len(self.text))
-
-      # For Text-delta: true, the md5 is for the entire file, so never compute
-      # the md5 of the delta.
-      if ('Text-content-md5' not in self.headers
-          and self.headers.get('Text-delta') != 'true'):
-        m = md5.new()
-        m.update(self.text)
-        self.headers['Text-content-md5'] = m.hexdigest()
+      self.headers['Text-content-length'] = str(len(self._text))
+      if self._NeedsChecksums():
+        self._ComputeChecksums()
     # Generate overall Content-length header
-    if not proptext and self.text is None:
+    if not proptext and self._text is None:
       self.DeleteHeader('Content-length')
     else:
       try:
-        textlen = len(self.text)
+        textlen = len(self._text)
       except TypeError:
         textlen = 0
       self.headers['Content-length'] = str(len(proptext) + textlen)
@@ -150,6 +539,34 @@ class Record(object):
           old_rev = int(self.headers[header])
           self.headers[header] = str(revmap[old_rev])
 
+  def _NeedsChecksums(self):
+    """Does _FixHeaders have to compute checksums of the text content?"""
+    # For Text-delta: true, the md5 is for the entire file, so never compute
+    # the md5 of the delta.
+    return (self._text is not None
+            and 'Text-content-md5' not in self.headers
+            and self.headers.get('Text-delta') != 'true')
+
+  def _ComputeChecksums(self):
+    """Set the Text-content-md5 and Text-content-sha1 headers from the text.
+
+    SVN supports both checksums. svnadmin load verifies MD5; SHA1 is also
+    given so that it is never missing when the text has been replaced.
+    hashlib releases the GIL on large chunks, so this can run on another thread
+    (see RecordWriter) while the Record is not being modified.
+    """
+    md5 = hashlib.md5()
+    sha1 = hashlib.sha1()
+    if isinstance(self._text, _DeferredText):
+      chunks = self._text.Chunks()
+    else:
+      chunks = (self._text,)
+    for chunk in chunks:
+      md5.update(chunk)
+      sha1.update(chunk)
+    self.headers['Text-content-md5'] = md5.hexdigest()
+    self.headers['Text-content-sha1'] = sha1.hexdigest()
+
   def Write(self, stream, revmap):
     """Write a Record to the given file-like object.
 
@@ -159,20 +576,71 @@ class Record(object):
 
     This calls _FixHeaders to ensure that the Record's headers are consistent
     with its content (revision remapping also currently occurs there).
+
+    Text content that has not been loaded yet is copied to stream in chunks
+    without being kept in memory.
+
+    If the Record is not dirty and needs no renumbering, its headers and
+    properties are written exactly as they were read instead.
     """
-    proptext = self._GeneratePropText()
-    self._FixHeaders(proptext, revmap)
-    for key, val in self.headers.iteritems():
-      stream.write('%s: %s\n' % (key, val))
-    stream.write('\n')
-    stream.write(proptext)
-    if self.text is not None:
-      stream.write(self.text)
-      stream.write('\n')
+    for block in self._Blocks(revmap):
+      if isinstance(block, _DeferredText):
+        block.WriteTo(stream)
+      else:
+        stream.write(block)
+
+  def _Blocks(self, revmap):
+    """Serialize a Record for Write.
+
+    Args:
+      revmap: a dict mapping old revision number to new revision number
+
+    Returns:
+      a list of strs and deferred text contents that make up the Record when
+      written in order
+    """
+    if self._CanWriteRaw(revmap):
+      header_text, proptext = self._raw
+      header_text += '\n'
+    else:
+      proptext = self._GeneratePropText()
+      self._FixHeaders(proptext, revmap)
+      header_text = ''.join(['%s: %s\n' % (key, val)
+                             for key, val in self.headers.iteritems()]
+                            + ['\n'])
+    blocks = [header_text]
+    if proptext:
+      blocks.append(proptext)
+    if self._text is not None:
+      blocks.append(self._text)
+      blocks.append('\n')
     if ('Prop-content-length' in self.headers
         or 'Text-content-length' in self.headers
         or 'Content-length' in self.headers):
-      stream.write('\n')
+      blocks.append('\n')
+    return blocks
+
+  def _CanWriteRaw(self, revmap):
+    """Would _FixHeaders leave the headers of a clean Record unchanged?
+
+    Args:
+      revmap: a dict mapping old revision number to new revision number
+
+    Returns:
+      True if the Record can be written back exactly as it was read
+    """
+    if self.dirty:
+      return False
+    if revmap:
+      for header in ['Revision-number', 'Node-copyfrom-rev']:
+        if header in self.headers:
+          old_rev = int(self.headers[header])
+          if revmap[old_rev] != old_rev:
+            return False
+    # _FixHeaders adds a missing checksum
+    return (self._text is None
+            or 'Text-content-md5' in self.headers
+            or self.headers.get('Text-delta') == 'true')
 
   def DoesNotAffectExternals(self):
     """Can a Record be determined to NOT affect svn:externals in any way?
@@ -197,10 +665,10 @@ class Record(object):
     elif self.headers['Node-kind'] != 'dir':
       # Only directories can have externals.
       return True
-    elif self.props is None:
+    elif not self.HasProps():
       # Without a properties block, externals cannot be affected.
       return True
-    elif 'svn:externals' in self.props:
+    elif self.HasProperty('svn:externals'):
       return False
     elif self.headers['Node-action'] == 'add':
       # Add actions explicitly declare their properties.
@@ -225,27 +693,471 @@ class Record(object):
             and self.text == other.text)
 
 
-def ReadRecord(stream):
+class TextSpill(object):
+  """Keeps the text content of a group of Records within a memory budget.
+
+  Records are added as they are held back. Once the text content held in
+  memory by the Records added exceeds the budget, it is all moved to a
+  temporary file and only read back when it is needed (usually when the
+  Record is written). The file is deleted once none of the Records need it.
+  """
+
+  def __init__(self, budget=None):
+    """Create a new TextSpill.
+
+    Args:
+      budget: the most text content, in bytes, to hold in memory, or None for
+              no limit
+    """
+    self.budget = budget
+    self._records = []  # Records added that still hold text in memory
+    self._size = 0
+    self._file = None
+
+  def Add(self, record):
+    """Count a Record's text content against the budget."""
+    if self.budget is None:
+      return
+    size = record.HeldTextSize()
+    if not size:
+      return
+    self._records.append(record)
+    self._size += size
+    if self._size > self.budget:
+      if self._file is None:
+        self._file = tempfile.TemporaryFile(prefix='svndump')
+      for held in self._records:
+        held._SpillText(self._file)
+      del self._records[:]
+      self._size = 0
+
+
+class RecordWriter(object):
+  """Writes Records to a stream in large batches.
+
+  Record.Write makes several small writes per Record. A RecordWriter instead
+  copies Records into a reusable buffer and writes it out once it is full, so
+  a run of small Records costs a single write. Blocks too large for the
+  buffer, such as big text content, are written directly without being copied
+  into it (deferred text with Record.WriteTo, so memory-mapped text is still
+  never copied).
+
+  With checksum_threads, missing checksums of large text content are computed
+  by a pool of threads. Records are still written in the order they are given,
+  each one once its checksums (and those of the Records before it) are ready.
+  The threads are only started when the first such Record is written, so a
+  RecordWriter can be created before forking.
+
+  Close (or Flush) must be called once done, before the stream is used in any
+  other way.
+  """
+
+  def __init__(self, stream, buffer_size=WRITE_BUFFER_SIZE,
+               checksum_threads=0):
+    """Create a new RecordWriter.
+
+    Args:
+      stream: a writeable file-like object
+      buffer_size: the size of the buffer in bytes. 0 writes every block of
+                   every Record as soon as it is given.
+      checksum_threads: the number of threads computing checksums, or 0 to
+                        compute them when the Record is written
+    """
+    self.stream = stream
+    self.buffer_size = buffer_size
+    self._buffer = bytearray(buffer_size)
+    self._view = memoryview(self._buffer)
+    self._used = 0
+    # Real files accept the buffer itself; others get a copy as a str
+    self._takes_buffer = isinstance(stream, (file, io.BufferedIOBase,
+                                             io.RawIOBase))
+    self.checksum_threads = checksum_threads
+    self._pool = None
+    # (Record, revmap, AsyncResult or None, held text size) waiting for
+    # earlier checksums
+    self._pending = collections.deque()
+    self._pending_size = 0
+
+  def Write(self, record, revmap):
+    """Write a Record (see Record.Write)."""
+    # Other text may be read through a stream that the caller is still using
+    if (self.checksum_threads and record._NeedsChecksums()
+        and isinstance(record._text, (str, _MappedSlice))
+        and len(record._text) >= CHECKSUM_THREAD_THRESHOLD):
+      if self._pool is None:
+        self._pool = mp_pool.ThreadPool(self.checksum_threads)
+      result = self._pool.apply_async(record._ComputeChecksums)
+    elif self._pending:
+      result = None
+    else:
+      self._WriteNow(record, revmap)
+      return
+    size = record.HeldTextSize()
+    self._pending.append((record, revmap, result, size))
+    self._pending_size += size
+    self._WritePending(False)
+
+  def _WritePending(self, wait):
+    """Write pending Records whose checksums are ready.
+
+    Also waits for checksums while the pending Records are more, or hold more
+    text content, than MAX_PENDING_RECORDS and MAX_PENDING_TEXT allow.
+
+    Args:
+      wait: if True, wait for the checksums of every pending Record
+    """
+    pending = self._pending
+    while pending:
+      record, revmap, result, size = pending[0]
+      if result is not None:
+        if not (wait or result.ready()
+                or len(pending) > MAX_PENDING_RECORDS
+                or self._pending_size > MAX_PENDING_TEXT):
+          break
+        # Raises any exception from _ComputeChecksums
+        result.get()
+      pending.popleft()
+      self._pending_size -= size
+      self._WriteNow(record, revmap)
+
+  def _WriteNow(self, record, revmap):
+    blocks = record._Blocks(revmap)
+    text = record._text
+    if text is None or (type(text) is str and len(text) < self.buffer_size):
+      # Joining the blocks of a small Record is cheaper than copying each
+      self._Add(''.join(blocks))
+    else:
+      for block in blocks:
+        self._Add(block)
+
+  def _Add(self, block):
+    """Copy a str or deferred text into the buffer or write it directly."""
+    size = len(block)
+    used = self._used
+    if used + size > self.buffer_size:
+      self._FlushBuffer()
+      used = 0
+      if size > self.buffer_size:
+        if isinstance(block, _DeferredText):
+          block.WriteTo(self.stream)
+        else:
+          self.stream.write(block)
+        return
+    if isinstance(block, _DeferredText):
+      for chunk in block.Chunks():
+        end = used + len(chunk)
+        self._view[used:end] = chunk
+        used = end
+      self._used = used
+    else:
+      self._used = used + size
+      self._view[used:self._used] = block
+
+  def Flush(self):
+    """Write out every Record given so far."""
+    self._WritePending(True)
+    self._FlushBuffer()
+
+  def _FlushBuffer(self):
+    if self._used:
+      data = self._view[:self._used]
+      self.stream.write(data if self._takes_buffer else data.tobytes())
+      self._used = 0
+
+  def Close(self):
+    """Flush and stop the checksum threads."""
+    self.Flush()
+    if self._pool is not None:
+      self._pool.close()
+      self._pool.join()
+      self._pool = None
+
+
+def ReadRecord(stream, discard_text=None):
   """Read a Record from the given file-like object.
 
   Args:
     stream: a readable file-like object
+    discard_text: an optional callable that is passed the Record once its
+                  headers and properties have been read. If it returns True,
+                  the text content will be thrown away rather than read into
+                  memory (only relevant if stream is not seekable).
 
   Returns:
     a Record read from stream or None if EOF is reached
+
+  If stream is seekable (including a mapping created by MapFile), the text
+  content is not read. Instead, the Record
+  remembers where to find it and stream seeks past it. The text is only read
+  if it is needed (see Record.text and Record.Write). Otherwise, the text is
+  read immediately unless discard_text says it will never be needed, in which
+  case it is read and thrown away in chunks.
   """
   record = _ReadRFC822Headers(stream)
   if record is None:
     return None
+  header_text = record._raw[0]
   pcl = int(record.headers.get('Prop-content-length', '0'))
   if pcl > 0:
-    record.props = _ParseProps(stream.read(pcl))
+    proptext = stream.read(pcl)
+    record._proptext = proptext
+  else:
+    proptext = ''
   if 'Text-content-length' in record.headers:
     tcl = int(record.headers['Text-content-length'])
-    record.text = stream.read(tcl)
+    offset = _Tell(stream)
+    if isinstance(stream, mmap.mmap):
+      stream.seek(tcl, os.SEEK_CUR)
+      record.text = _MappedSlice(stream, offset, tcl)
+    elif offset is not None:
+      stream.seek(tcl, os.SEEK_CUR)
+      record.text = _StreamSlice(stream, offset, tcl)
+    elif discard_text is not None and discard_text(record):
+      _Skip(stream, tcl)
+      record.text = _DiscardedText(tcl)
+    else:
+      record.text = SpoolText(_ReadChunks(stream, tcl))
+  # Remember the raw blocks so an unmodified Record can be written verbatim
+  record._raw = (header_text, proptext)
   return record
 
 
+def MapFile(stream):
+  """Memory-map a dump file so that text content is never copied.
+
+  Args:
+    stream: a file object open for reading on a regular, non-empty file
+
+  Returns:
+    an mmap.mmap that can be passed to ReadRecord in place of stream
+
+  Raises:
+    EnvironmentError: if stream can not be mapped (e.g. it is a pipe)
+    ValueError: if stream is empty
+
+  The text of Records read from the mapping stays in the mapping: Record.Write
+  passes slices of it directly to the output file, so even very large files
+  pass through without ever being copied into a Python string.
+  """
+  return mmap.mmap(stream.fileno(), 0, access=mmap.ACCESS_READ)
+
+
+def _Tell(stream):
+  """Return the current position of stream or None if it is not seekable."""
+  try:
+    return stream.tell()
+  except (AttributeError, IOError):
+    return None
+
+
+def _Skip(stream, length):
+  """Read and throw away length bytes from a non-seekable stream.
+
+  Raises:
+    EOFError: if EOF is reached before length bytes were read
+  """
+  while length > 0:
+    data = stream.read(min(CHUNK_SIZE, length))
+    if not data:
+      raise EOFError('Reached EOF while skipping text content')
+    length -= len(data)
+
+
+def _ReadChunks(stream, length):
+  """Read up to length bytes from stream, yielding them in chunks."""
+  while length > 0:
+    data = stream.read(min(CHUNK_SIZE, length))
+    if not data:
+      break
+    length -= len(data)
+    yield data
+
+
+def MakeRecordReader(stream):
+  """Choose the fastest way to read Records from a stream.
+
+  Args:
+    stream: a readable file-like object (or a mapping created by MapFile)
+
+  Returns:
+    a function that takes the same optional discard_text argument as
+    ReadRecord and returns the next Record from stream or None at EOF
+
+  Seekable streams are read with ReadRecord so that text content can be
+  loaded lazily. Other streams (e.g. stdin connected to a pipe) are read with
+  a RecordScanner. Once a reader has been created, stream must not be read
+  from in any other way.
+  """
+  if _Tell(stream) is None:
+    return RecordScanner(stream).ReadRecord
+  else:
+    return functools.partial(ReadRecord, stream)
+
+
+class RecordScanner(object):
+  """Reads Records from a stream that is not seekable using large reads.
+
+  ReadRecord reads headers one line at a time and the properties and text
+  with separate reads, which adds up to a lot of small reads. A RecordScanner
+  instead fills a large buffer at a time, finds each header block by
+  searching for the blank line that ends it, and slices the headers,
+  properties, and text out of the buffer.
+
+  Since the RecordScanner reads ahead, the stream must not be read from in any
+  other way once a RecordScanner has been created for it.
+  """
+
+  def __init__(self, stream, block_size=CHUNK_SIZE, spool_threshold=None):
+    """Create a new RecordScanner.
+
+    Args:
+      stream: a readable file-like object
+      block_size: the number of bytes to try to read at a time
+      spool_threshold: see the threshold argument of SpoolText
+    """
+    self.stream = stream
+    self.block_size = block_size
+    self.spool_threshold = spool_threshold
+    self._buffer = bytearray(block_size)
+    self._start = 0  # First byte of _buffer not consumed yet
+    self._end = 0  # End of the data in _buffer
+    self._eof = False
+
+  def ReadRecord(self, discard_text=None):
+    """Read the next Record.
+
+    Args:
+      discard_text: see the discard_text argument of ReadRecord
+
+    Returns:
+      a Record or None if EOF is reached
+
+    Raises:
+      EOFError: if EOF is reached in the middle of a Record
+    """
+    header_text = self._ReadHeaderBlock()
+    if header_text is None:
+      return None
+    record = Record()
+    for line in header_text[:-1].split('\n'):
+      key, val = line.split(': ', 1)
+      record.headers[key] = val
+    pcl = int(record.headers.get('Prop-content-length', '0'))
+    if pcl > 0:
+      proptext = self._Read(pcl)
+      record._proptext = proptext
+    else:
+      proptext = ''
+    if 'Text-content-length' in record.headers:
+      tcl = int(record.headers['Text-content-length'])
+      if discard_text is not None and discard_text(record):
+        self._Skip(tcl)
+        record.text = _DiscardedText(tcl)
+      else:
+        record.text = SpoolText(self._Chunks(tcl), self.spool_threshold)
+    record.headers.modified = False
+    record._raw = (header_text, proptext)
+    return record
+
+  def _ReadHeaderBlock(self):
+    """Read the next header block (see _ReadRFC822Headers).
+
+    Returns:
+      the header lines, each ending in a newline, or None at EOF
+    """
+    # Skip blank lines before the headers
+    while True:
+      while self._start < self._end and self._buffer[self._start] == 10:
+        self._start += 1
+      if self._start < self._end or not self._Fill():
+        break
+    if self._start == self._end:
+      return None
+    searched = 0  # Number of bytes after _start already searched
+    while True:
+      blank = self._buffer.find('\n\n', self._start + searched, self._end)
+      if blank >= 0:
+        header_text = str(buffer(self._buffer, self._start,
+                                 blank + 1 - self._start))
+        self._start = blank + 2
+        return header_text
+      # Search the last byte again in case the blank line spans two reads
+      searched = max(0, self._end - self._start - 1)
+      if not self._Fill():
+        raise EOFError('Reached EOF while reading headers')
+
+  def _Fill(self):
+    """Read more data into the buffer.
+
+    Returns:
+      False if EOF was reached without reading anything, otherwise True
+
+    Unconsumed data is moved to the start of the buffer first, and the buffer
+    is grown if it is already full of unconsumed data (i.e. a header block is
+    larger than the buffer).
+    """
+    if self._eof:
+      return False
+    if self._start:
+      self._buffer[:self._end - self._start] = (
+          self._buffer[self._start:self._end])
+      self._end -= self._start
+      self._start = 0
+    if self._end == len(self._buffer):
+      self._buffer.extend(bytearray(self.block_size))
+    read = _ReadInto(self.stream, memoryview(self._buffer)[self._end:])
+    if not read:
+      self._eof = True
+      return False
+    self._end += read
+    return True
+
+  def _Read(self, length):
+    """Consume and return length bytes."""
+    return ''.join(self._Chunks(length))
+
+  def _Chunks(self, length):
+    """Consume length bytes, yielding them in chunks."""
+    if self._end - self._start < length and length <= len(self._buffer):
+      while self._end - self._start < length and self._Fill():
+        pass
+    available = min(length, self._end - self._start)
+    if available:
+      data = str(buffer(self._buffer, self._start, available))
+      self._start += available
+      yield data
+    # Anything too big for the buffer is read straight from the stream
+    for data in _ReadChunks(self.stream, length - available):
+      yield data
+
+  def _Skip(self, length):
+    """Consume and throw away length bytes."""
+    available = min(length, self._end - self._start)
+    self._start += available
+    if available < length:
+      _Skip(self.stream, length - available)
+
+
+def _ReadInto(stream, view):
+  """Read from stream into a writable buffer.
+
+  Args:
+    stream: a readable file-like object
+    view: a memoryview to read into
+
+  Returns:
+    the number of bytes read (0 at EOF)
+  """
+  try:
+    readinto = stream.readinto
+  except AttributeError:
+    # Not all file-like objects (e.g. StringIO) support readinto
+    data = stream.read(len(view))
+    view[:len(data)] = data
+    return len(data)
+  return readinto(view) or 0
+
+
 def _ReadRFC822Headers(stream):
   """Create a Record with headers populated by reading from a stream.
 
@@ -253,7 +1165,9 @@ def _ReadRFC822Headers(stream):
     stream: a file-like stream
 
   Returns:
-    a Record if parsing succeeds or None if stream was empty
+    a Record if parsing succeeds or None if stream was empty. The header block
+    exactly as it was read is saved for ReadRecord in the Record's _raw
+    attribute (excluding the blank line that ends it).
 
   Raises:
     EOFError: if EOF is reached before a blank line indicating the end of the
@@ -262,6 +1176,7 @@ def _ReadRFC822Headers(stream):
   Helper for Read().
   """
   record = Record()
+  lines = []
   while True:
     # It is necessary to use readline() instead of iterating over stream because
     # the file iterator keeps its own internal buffer, causing future uses of
@@ -272,9 +1187,12 @@ def _ReadRFC822Headers(stream):
       break
     if line == '\n':
       if record.headers:
+        record.headers.modified = False
+        record._raw = (''.join(lines), '')
         return record
       else:
         continue  # newline before headers is simply ignored
+    lines.append(line)
     line = line.rstrip('\n')
     key, val = line.split(': ', 1)
     record.headers[key] = val
@@ -329,51 +1247,165 @@ def _ParseProps(proptext):
   In version 3 of the format, a third type 'D' of property record is
   introduced to describe property deletion.
   """
-  # TODO use BytesIO to clean this up
-  props = collections.OrderedDict()
+  props = _TrackedDict()
   index = 0
-  while True:
-    if proptext[index:index+2] == 'K ':
-      wantval = True
-    elif proptext[index:index+2] == 'D ':
-      wantval = False
-    elif proptext[index:index+9] == 'PROPS-END':
-      break
+  # Walk the block once, only copying out the keys and values themselves.
+  while not proptext.startswith('PROPS-END', index):
+    if proptext.startswith('K ', index):
+      start, end = _FindPropsField(proptext, index)
+      name = proptext[start:end]
+      if not proptext.startswith('V ', end + 1):
+        raise PropsParseError('Expected "V ...", got %r'
+                              % _Excerpt(proptext, end + 1))
+      start, index = _FindPropsField(proptext, end + 1)
+      props[name] = proptext[start:index]
+      index += 1
+    elif proptext.startswith('D ', index):
+      start, index = _FindPropsField(proptext, index)
+      props[proptext[start:index]] = None
+      index += 1
     else:
-      raise PropsParseError('Unrecognised record in %r' % proptext[index:])
-    nlpos = proptext.find('\n', index)
-    if nlpos <= 0:
-      raise PropsParseError('Missing newline after name length in %r'
-                            % proptext[index:])
-    namelen = int(proptext[index+2:nlpos])
-    if proptext[nlpos+1+namelen] != '\n':
-      raise PropsParseError('Missing newline after name in %r'
-                            % proptext[index:])
-    name = proptext[nlpos+1:nlpos+1+namelen]
-    index = nlpos+2+namelen
-    if wantval:
-      if proptext[index:index+2] != 'V ':
-        raise PropsParseError('Expected "V ...", got %r' % proptext[index:])
-      nlpos = proptext.find('\n', index)
-      if nlpos <= 0:
-        raise PropsParseError('Missing newline after value length in %r'
-                              % proptext[index:])
-      proplen = int(proptext[index+2:nlpos])
-      if proptext[nlpos+1+proplen] != '\n':
-        raise PropsParseError('Missing newline after value in %r'
-                              % proptext[index:])
-      prop = proptext[nlpos+1:nlpos+1+proplen]
-      index = nlpos+2+proplen
-    else:
-      prop = None
-    props[name] = prop
+      raise PropsParseError('Unrecognised record in %r'
+                            % _Excerpt(proptext, index))
   if len(proptext) != index + 10:
     raise PropsParseError('Trailing characters after PROPS-END: %s'
-                          % proptext[index:])
+                          % _Excerpt(proptext, index))
+  props.modified = False
   return props
 
 
-def MakeRecordsFromPath(srcrepo, srcrev, srcpath, dstpath, record_source):
+def _PropsContainKey(proptext, key):
+  """Check whether a properties block sets or deletes a property.
+
+  Args:
+    proptext: a string containing the properties block of a Record
+    key: the name of the property
+
+  Returns:
+    True if proptext has a K or D record for key
+
+  Raises:
+    PropsParseError: if parsing fails
+
+  Only the K and D records are compared with key. Values are skipped over
+  using their lengths without being copied.
+  """
+  index = 0
+  while not proptext.startswith('PROPS-END', index):
+    wantval = proptext.startswith('K ', index)
+    if not wantval and not proptext.startswith('D ', index):
+      raise PropsParseError('Unrecognised record in %r'
+                            % _Excerpt(proptext, index))
+    start, end = _FindPropsField(proptext, index)
+    if end - start == len(key) and proptext.startswith(key, start):
+      return True
+    index = end + 1
+    if wantval:
+      if not proptext.startswith('V ', index):
+        raise PropsParseError('Expected "V ...", got %r'
+                              % _Excerpt(proptext, index))
+      index = _FindPropsField(proptext, index)[1] + 1
+  return False
+
+
+def _FindPropsField(proptext, index):
+  """Locate the content of one length-prefixed K, V, or D record.
+
+  Args:
+    proptext: a string containing the properties block of a Record
+    index: the position in proptext of the line giving the content's length
+
+  Returns:
+    the start and end positions of the content in proptext (the content is
+    followed by a newline at the end position)
+
+  Raises:
+    PropsParseError: if parsing fails
+    IndexError: if proptext ends in the middle of the content
+  """
+  nlpos = proptext.find('\n', index)
+  if nlpos < 0:
+    raise PropsParseError('Missing newline after length in %r'
+                          % _Excerpt(proptext, index))
+  end = nlpos + 1 + int(proptext[index+2:nlpos])
+  if proptext[end] != '\n':
+    raise PropsParseError('Missing newline after content in %r'
+                          % _Excerpt(proptext, index))
+  return nlpos + 1, end
+
+
+def _Excerpt(proptext, index):
+  """Return a bounded piece of proptext for use in error messages."""
+  return proptext[index:index+80]
+
+
+# Number of revision roots kept open by RevisionRoot
+REVISION_ROOT_CACHE_SIZE = 64
+# {repository path: (repository, filesystem)} for every repository opened
+_REPOSITORIES = {}
+# {(repository path, revision): root} ordered from least to most recently used
+_REVISION_ROOTS = collections.OrderedDict()
+
+
+def OpenRepository(repo):
+  """Return the filesystem of a repository, opening it only once.
+
+  Args:
+    repo: path to the repository
+
+  Returns:
+    an svn_fs_t for the repository, which stays open for the life of the
+    process (or until CloseRepositories is called)
+  """
+  try:
+    return _REPOSITORIES[repo][1]
+  except KeyError:
+    repo_ptr = svn_repos.open(svn_core.svn_path_canonicalize(repo))
+    # Keep the repository alive as long as its filesystem is in use
+    _REPOSITORIES[repo] = (repo_ptr, svn_repos.fs(repo_ptr))
+    return _REPOSITORIES[repo][1]
+
+
+def RevisionRoot(repo, rev):
+  """Return the root of a revision of a repository.
+
+  Args:
+    repo: path to the repository
+    rev: revision number
+
+  Returns:
+    an svn_fs_root_t for the revision
+
+  Every caller shares the same open repositories (see OpenRepository), and
+  the REVISION_ROOT_CACHE_SIZE most recently used roots are kept open so that
+  repeated lookups in the same revisions do not reopen them.
+  """
+  key = (repo, rev)
+  try:
+    root = _REVISION_ROOTS.pop(key)
+  except KeyError:
+    root = svn_fs.revision_root(OpenRepository(repo), rev)
+    while len(_REVISION_ROOTS) >= REVISION_ROOT_CACHE_SIZE:
+      _REVISION_ROOTS.popitem(last=False)
+  _REVISION_ROOTS[key] = root
+  return root
+
+
+def CloseRepositories():
+  """Forget all repositories and roots opened by RevisionRoot."""
+  _REVISION_ROOTS.clear()
+  _REPOSITORIES.clear()
+
+
+def MakeRecordsFromPath(srcrepo, srcrev, srcpath, dstpath, record_source,
+                        prune=None):
+  """Like IterRecordsFromPath, but returns a list of Records."""
+  return list(IterRecordsFromPath(srcrepo, srcrev, srcpath, dstpath,
+                                  record_source, prune))
+
+
+def IterRecordsFromPath(srcrepo, srcrev, srcpath, dstpath, record_source,
+                        prune=None):
   """Generate Records adding the contents of a given repo/rev/path.
 
   Args:
@@ -382,12 +1414,14 @@ def MakeRecordsFromPath(srcrepo, srcrev, srcpath, dstpath, record_source):
     srcpath: path within the source repository
     dstpath: destination path in the repository being filtered
     record_source: the source attribute of the Records generated
+    prune: an optional callable that is passed the destination path of each
+           node. Nodes for which it returns True are skipped, along with
+           everything below them.
 
-  Returns:
-    a list of Records
-
-  Raises:
-    RuntimeError: if svnrdump seems to have failed
+  Yields:
+    Records, one at a time. The text content of files is not read from the
+    repository until it is needed (usually when the Record is written), and
+    then it is read in chunks.
 
   This is the fundamental feature of a working svndumpfilter replacement. In the
   upstream svndumpfilter, copyfrom operations that reference paths that are
@@ -421,12 +1455,9 @@ def MakeRecordsFromPath(srcrepo, srcrev, srcpath, dstpath, record_source):
   the filesystem when the revision is changed, rather than deleting and reading
   it every time (see externals.FromRev, externals.Diff, Diff).
   """
-  srcrepo = svn_core.svn_path_canonicalize(srcrepo)
-  repo_ptr = svn_repos.open(srcrepo)
-  fs = svn_repos.fs(repo_ptr)
-  root = svn_fs.revision_root(fs, srcrev)
-  output = []
-  # Perform a depth-first search
+  root = RevisionRoot(srcrepo, srcrev)
+  # Perform a depth-first search, visiting siblings in sorted order like
+  # svn_util.WalkTree so that IterRecordsFromNodes yields the same Records
   stack = [srcpath]
   while stack:
     path = stack.pop()
@@ -435,41 +1466,98 @@ def MakeRecordsFromPath(srcrepo, srcrev, srcpath, dstpath, record_source):
       node_path = dstpath + relative_path
     else:
       node_path = (dstpath + '/' + path) if path else dstpath
-    if svn_fs.is_dir(root, path):
-      record = Record(action='add', kind='dir', path=node_path,
-                      source=record_source)
+    if prune is not None and prune(node_path):
+      continue
+    is_dir = svn_fs.is_dir(root, path)
+    if is_dir:
       # Add children to the stack
       prefix = (path + '/') if path else ''
-      for name in svn_fs.dir_entries(root, path).keys():
+      for name in sorted(svn_fs.dir_entries(root, path), reverse=True):
         stack.append(prefix + name)
-    else:
-      record = Record(action='add', kind='file', path=node_path,
-                      source=record_source)
-      # Fetch file content
-      stream = svn_fs.file_contents(root, path)
-      record.text = _ReadSVNStream(stream)
-      checksum = svn_fs.file_md5_checksum(root, path)
-      record.headers['Text-content-md5'] = checksum.encode('hex_codec')
-    # Fetch properties
-    props = svn_fs.node_proplist(root, path)
-    record.props = {key: str(value) for key, value in props.iteritems()}
-    output.append(record)
-  return output
+    yield _MakeNodeRecord(root, path, is_dir, node_path, record_source)
 
 
-def _ReadSVNStream(stream):
-  """Read an entire SVN stream into a string.
+def IterRecordsFromNodes(srcrepo, srcrev, srcpath, dstpath, record_source,
+                         nodes, prune=None):
+  """Generate the Records of IterRecordsFromPath from svn_util.ListNodes.
 
   Args:
-    stream: an SVN stream
+    srcrepo: path to the source repository
+    srcrev: revision number
+    srcpath: path within the source repository
+    dstpath: destination path in the repository being filtered
+    record_source: the source attribute of the Records generated
+    nodes: the list returned by svn_util.ListNodes(srcrepo, srcrev, srcpath)
+    prune: an optional callable, as for IterRecordsFromPath
+
+  Yields:
+    Records, one at a time. Only the text content of files is read from the
+    repository, when it is needed.
+  """
+  root = RevisionRoot(srcrepo, srcrev)
+  pruned = set()
+  for path, kind, props, md5 in nodes:
+    node_path = (dstpath + '/' + path) if path else dstpath
+    if path and path.rpartition('/')[0] in pruned:
+      pruned.add(path)
+      continue
+    if prune is not None and prune(node_path):
+      pruned.add(path)
+      continue
+    record = Record(action='add', kind=kind, path=node_path,
+                    source=record_source)
+    if kind == 'file':
+      if srcpath and path:
+        full_path = srcpath + '/' + path
+      else:
+        full_path = srcpath or path
+      record.text = _SVNFileText(root, full_path)
+      record.headers['Text-content-md5'] = md5
+    record.props = dict(props)
+    yield record
+
+
+def MakeRecordFromNode(srcrepo, srcrev, srcpath, dstpath, record_source,
+                       action='add', text=True, props=True):
+  """Make a Record for a single node of a given repo/rev/path.
+
+  Args:
+    srcrepo: path to the source repository
+    srcrev: revision number
+    srcpath: path of the node within the source repository
+    dstpath: destination path in the repository being filtered
+    record_source: the source attribute of the Record
+    action: the Node-action of the Record ('add' or 'change')
+    text: whether to include the text content if the node is a file
+    props: whether to include the properties of the node
 
   Returns:
-    str containing entire stream
+    a Record. As with IterRecordsFromPath, the text content is not read from
+    the repository until it is needed.
+
+  Unlike IterRecordsFromPath, the children of a directory are not included.
+  This is used to apply the changes found by svn_util.Diff one path at a time,
+  fetching only the parts of each node that changed.
   """
-  out = ''
-  while True:
-    data = svn_core.svn_stream_read(stream, 16384)
-    if not data:
-      break
-    out += data
-  return out
+  root = RevisionRoot(srcrepo, srcrev)
+  return _MakeNodeRecord(root, srcpath, svn_fs.is_dir(root, srcpath), dstpath,
+                         record_source, action, text, props)
+
+
+def _MakeNodeRecord(root, path, is_dir, node_path, record_source,
+                    action='add', text=True, props=True):
+  """Make a Record for the node at path in root (see MakeRecordFromNode)."""
+  if is_dir:
+    record = Record(action=action, kind='dir', path=node_path,
+                    source=record_source)
+  else:
+    record = Record(action=action, kind='file', path=node_path,
+                    source=record_source)
+    if text:
+      record.text = _SVNFileText(root, path)
+      checksum = svn_fs.file_md5_checksum(root, path)
+      record.headers['Text-content-md5'] = checksum.encode('hex_codec')
+  if props:
+    proplist = svn_fs.node_proplist(root, path)
+    record.props = {key: str(value) for key, value in proplist.iteritems()}
+  return record
@@ -0,0 +1,114 @@
+#!/usr/bin/python2.7
+
+# Copyright 2013 Google Inc. All Rights Reserved.
+#
+# Use of this source code is governed by a MIT-style
+# license that can be found in the LICENSE file or at
+# http://opensource.org/licenses/MIT
+
+"""Benchmarks for svndump.
+
+Run with: python -m svndumpmultitool.svndump_benchmark
+"""
+
+from __future__ import absolute_import
+
+import collections
+import io
+import sys
+import tempfile
+import timeit
+
+from svndumpmultitool import svndump
+
+
+def _MakeRecord(props):
+  record = svndump.Record()
+  record.props = collections.OrderedDict(props)
+  return record
+
+
+def _ManyKeys(count):
+  return [('key%d' % i, 'value%d' % i) for i in xrange(count)]
+
+
+def _LargeValue(size):
+  # Resembles svn:mergeinfo on a merge-heavy branch
+  line = '/branches/some-feature-branch:1000-2000,2002,2004-2010\n'
+  return [('svn:mergeinfo', line * (size // len(line)))]
+
+
+# Name -> properties used for each benchmark
+CASES = collections.OrderedDict([
+    ('10 keys', _ManyKeys(10)),
+    ('1000 keys', _ManyKeys(1000)),
+    ('10000 keys', _ManyKeys(10000)),
+    ('1 MB value', _LargeValue(1 << 20)),
+    ('16 MB value', _LargeValue(16 << 20)),
+    ])
+
+
+def _Time(func, repeat=3, number=5):
+  """Return the best time in seconds of number calls to func."""
+  return min(timeit.repeat(func, repeat=repeat, number=number)) / number
+
+
+def BenchmarkProps(stream):
+  """Time generating and parsing each property block in CASES."""
+  stream.write('%-12s %14s %14s\n' % ('props', 'generate (ms)', 'parse (ms)'))
+  for name, props in CASES.iteritems():
+    record = _MakeRecord(props)
+    proptext = record._GeneratePropText()
+    generate = _Time(record._GeneratePropText)
+    parse = _Time(lambda: svndump._ParseProps(proptext))
+    stream.write('%-12s %14.3f %14.3f\n' % (name, generate * 1000,
+                                             parse * 1000))
+
+
+def _MakeRecords(count, text_size):
+  """Read count file adds, like a revision importing many small files."""
+  record = svndump.Record(action='add', kind='file')
+  record.text = 'x' * text_size
+  record.SetProperty('svn:eol-style', 'native')
+  dump = io.BytesIO()
+  for i in xrange(count):
+    record.headers['Node-path'] = 'trunk/file%d' % i
+    record.Write(dump, None)
+  scanner = svndump.RecordScanner(io.BytesIO(dump.getvalue()))
+  return list(iter(scanner.ReadRecord, None))
+
+
+def _WriteEach(records, stream):
+  for record in records:
+    record.Write(stream, None)
+
+
+def _WriteBatched(records, stream):
+  writer = svndump.RecordWriter(stream)
+  for record in records:
+    writer.Write(record, None)
+  writer.Flush()
+
+
+def BenchmarkWrite(stream):
+  """Time writing 100,000 small Records with Record.Write and RecordWriter."""
+  records = _MakeRecords(100000, 100)
+  stream.write('%-12s %14s\n' % ('writer', 'MB/s'))
+  # Unbuffered, so every write is a system call
+  with tempfile.TemporaryFile(bufsize=0) as output:
+    size = sum(len(block) for record in records
+               for block in record._Blocks(None))
+    for name, write in (('Record.Write', _WriteEach),
+                        ('RecordWriter', _WriteBatched)):
+      seconds = _Time(lambda: write(records, output) or output.seek(0),
+                      number=1)
+      stream.write('%-12s %14.1f\n' % (name, size / seconds / (1 << 20)))
+
+
+def main():
+  BenchmarkProps(sys.stdout)
+  BenchmarkWrite(sys.stdout)
+
+
+if __name__ == '__main__':
+  main()
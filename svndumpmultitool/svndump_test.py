@@ -10,18 +10,32 @@ from __future__ import absolute_import
 
 import collections
 import io
+import os
 import StringIO
+import tempfile
+import threading
 import unittest
 
 import mock
 
 from svndumpmultitool import svndump
+from svndumpmultitool import test_utils
 
 # Static data
 MAIN_REPO = '/svn/zoo'
 MAIN_REPO_REV = 5
 
 
+class _PipeStream(io.BytesIO):
+  """A stream that can't seek, like stdin when it is a pipe."""
+
+  def tell(self):
+    raise IOError('Illegal seek')
+
+  def seek(self, *unused_args):
+    raise IOError('Illegal seek')
+
+
 class RecordConstructorTest(unittest.TestCase):
   def testSimple(self):
     record = svndump.Record()
@@ -51,6 +65,11 @@ class RecordConstructorTest(unittest.TestCase):
     self.assertIsNone(record.props)
     self.assertIsNone(record.text)
 
+  def testSlots(self):
+    record = svndump.Record()
+    with self.assertRaises(AttributeError):
+      record.foo = 'bar'
+
   def testSource(self):
     record = svndump.Record(source=svndump.Record.COPY)
     self.assertFalse(record.headers)
@@ -59,6 +78,100 @@ class RecordConstructorTest(unittest.TestCase):
     self.assertIs(record.source, record.COPY)
 
 
+class RecordDirtyTest(unittest.TestCase):
+  def setUp(self):
+    self.record = svndump.ReadRecord(StringIO.StringIO(
+        'Node-path: foo\n'
+        'Text-content-length: 3\n'
+        'Prop-content-length: 26\n\n'
+        'K 3\nfoo\nV 3\nbar\nPROPS-END\n'
+        'foo\n'))
+
+  def testNew(self):
+    self.assertTrue(svndump.Record().dirty)
+
+  def testRead(self):
+    self.assertFalse(self.record.dirty)
+    # Loading deferred text is not a modification
+    self.assertEquals(self.record.text, 'foo')
+    self.assertFalse(self.record.dirty)
+
+  def testHeaderChanged(self):
+    self.record.headers['Node-action'] = 'change'
+    self.assertTrue(self.record.dirty)
+
+  def testHeaderDeleted(self):
+    self.record.DeleteHeader('Node-path')
+    self.assertTrue(self.record.dirty)
+
+  def testPropertyChanged(self):
+    self.record.SetProperty('foo', 'baz')
+    self.assertTrue(self.record.dirty)
+
+  def testPropsReplaced(self):
+    self.record.props = None
+    self.assertTrue(self.record.dirty)
+
+  def testTextReplaced(self):
+    self.record.text = 'bar'
+    self.assertTrue(self.record.dirty)
+
+
+class HeadersTest(unittest.TestCase):
+  def setUp(self):
+    self.headers = svndump._Headers()
+    self.headers['Node-path'] = 'foo'
+    self.headers['Node-kind'] = 'file'
+    self.headers['Rare-header'] = 'bar'
+
+  def testOrder(self):
+    self.headers['Node-kind'] = 'dir'
+    self.assertEqual(self.headers.items(), [('Node-path', 'foo'),
+                                            ('Node-kind', 'dir'),
+                                            ('Rare-header', 'bar')])
+    del self.headers['Node-path']
+    self.headers['Node-path'] = 'baz'
+    self.assertEqual(self.headers.keys(), ['Node-kind', 'Rare-header',
+                                           'Node-path'])
+
+  def testMissing(self):
+    with self.assertRaises(KeyError):
+      _ = self.headers['Node-action']
+    with self.assertRaises(KeyError):
+      del self.headers['Node-action']
+    self.assertNotIn('Node-action', self.headers)
+    self.assertIsNone(self.headers.get('Node-action'))
+    self.assertEqual(self.headers.pop('Node-action', 'x'), 'x')
+
+  def testPop(self):
+    self.assertEqual(self.headers.pop('Node-kind'), 'file')
+    self.assertEqual(self.headers.keys(), ['Node-path', 'Rare-header'])
+
+  def testEquality(self):
+    other = svndump._Headers()
+    other['Node-path'] = 'foo'
+    other['Node-kind'] = 'file'
+    self.assertNotEqual(self.headers, other)
+    other['Rare-header'] = 'bar'
+    self.assertEqual(self.headers, other)
+    self.assertEqual(self.headers, {'Node-path': 'foo', 'Node-kind': 'file',
+                                    'Rare-header': 'bar'})
+
+  def testLayoutIsShared(self):
+    other = svndump._Headers()
+    other['Node-path'] = 'bar'
+    other['Node-kind'] = 'dir'
+    other['Rare-header'] = 'baz'
+    self.assertIs(self.headers._keys, other._keys)
+
+  def testModified(self):
+    self.headers.modified = False
+    _ = self.headers.get('Node-path')
+    self.assertFalse(self.headers.modified)
+    self.headers['Node-path'] = 'bar'
+    self.assertTrue(self.headers.modified)
+
+
 class RecordDeleteHeaderTest(unittest.TestCase):
   def testExists(self):
     record = svndump.Record()
@@ -112,6 +225,75 @@ class ParsePropsTest(unittest.TestCase):
     with self.assertRaises(svndump.PropsParseError):
       svndump._ParseProps('Z 3\nPROPS-END\n')
 
+  def testMissingValue(self):
+    with self.assertRaises(svndump.PropsParseError):
+      svndump._ParseProps('K 3\nfoo\nK 3\nbar\nPROPS-END\n')
+
+  def testTrailingCharacters(self):
+    with self.assertRaises(svndump.PropsParseError):
+      svndump._ParseProps('PROPS-END\nfoo')
+
+  def testErrorMessageIsBounded(self):
+    with self.assertRaises(svndump.PropsParseError) as cm:
+      svndump._ParseProps('Z' * 100000)
+    self.assertLess(len(str(cm.exception)), 200)
+
+  def testRoundTrip(self):
+    record = svndump.Record()
+    for i in range(500):
+      record.SetProperty('key%d' % i, 'value\n' * i)
+    record.SetProperty('svn:mergeinfo', 'x' * 1000000)
+    record.SetProperty('deleted', None)
+    self.assertEquals(svndump._ParseProps(record._GeneratePropText()),
+                      record.props)
+
+
+class PropsContainKeyTest(unittest.TestCase):
+  PROPTEXT = ('K 3\nfoo\nV 13\nsvn:externals\n'
+              'D 3\nbar\n'
+              'K 12\nlong\nkey\nbaz\nV 0\n\n'
+              'PROPS-END\n')
+
+  def testKey(self):
+    self.assertTrue(svndump._PropsContainKey(self.PROPTEXT, 'foo'))
+    self.assertTrue(svndump._PropsContainKey(self.PROPTEXT, 'long\nkey\nbaz'))
+
+  def testDelete(self):
+    self.assertTrue(svndump._PropsContainKey(self.PROPTEXT, 'bar'))
+
+  def testValueIsNotAKey(self):
+    self.assertFalse(svndump._PropsContainKey(self.PROPTEXT, 'svn:externals'))
+
+  def testPrefixIsNotAKey(self):
+    self.assertFalse(svndump._PropsContainKey(self.PROPTEXT, 'fo'))
+    self.assertFalse(svndump._PropsContainKey(self.PROPTEXT, 'long'))
+
+  def testEmpty(self):
+    self.assertFalse(svndump._PropsContainKey('PROPS-END\n', 'foo'))
+
+  def testUnknownFormat(self):
+    with self.assertRaises(svndump.PropsParseError):
+      svndump._PropsContainKey('Z 3\nPROPS-END\n', 'foo')
+
+
+class RecordHasPropertyTest(unittest.TestCase):
+  def testNoProps(self):
+    self.assertFalse(svndump.Record().HasProperty('foo'))
+
+  def testParsed(self):
+    record = svndump.Record()
+    record.SetProperty('foo', 'bar')
+    self.assertTrue(record.HasProperty('foo'))
+    self.assertFalse(record.HasProperty('bar'))
+
+  def testUnparsed(self):
+    record = svndump.ReadRecord(StringIO.StringIO(
+        'Prop-content-length: 26\n\n'
+        'K 3\nfoo\nV 3\nbar\nPROPS-END\n'))
+    self.assertTrue(record.HasProperty('foo'))
+    self.assertFalse(record.HasProperty('bar'))
+    self.assertIsNone(record._props)
+
 
 class RecordSetPropertyTest(unittest.TestCase):
   def setUp(self):
@@ -209,6 +391,13 @@ class RecordFixHeadersTest(unittest.TestCase):
     self.assertEquals(record.headers['Text-content-md5'],
                       'acbd18db4cc2f85cedef654fccc4a4d8')
 
+  def testSetTextContentSHA1(self):
+    record = svndump.Record()
+    record.text = 'foo'
+    record._FixHeaders('', None)
+    self.assertEquals(record.headers['Text-content-sha1'],
+                      '0beec7b5ea3f0fdbc95d0dd47f3c5bc275da8a33')
+
   def testLeaveTextDeltaAlone(self):
     record = svndump.Record()
     record.headers['Text-delta'] = 'true'
@@ -315,6 +504,16 @@ class ReadRecordTest(unittest.TestCase):
     self.assertEquals(result.props['foo'], 'bar')
     self.assertIsNone(result.text)
 
+  def testPropsAreParsedLazily(self):
+    stream = StringIO.StringIO('Prop-content-length: 26\n\n'
+                               'K 3\nfoo\nV 3\nbar\nPROPS-END\n')
+    result = svndump.ReadRecord(stream)
+    self.assertIsNone(result._props)
+    self.assertEquals(result._GeneratePropText(),
+                      'K 3\nfoo\nV 3\nbar\nPROPS-END\n')
+    self.assertIsNone(result._props)
+    self.assertEquals(result.props, {'foo': 'bar'})
+
   def testText(self):
     text = 'Some text\nSome more text'
     stream = StringIO.StringIO('Text-content-length: %s\n\n%s'
@@ -332,6 +531,246 @@ class ReadRecordTest(unittest.TestCase):
     self.assertEquals(result.text, 'foo')
     self.assertEquals(result.props['foo'], 'bar')
 
+  def testTextIsDeferred(self):
+    stream = StringIO.StringIO('Text-content-length: 3\n\nfoo\n\n'
+                               'bar: baz\n\n')
+    result = svndump.ReadRecord(stream)
+    # The text is skipped over and the next Record can be read right away
+    self.assertIsInstance(result._text, svndump._StreamSlice)
+    self.assertEquals(svndump.ReadRecord(stream).headers['bar'], 'baz')
+    position = stream.tell()
+    self.assertEquals(result.text, 'foo')
+    self.assertEquals(stream.tell(), position)
+
+  def testPipe(self):
+    stream = _PipeStream('Text-content-length: 3\n\nfoo\n\n')
+    result = svndump.ReadRecord(stream, discard_text=lambda _: False)
+    self.assertEquals(result._text, 'foo')
+
+  def testPipeDiscardText(self):
+    stream = _PipeStream('Text-content-length: 3\n\nfoo\n\n'
+                         'bar: baz\n\n')
+    result = svndump.ReadRecord(stream, discard_text=lambda _: True)
+    self.assertEquals(svndump.ReadRecord(stream).headers['bar'], 'baz')
+    with self.assertRaises(svndump.TextUnavailableError):
+      _ = result.text
+
+
+class RecordScannerTest(unittest.TestCase):
+  DUMP = ('\n'
+          'SVN-fs-dump-format-version: 2\n\n'
+          'Node-path: foo\n'
+          'Text-content-length: 10\n'
+          'Text-content-md5: d792dcc30c376fa81e7d572a35164418\n'
+          'Prop-content-length: 26\n'
+          'Content-length: 36\n\n'
+          'K 3\nfoo\nV 3\nbar\nPROPS-END\n'
+          'some\n\ntext\n\n'
+          'Node-path: bar\n\n')
+
+  def ReadAll(self, scanner, discard_text=None):
+    records = []
+    while True:
+      record = scanner.ReadRecord(discard_text=discard_text)
+      if record is None:
+        return records
+      records.append(record)
+
+  def CheckRecords(self, records):
+    self.assertEquals(len(records), 3)
+    version, foo, bar = records
+    self.assertEquals(dict(version.headers),
+                      {'SVN-fs-dump-format-version': '2'})
+    self.assertEquals(foo.headers.keys(), ['Node-path', 'Text-content-length',
+                                           'Text-content-md5',
+                                           'Prop-content-length',
+                                           'Content-length'])
+    self.assertEquals(foo.props, {'foo': 'bar'})
+    self.assertEquals(foo.text, 'some\n\ntext')
+    self.assertEquals(dict(bar.headers), {'Node-path': 'bar'})
+    self.assertIsNone(bar.props)
+    self.assertIsNone(bar.text)
+
+  def testSimple(self):
+    scanner = svndump.RecordScanner(_PipeStream(self.DUMP))
+    self.CheckRecords(self.ReadAll(scanner))
+
+  def testSmallBlocks(self):
+    # Headers, properties, and text all span multiple reads
+    for block_size in range(1, 10):
+      scanner = svndump.RecordScanner(_PipeStream(self.DUMP),
+                                      block_size=block_size)
+      self.CheckRecords(self.ReadAll(scanner))
+
+  def testNoReadInto(self):
+    scanner = svndump.RecordScanner(StringIO.StringIO(self.DUMP), block_size=4)
+    self.CheckRecords(self.ReadAll(scanner))
+
+  def testDiscardText(self):
+    scanner = svndump.RecordScanner(_PipeStream(self.DUMP), block_size=4)
+    records = self.ReadAll(scanner, discard_text=lambda _: True)
+    self.assertEquals(len(records), 3)
+    with self.assertRaises(svndump.TextUnavailableError):
+      _ = records[1].text
+    self.assertEquals(dict(records[2].headers), {'Node-path': 'bar'})
+
+  def testVerbatim(self):
+    scanner = svndump.RecordScanner(_PipeStream(self.DUMP))
+    output = StringIO.StringIO()
+    for record in self.ReadAll(scanner):
+      self.assertFalse(record.dirty)
+      record.Write(output, None)
+    self.assertEquals(output.getvalue(), self.DUMP.lstrip('\n'))
+
+  def testSpool(self):
+    scanner = svndump.RecordScanner(_PipeStream(self.DUMP), block_size=4,
+                                    spool_threshold=4)
+    records = self.ReadAll(scanner)
+    self.assertIsInstance(records[1]._text, svndump._StreamSlice)
+    self.CheckRecords(records)
+
+  def testEOF(self):
+    scanner = svndump.RecordScanner(_PipeStream('\n\n'))
+    self.assertIsNone(scanner.ReadRecord())
+
+  def testTruncated(self):
+    scanner = svndump.RecordScanner(_PipeStream('foo: bar\n'))
+    with self.assertRaises(EOFError):
+      scanner.ReadRecord()
+
+  def testInvalid(self):
+    scanner = svndump.RecordScanner(_PipeStream('foobar\n\n'))
+    with self.assertRaises(ValueError):
+      scanner.ReadRecord()
+
+
+class TextSpillTest(unittest.TestCase):
+  def testUnderBudget(self):
+    spill = svndump.TextSpill(10)
+    record = svndump.Record()
+    record.text = 'foo'
+    spill.Add(record)
+    self.assertEquals(record._text, 'foo')
+
+  def testOverBudget(self):
+    spill = svndump.TextSpill(5)
+    source = StringIO.StringIO('Text-content-length: 3\n'
+                               'Text-content-md5: acbd18db4cc2f85cedef654fccc4a4d8\n'
+                               'Content-length: 3\n\n'
+                               'foo\n\n')
+    records = [svndump.RecordScanner(source).ReadRecord(), svndump.Record()]
+    records[1].text = 'barbaz'
+    for record in records:
+      spill.Add(record)
+    for record in records:
+      self.assertIsInstance(record._text, svndump._StreamSlice)
+    # Spilling is not a modification
+    self.assertFalse(records[0].dirty)
+    output = StringIO.StringIO()
+    records[0].Write(output, None)
+    self.assertEquals(output.getvalue(), source.getvalue())
+    self.assertEquals(records[1].text, 'barbaz')
+
+  def testNoBudget(self):
+    spill = svndump.TextSpill()
+    record = svndump.Record()
+    record.text = 'foo' * 1000
+    spill.Add(record)
+    self.assertIsInstance(record._text, str)
+
+
+class RecordLoadRepositoryTextTest(unittest.TestCase):
+
+  @mock.patch.object(svndump, 'svn_core')
+  @mock.patch.object(svndump, 'svn_fs')
+  def testLoadsRepositoryText(self, fs, core):
+    fs.file_length.return_value = 3
+    fs.file_contents.return_value = io.BytesIO('foo')
+    core.svn_stream_read = lambda stream, size: stream.read(size)
+    record = svndump.Record()
+    record.text = svndump._SVNFileText('root', 'file')
+    record.LoadRepositoryText()
+    self.assertEqual(fs.file_contents.call_count, 1)
+    fs.file_contents.reset_mock()
+    self.assertEqual(record.text, 'foo')
+    self.assertFalse(fs.file_contents.called)
+
+  def testKeepsOtherText(self):
+    record = svndump.Record()
+    text = svndump._StreamSlice(io.BytesIO('foo'), 0, 3)
+    record.text = text
+    record.LoadRepositoryText()
+    self.assertIs(record._text, text)
+
+
+class SpoolTextTest(unittest.TestCase):
+  def testSmall(self):
+    self.assertEquals(svndump.SpoolText(['foo', 'bar'], threshold=6), 'foobar')
+
+  def testLarge(self):
+    chunks = iter(['foo', 'bar', 'baz'])
+    text = svndump.SpoolText(chunks, threshold=5)
+    self.assertEquals(len(text), 9)
+    self.assertEquals(text.Read(), 'foobarbaz')
+    self.assertEquals(list(chunks), [])
+
+
+class MakeRecordReaderTest(unittest.TestCase):
+  def testSeekable(self):
+    read_record = svndump.MakeRecordReader(
+        StringIO.StringIO('Text-content-length: 3\n\nfoo\n\n'))
+    self.assertIsInstance(read_record()._text, svndump._StreamSlice)
+    self.assertIsNone(read_record())
+
+  def testPipe(self):
+    read_record = svndump.MakeRecordReader(
+        _PipeStream('Text-content-length: 3\n\nfoo\n\n'))
+    self.assertEquals(read_record(discard_text=lambda _: False)._text, 'foo')
+    self.assertIsNone(read_record())
+
+
+class MapFileTest(unittest.TestCase):
+  DUMP = ('Text-content-length: 3\n'
+          'Text-content-md5: foo-checksum\n'
+          'Content-length: 3\n\n'
+          'foo\n\n')
+
+  def setUp(self):
+    self.dump_file = tempfile.TemporaryFile()
+    self.dump_file.write(self.DUMP)
+    self.dump_file.flush()
+    self.mapping = svndump.MapFile(self.dump_file)
+
+  def tearDown(self):
+    self.mapping.close()
+    self.dump_file.close()
+
+  def testReadRecord(self):
+    record = svndump.ReadRecord(self.mapping)
+    self.assertIsInstance(record._text, svndump._MappedSlice)
+    self.assertIsNone(svndump.ReadRecord(self.mapping))
+    self.assertEquals(record.text, 'foo')
+
+  def testWriteToFile(self):
+    record = svndump.ReadRecord(self.mapping)
+    with tempfile.TemporaryFile() as output:
+      record.Write(output, None)
+      output.seek(0)
+      self.assertEquals(output.read(), self.DUMP)
+
+  def testWriteToStringIO(self):
+    record = svndump.ReadRecord(self.mapping)
+    output = StringIO.StringIO()
+    record.Write(output, None)
+    self.assertEquals(output.getvalue(), self.DUMP)
+
+  def testPipe(self):
+    read_fd, write_fd = os.pipe()
+    os.close(write_fd)
+    with os.fdopen(read_fd) as pipe:
+      with self.assertRaises(EnvironmentError):
+        svndump.MapFile(pipe)
+
 
 class RecordWriteTest(unittest.TestCase):
   def setUp(self):
@@ -349,9 +788,75 @@ class RecordWriteTest(unittest.TestCase):
     self.assertEquals(self.stream.getvalue(),
                       'Text-content-length: 3\n'
                       'Text-content-md5: acbd18db4cc2f85cedef654fccc4a4d8\n'
+                      'Text-content-sha1: '
+                      '0beec7b5ea3f0fdbc95d0dd47f3c5bc275da8a33\n'
                       'Content-length: 3\n\n'
                       'foo\n\n')
 
+  def testDeferredText(self):
+    source = StringIO.StringIO('Text-content-length: 3\n'
+                               'Text-content-md5: foo-checksum\n'
+                               'Content-length: 3\n\n'
+                               'foo\n\n')
+    record = svndump.ReadRecord(source)
+    record.Write(self.stream, None)
+    self.assertEquals(self.stream.getvalue(), source.getvalue())
+    self.assertIsInstance(record._text, svndump._StreamSlice)
+
+  def testFileText(self):
+    source = tempfile.TemporaryFile()
+    source.write('xxfoo')
+    source.seek(2)
+    self.record.text = source
+    self.assertTrue(self.record.HasText())
+    self.record.Write(self.stream, None)
+    self.assertEquals(self.stream.getvalue(),
+                      'Text-content-length: 3\n'
+                      'Text-content-md5: acbd18db4cc2f85cedef654fccc4a4d8\n'
+                      'Text-content-sha1: '
+                      '0beec7b5ea3f0fdbc95d0dd47f3c5bc275da8a33\n'
+                      'Content-length: 3\n\n'
+                      'foo\n\n')
+
+  def testCopyTextFrom(self):
+    source = svndump.ReadRecord(StringIO.StringIO('Text-content-length: 3\n\n'
+                                                  'foo\n\n'))
+    self.record.CopyTextFrom(source)
+    self.assertIsInstance(self.record._text, svndump._StreamSlice)
+    self.assertEquals(self.record.text, 'foo')
+
+  def testUnmodifiedIsVerbatim(self):
+    # 'K 03' is valid, but would be written as 'K 3' if it were regenerated
+    source = StringIO.StringIO('Node-path: foo\n'
+                               'Prop-content-length: 27\n'
+                               'Content-length: 27\n\n'
+                               'K 03\nbar\nV 3\nbaz\nPROPS-END\n\n')
+    record = svndump.ReadRecord(source)
+    self.assertFalse(record.dirty)
+    record.Write(self.stream, None)
+    self.assertEquals(self.stream.getvalue(), source.getvalue())
+
+  def testModifiedIsRegenerated(self):
+    source = StringIO.StringIO('Node-path: foo\n'
+                               'Prop-content-length: 27\n'
+                               'Content-length: 27\n\n'
+                               'K 03\nbar\nV 3\nbaz\nPROPS-END\n\n')
+    record = svndump.ReadRecord(source)
+    record.DeleteProperty('bar')
+    self.assertTrue(record.dirty)
+    record.Write(self.stream, None)
+    self.assertEquals(self.stream.getvalue(),
+                      'Node-path: foo\n'
+                      'Prop-content-length: 10\n'
+                      'Content-length: 10\n\n'
+                      'PROPS-END\n\n')
+
+  def testRenumberedIsRegenerated(self):
+    source = StringIO.StringIO('Revision-number: 10\n\n')
+    record = svndump.ReadRecord(source)
+    record.Write(self.stream, {10: 5})
+    self.assertEquals(self.stream.getvalue(), 'Revision-number: 5\n\n')
+
   def testProps(self):
     self.record.headers['foo'] = 'bar'
     self.record.SetProperty('bar', 'baz')
@@ -374,6 +879,107 @@ class RecordWriteTest(unittest.TestCase):
                       'K 3\nbar\nV 3\nbaz\nPROPS-END\n\n')
 
 
+class RecordWriterTest(unittest.TestCase):
+  DUMP = ('Node-path: foo\n'
+          'Text-content-length: 3\n'
+          'Text-content-md5: foo-checksum\n'
+          'Content-length: 3\n\n'
+          'foo\n\n'
+          'Node-path: bar\n'
+          'Prop-content-length: 26\n'
+          'Content-length: 26\n\n'
+          'K 3\nbar\nV 3\nbaz\nPROPS-END\n\n')
+
+  def WriteAll(self, source, output, buffer_size):
+    writer = svndump.RecordWriter(output, buffer_size)
+    read_record = svndump.MakeRecordReader(source)
+    record = read_record()
+    while record is not None:
+      writer.Write(record, None)
+      record = read_record()
+    writer.Flush()
+
+  def testBufferSizes(self):
+    for buffer_size in [0, 1, 8, 40, 1 << 20]:
+      output = StringIO.StringIO()
+      self.WriteAll(StringIO.StringIO(self.DUMP), output, buffer_size)
+      self.assertEquals(output.getvalue(), self.DUMP)
+
+  def testBatched(self):
+    output = mock.Mock()
+    writer = svndump.RecordWriter(output, 1 << 20)
+    record = svndump.Record(path='foo', action='add', kind='file')
+    record.text = 'foo'
+    writer.Write(record, None)
+    writer.Write(record, None)
+    self.assertFalse(output.write.called)
+    writer.Flush()
+    self.assertEquals(output.write.call_count, 1)
+
+  def testDeferredText(self):
+    # Text read from a seekable stream is copied into the buffer in chunks
+    for buffer_size in [0, 8, 100]:
+      output = StringIO.StringIO()
+      self.WriteAll(StringIO.StringIO(self.DUMP + self.DUMP), output,
+                    buffer_size)
+      self.assertEquals(output.getvalue(), self.DUMP + self.DUMP)
+
+  @mock.patch.object(svndump, 'CHECKSUM_THREAD_THRESHOLD', 4)
+  def testChecksumThreads(self):
+    output = StringIO.StringIO()
+    writer = svndump.RecordWriter(output, 0, checksum_threads=2)
+    # No threads are started until they are needed
+    self.assertIsNone(writer._pool)
+    records = []
+    for i, text in enumerate(['small', 'large' * 100, 'small', 'x']):
+      record = svndump.Record(path='file%d' % i)
+      record.text = text
+      writer.Write(record, None)
+      records.append(record)
+    writer.Close()
+    expected = StringIO.StringIO()
+    for record in records:
+      self.assertIn('Text-content-sha1', record.headers)
+      record.Write(expected, None)
+    self.assertEquals(output.getvalue(), expected.getvalue())
+
+  @mock.patch.object(svndump, 'CHECKSUM_THREAD_THRESHOLD', 4)
+  @mock.patch.object(svndump, 'MAX_PENDING_TEXT', 10)
+  def testPendingTextIsBounded(self):
+    output = StringIO.StringIO()
+    writer = svndump.RecordWriter(output, 0, checksum_threads=1)
+    ready = threading.Event()
+    timer = threading.Timer(0.2, ready.set)
+    timer.start()
+    self.addCleanup(timer.cancel)
+    with mock.patch.object(svndump.Record, '_ComputeChecksums', autospec=True,
+                           side_effect=lambda record: ready.wait()):
+      for i in xrange(3):
+        record = svndump.Record(path='file%d' % i)
+        record.text = 'x' * 8
+        writer.Write(record, None)
+        # Waits for the checksums instead of holding 16 bytes
+        self.assertLessEqual(writer._pending_size, 10)
+      writer.Close()
+    self.assertEquals(output.getvalue().count('x' * 8), 3)
+
+  @mock.patch.object(svndump, 'CHECKSUM_THREAD_THRESHOLD', 0)
+  def testChecksumThreadError(self):
+    writer = svndump.RecordWriter(StringIO.StringIO(), checksum_threads=1)
+    record = svndump.Record(path='foo')
+    record.text = svndump._MappedSlice(None, 0, 3)
+    # Raised once the Record is written, which may be before Close
+    with self.assertRaises(TypeError):
+      writer.Write(record, None)
+      writer.Close()
+
+  def testWriteToFile(self):
+    with tempfile.TemporaryFile() as output:
+      self.WriteAll(StringIO.StringIO(self.DUMP), output, 64)
+      output.seek(0)
+      self.assertEquals(output.read(), self.DUMP)
+
+
 class RecordDoesNotAffectExternalsTest(unittest.TestCase):
   def testDelete(self):
     record = svndump.Record(action='delete')
@@ -416,9 +1022,67 @@ class RecordDoesNotAffectExternalsTest(unittest.TestCase):
     record.SetProperty('garbage', 'foo')
     self.assertEquals(record.DoesNotAffectExternals(), False)
 
+  def testUnparsedProps(self):
+    record = svndump.ReadRecord(StringIO.StringIO(
+        'Node-kind: dir\n'
+        'Node-action: change\n'
+        'Prop-delta: true\n'
+        'Prop-content-length: 26\n\n'
+        'K 3\nfoo\nV 3\nbar\nPROPS-END\n'))
+    self.assertEquals(record.DoesNotAffectExternals(), True)
+    self.assertIsNone(record._props)
+    record = svndump.ReadRecord(StringIO.StringIO(
+        'Node-kind: dir\n'
+        'Node-action: change\n'
+        'Prop-content-length: 36\n\n'
+        'K 13\nsvn:externals\nV 3\nbar\nPROPS-END\n'))
+    self.assertEquals(record.DoesNotAffectExternals(), False)
+    self.assertIsNone(record._props)
+
+
+class RevisionRootTest(unittest.TestCase):
+
+  def setUp(self):
+    svndump.CloseRepositories()
+
+  def tearDown(self):
+    svndump.CloseRepositories()
+
+  @mock.patch.object(svndump, 'svn_core')
+  @mock.patch.object(svndump, 'svn_repos')
+  @mock.patch.object(svndump, 'svn_fs')
+  def testRepositoryOpenedOnce(self, fs, repos, unused_core):
+    fs.revision_root.side_effect = lambda fs_ptr, rev: (fs_ptr, rev)
+    root1 = svndump.RevisionRoot(MAIN_REPO, 1)
+    root2 = svndump.RevisionRoot(MAIN_REPO, 2)
+    self.assertEquals(repos.open.call_count, 1)
+    self.assertEquals(root1, (repos.fs.return_value, 1))
+    self.assertEquals(root2, (repos.fs.return_value, 2))
+    self.assertIs(svndump.RevisionRoot(MAIN_REPO, 1), root1)
+    self.assertEquals(fs.revision_root.call_count, 2)
+
+  @mock.patch.object(svndump, 'REVISION_ROOT_CACHE_SIZE', 2)
+  @mock.patch.object(svndump, 'svn_core')
+  @mock.patch.object(svndump, 'svn_repos')
+  @mock.patch.object(svndump, 'svn_fs')
+  def testLeastRecentlyUsedIsEvicted(self, fs, unused_repos, unused_core):
+    fs.revision_root.side_effect = lambda fs_ptr, rev: rev
+    svndump.RevisionRoot(MAIN_REPO, 1)
+    svndump.RevisionRoot(MAIN_REPO, 2)
+    svndump.RevisionRoot(MAIN_REPO, 1)
+    svndump.RevisionRoot(MAIN_REPO, 3)  # Evicts 2
+    self.assertEquals(fs.revision_root.call_count, 3)
+    svndump.RevisionRoot(MAIN_REPO, 1)
+    self.assertEquals(fs.revision_root.call_count, 3)
+    svndump.RevisionRoot(MAIN_REPO, 2)
+    self.assertEquals(fs.revision_root.call_count, 4)
+
 
 class MakeRecordsFromPathTest(unittest.TestCase):
 
+  def setUp(self):
+    svndump.CloseRepositories()
+
   @mock.patch.object(svndump, 'svn_core')
   @mock.patch.object(svndump, 'svn_repos')
   @mock.patch.object(svndump, 'svn_fs')
@@ -445,6 +1109,7 @@ class MakeRecordsFromPathTest(unittest.TestCase):
         }
     fs.file_contents = lambda _, path: file_contents[path]
     core.svn_stream_read = lambda stream, size: stream.read(size)
+    fs.file_length = lambda _, path: len(file_contents[path].getvalue())
     file_md5_checksum = {
         'foo/file1': 'file1_checksum',
         'foo/file2': 'file2_checksum'
@@ -461,7 +1126,8 @@ class MakeRecordsFromPathTest(unittest.TestCase):
     results = svndump.MakeRecordsFromPath(
         MAIN_REPO, MAIN_REPO_REV, '', 'bar', svndump.Record.COPY)
     self.assertEquals(len(results), 5)
-    root, foo, subdir, file2, file1 = results
+    # Siblings are added in sorted order
+    root, foo, file1, file2, subdir = results
     self.assertEquals(dict(root.headers), {
         'Node-path': 'bar',
         'Node-kind': 'dir',
@@ -512,6 +1178,7 @@ class MakeRecordsFromPathTest(unittest.TestCase):
     fs.is_dir.return_value = False
     fs.file_contents.return_value = io.BytesIO('foo')
     core.svn_stream_read = lambda stream, size: stream.read(size)
+    fs.file_length.return_value = 3
     fs.file_md5_checksum.return_value = 'foo_checksum'
     fs.node_proplist.return_value = {}
     results = svndump.MakeRecordsFromPath(MAIN_REPO, MAIN_REPO_REV,
@@ -522,5 +1189,124 @@ class MakeRecordsFromPathTest(unittest.TestCase):
     self.assertEqual(results[0].source, svndump.Record.EXTERNALS)
 
 
+class MakeRecordFromNodeTest(unittest.TestCase):
+  NODES = {
+      '': ('dir', None, {}),
+      'foo': ('dir', None, {'fooprop': 'fooval'}),
+      'foo/file': ('file', 'text', {'fileprop': 'fileval'}),
+      }
+
+  def setUp(self):
+    svndump.CloseRepositories()
+
+  @mock.patch.object(svndump, 'svn_core')
+  @mock.patch.object(svndump, 'svn_repos')
+  @mock.patch.object(svndump, 'svn_fs')
+  def testAddFile(self, fs, unused_repos, core):
+    test_utils.MockRevisions(fs, core, {MAIN_REPO_REV: self.NODES})
+    fs.file_md5_checksum.return_value = 'checksum'
+    record = svndump.MakeRecordFromNode(MAIN_REPO, MAIN_REPO_REV, 'foo/file',
+                                        'bar/file', svndump.Record.EXTERNALS)
+    self.assertEquals(dict(record.headers), {
+        'Node-path': 'bar/file',
+        'Node-kind': 'file',
+        'Node-action': 'add',
+        'Text-content-md5': 'checksum'.encode('hex_codec'),
+        })
+    self.assertEquals(dict(record.props), {'fileprop': 'fileval'})
+    self.assertIs(record.source, record.EXTERNALS)
+    self.assertFalse(fs.file_contents.called)
+
+  @mock.patch.object(svndump, 'svn_core')
+  @mock.patch.object(svndump, 'svn_repos')
+  @mock.patch.object(svndump, 'svn_fs')
+  def testChangeText(self, fs, unused_repos, core):
+    test_utils.MockRevisions(fs, core, {MAIN_REPO_REV: self.NODES})
+    fs.file_md5_checksum.return_value = 'checksum'
+    record = svndump.MakeRecordFromNode(MAIN_REPO, MAIN_REPO_REV, 'foo/file',
+                                        'bar/file', svndump.Record.EXTERNALS,
+                                        action='change', props=False)
+    self.assertEquals(record.headers['Node-action'], 'change')
+    self.assertIn('Text-content-md5', record.headers)
+    self.assertIsNone(record.props)
+    self.assertFalse(fs.node_proplist.called)
+
+  @mock.patch.object(svndump, 'svn_core')
+  @mock.patch.object(svndump, 'svn_repos')
+  @mock.patch.object(svndump, 'svn_fs')
+  def testChangeProps(self, fs, unused_repos, core):
+    test_utils.MockRevisions(fs, core, {MAIN_REPO_REV: self.NODES})
+    record = svndump.MakeRecordFromNode(MAIN_REPO, MAIN_REPO_REV, 'foo/file',
+                                        'bar/file', svndump.Record.EXTERNALS,
+                                        action='change', text=False)
+    self.assertNotIn('Text-content-md5', record.headers)
+    self.assertIsNone(record.text)
+    self.assertEquals(dict(record.props), {'fileprop': 'fileval'})
+    self.assertFalse(fs.file_md5_checksum.called)
+
+  @mock.patch.object(svndump, 'svn_core')
+  @mock.patch.object(svndump, 'svn_repos')
+  @mock.patch.object(svndump, 'svn_fs')
+  def testDirIsNotRecursive(self, fs, unused_repos, core):
+    test_utils.MockRevisions(fs, core, {MAIN_REPO_REV: self.NODES})
+    record = svndump.MakeRecordFromNode(MAIN_REPO, MAIN_REPO_REV, 'foo',
+                                        'bar', svndump.Record.EXTERNALS)
+    self.assertEquals(dict(record.headers), {
+        'Node-path': 'bar',
+        'Node-kind': 'dir',
+        'Node-action': 'add',
+        })
+    self.assertEquals(dict(record.props), {'fooprop': 'fooval'})
+    self.assertFalse(fs.dir_entries.called)
+
+
+class IterRecordsFromPathTest(unittest.TestCase):
+
+  def setUp(self):
+    svndump.CloseRepositories()
+
+  @mock.patch.object(svndump, 'svn_core')
+  @mock.patch.object(svndump, 'svn_repos')
+  @mock.patch.object(svndump, 'svn_fs')
+  def testPrune(self, fs, unused_repos, core):
+    test_utils.MockTree(fs, core, {
+        '': 'dir',
+        'keep': 'dir',
+        'skip': 'dir',
+        'skip/file': 'file',
+        })
+    fs.node_proplist.return_value = {}
+    records = svndump.IterRecordsFromPath(MAIN_REPO, MAIN_REPO_REV, '', 'bar',
+                                          svndump.Record.COPY,
+                                          prune=lambda path: path == 'bar/skip')
+    self.assertEqual(sorted(record.headers['Node-path'] for record in records),
+                     ['bar', 'bar/keep'])
+
+  @mock.patch.object(svndump, 'svn_core')
+  @mock.patch.object(svndump, 'svn_repos')
+  @mock.patch.object(svndump, 'svn_fs')
+  def testContentIsReadWhenWritten(self, fs, unused_repos, core):
+    fs.is_dir = lambda _, path: not path
+    fs.dir_entries.return_value = {'file': None}
+    fs.file_contents.side_effect = lambda *_: io.BytesIO('foo')
+    core.svn_stream_read = lambda stream, size: stream.read(size)
+    fs.file_length.return_value = 3
+    fs.file_md5_checksum.return_value = 'foo_checksum'
+    fs.node_proplist.return_value = {}
+    records = svndump.IterRecordsFromPath(MAIN_REPO, MAIN_REPO_REV, '', 'bar',
+                                          svndump.Record.COPY)
+    self.assertEqual(next(records).headers['Node-path'], 'bar')
+    record = next(records)
+    self.assertEqual(record.headers['Node-path'], 'bar/file')
+    with self.assertRaises(StopIteration):
+      next(records)
+    self.assertFalse(fs.file_contents.called)
+    output = StringIO.StringIO()
+    record.Write(output, None)
+    self.assertEqual(fs.file_contents.call_count, 1)
+    self.assertIn('Text-content-length: 3\n', output.getvalue())
+    self.assertTrue(output.getvalue().endswith('foo\n\n'))
+
+
 if __name__ == '__main__':
   unittest.main()
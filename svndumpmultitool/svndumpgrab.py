@@ -27,22 +27,25 @@ def main(argv):
 
   revnum = None
   rev_action_num = None
-  record = svndump.ReadRecord(sys.stdin)
+  read_record = svndump.MakeRecordReader(sys.stdin)
+  writer = svndump.RecordWriter(sys.stdout)
+  record = read_record()
   while record:
     if 'Revision-number' in record.headers:
       # Revision header Record
       revnum = int(record.headers['Revision-number'])
       rev_action_num = 0
       if Includes(revs, revnum):
-        record.Write(sys.stdout, None)
+        writer.Write(record, None)
       elif revnum > maxrev:
         break
     elif revnum is not None and Includes(revs, revnum):
       # Action Record in an included revision
       record.headers['Record-index'] = str(rev_action_num)
-      record.Write(sys.stdout, None)
+      writer.Write(record, None)
       rev_action_num += 1
-    record = svndump.ReadRecord(sys.stdin)
+    record = read_record()
+  writer.Flush()
 
 
 def ParseArgs(argv):
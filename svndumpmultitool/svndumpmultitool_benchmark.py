@@ -0,0 +1,109 @@
+#!/usr/bin/python2.7
+
+# Copyright 2013 Google Inc. All Rights Reserved.
+#
+# Use of this source code is governed by a MIT-style
+# license that can be found in the LICENSE file or at
+# http://opensource.org/licenses/MIT
+
+"""Benchmarks for svndumpmultitool.
+
+Run with: python -m svndumpmultitool.svndumpmultitool_benchmark
+"""
+
+from __future__ import absolute_import
+
+import collections
+import functools
+import sys
+import time
+
+from svndumpmultitool import svndumpmultitool_cli
+from svndumpmultitool import util
+
+# Shape of the synthetic copy source: top-level dirs, subdirs of each, and
+# files in each subdir (50 * 100 * 100 = 500,000 files)
+TREE_SHAPE = (50, 100, 100)
+
+# Name -> includes used for each benchmark; the copy destination is 'trunk'
+CASES = collections.OrderedDict([
+    ('one subdir', ['trunk/d0/s0']),
+    ('one dir', ['trunk/d0']),
+    ('500 subdirs', ['trunk/d[0-4]/s.*']),
+    ])
+
+
+def _MakeTree(shape):
+  """Build a tree of nested dicts, with None for files."""
+  if not shape:
+    return None
+  count = shape[0]
+  prefix = 'dsf'[-len(shape)]
+  subtree = _MakeTree(shape[1:])
+  # Subtrees are shared; the walk never modifies them
+  return {'%s%d' % (prefix, i): subtree for i in xrange(count)}
+
+
+def _Walk(tree, visit):
+  """Walk a tree built by _MakeTree like svn_util.WalkTree."""
+  stack = [('', tree)]
+  while stack:
+    path, node = stack.pop()
+    if node is None:
+      visit(path, 'file')
+    elif visit(path, 'dir'):
+      for name in sorted(node, reverse=True):
+        stack.append(((path + '/' + name) if path else name, node[name]))
+
+
+def _PlanCopyBySorting(path_filter, dstpath, paths):
+  """The old _FilterPaths algorithm: check and compare every path."""
+  empty_dirs = []
+  recursive_dirs = []
+  for path in sorted(paths):
+    full_path = dstpath + '/' + path if path else dstpath
+    interest = path_filter.CheckPath(full_path)
+    if interest is util.PathFilter.PARENT:
+      empty_dirs.append(path)
+    elif interest is util.PathFilter.YES:
+      include_me = True
+      for parent_dir in recursive_dirs:
+        if path.startswith(parent_dir + '/'):
+          include_me = False
+          break
+      if include_me:
+        recursive_dirs.append(path)
+  return empty_dirs, recursive_dirs
+
+
+def _Timed(func):
+  """Call func and return its result and the time it took in seconds."""
+  start = time.time()
+  result = func()
+  return result, time.time() - start
+
+
+def BenchmarkPlanCopy(stream):
+  """Time planning a copy of a 500,000 node tree for each case in CASES."""
+  tree = _MakeTree(TREE_SHAPE)
+  walk = functools.partial(_Walk, tree)
+  paths = []
+  walk(lambda path, _: paths.append(path) or True)
+  stream.write('%d nodes\n' % len(paths))
+  stream.write('%-12s %12s %12s\n' % ('includes', 'trie (s)', 'sorted (s)'))
+  for name, includes in CASES.iteritems():
+    path_filter = util.PathFilter(includes)
+    plan, trie = _Timed(lambda: svndumpmultitool_cli._PlanCopy(
+        path_filter, 'trunk', walk))
+    expected, by_sorting = _Timed(lambda: _PlanCopyBySorting(
+        path_filter, 'trunk', paths))
+    assert plan == expected, 'Plans differ for %s' % name
+    stream.write('%-12s %12.3f %12.3f\n' % (name, trie, by_sorting))
+
+
+def main():
+  BenchmarkPlanCopy(sys.stdout)
+
+
+if __name__ == '__main__':
+  main()
@@ -21,7 +21,7 @@ Dependencies:
 - Subversion API SWIG bindings for Python (NOT the pysvn library)
 
 Operations:
-  Path filtering (--include):
+  Path filtering (--include, --exclude):
     Each argument to --include is a regular expression. Only paths that
     match one or more --include regexps will be included in the output. A path
     whose ancestor directory matches a regexp will also be included. A path that
@@ -29,13 +29,22 @@ Operations:
     included as a directory without properties, even if originally it was a file
     or it had properties.
 
+    Arguments to --exclude are regular expressions of the same kind. A path
+    that matches one (or whose ancestor directory does) is excluded even if it
+    matches an --include regexp. Without --include, every path that is not
+    excluded is included.
+
+    Large numbers of regexps can be read from files with --include-from and
+    --exclude-from. Each line of the file is a regexp; blank lines and lines
+    starting with # are ignored.
+
     The regular expressions accepted by --include are based on standard Python
     regular expressions, but have one major difference: they are broken into
     /-separated pieces and applied to one /-separated path segment at a time.
     See [1] for detailed examples of how this works.
 
-    It is usually necessary to provide --repo when using --include. See [2] for
-    details.
+    It is usually necessary to provide --repo when using --include, and it is
+    required with --exclude. See [2] for details.
 
     See "Limitations" and --drop-empty-revs below.
 
@@ -49,6 +58,10 @@ Operations:
     Excludes: branches/foo, branches/v1/x/foo, branches/bar
     Includes as directory w/out properties: branches
 
+    --include=trunk --exclude=trunk/vendor/.*
+    Includes: trunk, trunk/vendor, trunk/src
+    Excludes: trunk/vendor/lib, trunk/vendor/lib/foo
+
   Externals (--externals-map):
     If the --externals-map argument is provided, the filter will attempt to
     alter the history such that whenever SVN externals[3] are included using the
@@ -67,6 +80,15 @@ Operations:
     Example:
       --externals-map=/path/to/my/externals.map
 
+    Checking that the location referenced by each external exists can take a
+    while for long histories. Pass --externals-cache=FILE to keep the answers
+    in a file that later runs reuse.
+
+    With --prefetch-externals=REVS, the dump is read that many revisions
+    ahead and the externals changed there are looked up in the referenced
+    repositories by worker processes (--prefetch-workers) while filtering
+    continues.
+
   Revision cancellation (--truncate-rev):
     The value for --truncate-rev should be a revision number. All changes to the
     repository that occurred in that revision will be dropped (commit messages
@@ -194,9 +216,15 @@ from __future__ import absolute_import
 
 import argparse
 import collections
+import functools
+import itertools
 import logging
+import mmap
+from multiprocessing import pool as mp_pool
 import os
 import sys
+import threading
+import time
 import urllib
 
 from svndumpmultitool import externals
@@ -209,6 +237,15 @@ from svndumpmultitool import util
 LOGGER = logging.getLogger('svndumpmultitool' if __name__ == '__main__'
                            else __name__)
 
+# Number of batches of Records each pipeline queue holds (see Filter pipeline)
+PIPELINE_DEPTH = 16
+# Most Records in a batch passed between pipeline stages
+PIPELINE_BATCH = 256
+# Most text content, in bytes, held in memory by each pipeline queue
+PIPELINE_MEMORY = 64 << 20
+# Number of processes prefetching externals (see Filter prefetch_revisions)
+PREFETCH_WORKERS = 4
+
 
 class Error(Exception):
   """Parent class for this module's errors."""
@@ -218,6 +255,581 @@ class UnsupportedActionPair(Error):
   """Encountered a pair of actions for which there is no merge strategy."""
 
 
+class UnstreamableRevision(Error):
+  """A path's Records were too far apart to merge while streaming a revision."""
+
+
+def _PlanCopy(path_filter, dstpath, walk):
+  """Decide which parts of a copied tree to import (see Filter._FilterPaths).
+
+  Args:
+    path_filter: a util.PathFilter
+    dstpath: destination path of the copy
+    walk: a function that walks the copied tree like svn_util.WalkTree, given
+          only its visit argument
+
+  Returns:
+    empty_dirs: a sorted list of dirs to create empty
+    recursive_dirs: a sorted list of dirs to copy recursively
+
+  The tree is walked as a trie of path components: only the children of PARENT
+  directories are visited, since everything below a YES path is copied with it
+  and nothing below a NO path can be included. Each node is therefore checked
+  at most once and no path is compared with the others.
+  """
+  empty_dirs = []
+  recursive_dirs = []
+
+  def Visit(path, unused_kind):
+    full_path = dstpath + '/' + path if path else dstpath
+    interest = path_filter.CheckPath(full_path)
+    if interest is util.PathFilter.PARENT:
+      empty_dirs.append(path)
+      return True
+    elif interest is util.PathFilter.YES:
+      recursive_dirs.append(path)
+    return False
+
+  walk(Visit)
+  # Sorting keeps parents before their children
+  empty_dirs.sort()
+  recursive_dirs.sort()
+  return empty_dirs, recursive_dirs
+
+
+class _IndexedRecords(object):
+  """The Records of a revision, for removing and reordering them in O(1).
+
+  Each Record keeps the slot it had in the original list. A Record that is
+  moved goes into the slot of the Record it is moved before, so removing and
+  moving Records never shifts the others.
+  """
+
+  def __init__(self, records):
+    self._slots = [[record] for record in records]
+    self._slot_of = {id(record): slot for slot, record in enumerate(records)}
+    self._count = len(records)
+
+  @staticmethod
+  def _Find(slot, record):
+    """Return the index of a Record in a slot.
+
+    Records are looked up by identity: equal Records (e.g. two identical
+    deletes) may share a slot.
+    """
+    return next(i for i, other in enumerate(slot) if other is record)
+
+  def __iter__(self):
+    for slot in self._slots:
+      for record in slot:
+        yield record
+
+  def __len__(self):
+    return self._count
+
+  def Remove(self, record):
+    """Remove a Record."""
+    slot = self._slots[self._slot_of.pop(id(record))]
+    del slot[self._Find(slot, record)]
+    self._count -= 1
+
+  def InsertBefore(self, record, anchor):
+    """Insert a Record just before anchor, which must be present."""
+    slot_number = self._slot_of[id(anchor)]
+    slot = self._slots[slot_number]
+    slot.insert(self._Find(slot, anchor), record)
+    self._slot_of[id(record)] = slot_number
+    self._count += 1
+
+
+class _Pipe(object):
+  """A bounded queue between two pipeline stages that times their waits.
+
+  The queue holds at most depth items. Items that are batches of Records are
+  also counted by the text content they hold in memory: the queue holds at
+  most memory bytes of it, unless a single batch holds more.
+
+  Attributes:
+    depth: the most items the queue holds
+    memory: the most bytes of text content the queue holds, or None for no
+            limit
+    put_wait: seconds spent waiting for room in the queue
+    get_wait: seconds spent waiting for an item
+  """
+
+  def __init__(self, depth, memory=None):
+    self.depth = depth
+    self.memory = memory
+    self.put_wait = 0.0
+    self.get_wait = 0.0
+    self._items = collections.deque()  # (item, size) pairs
+    self._size = 0
+    self._closed = False
+    self._condition = threading.Condition()
+
+  def IsBatchFull(self, batch, size):
+    """Should a batch of Records holding size bytes of text be queued now?"""
+    return (len(batch) >= PIPELINE_BATCH
+            or (self.memory is not None and size * self.depth >= self.memory))
+
+  def Put(self, item, size=0):
+    """Queue an item, waiting for room if the queue is full.
+
+    Args:
+      item: the item
+      size: the bytes of text content the item holds in memory
+
+    Returns:
+      False, without queueing the item, if the queue has been closed
+    """
+    start = time.time()
+    with self._condition:
+      while not self._closed and self._IsFull(size):
+        self._condition.wait()
+      if not self._closed:
+        self._items.append((item, size))
+        self._size += size
+        self._condition.notify_all()
+      queued = not self._closed
+    self.put_wait += time.time() - start
+    return queued
+
+  def Get(self):
+    start = time.time()
+    with self._condition:
+      while not self._items:
+        self._condition.wait()
+      item, size = self._items.popleft()
+      self._size -= size
+      self._condition.notify_all()
+    self.get_wait += time.time() - start
+    return item
+
+  def Close(self):
+    """Stop queueing items, so a stage waiting to put one can give up."""
+    with self._condition:
+      self._closed = True
+      self._items.clear()
+      self._size = 0
+      self._condition.notify_all()
+
+  def _IsFull(self, size):
+    if len(self._items) >= self.depth:
+      return True
+    # Even an item larger than memory must fit once the queue is empty, and
+    # items that hold no text always fit
+    return (self.memory is not None and size > 0 and self._size > 0
+            and self._size + size > self.memory)
+
+
+class _Failure(object):
+  """An exception raised by a pipeline stage, passed on to be raised again."""
+
+  def __init__(self, exc_info):
+    self.exc_info = exc_info
+
+  def Raise(self):
+    raise self.exc_info[0], self.exc_info[1], self.exc_info[2]
+
+
+def _StartThread(target, *args):
+  # Daemon threads can't keep the process alive if another stage fails
+  thread = threading.Thread(target=target, args=args)
+  thread.daemon = True
+  thread.start()
+  return thread
+
+
+def _ReadStage(read_record, paths, pipe):
+  """Read Records in batches that never span revisions and queue them.
+
+  Args:
+    read_record: a function returned by svndump.MakeRecordReader
+    paths: a util.PathFilter only used by this thread
+    pipe: the _Pipe to the filter stage
+
+  None is queued after the last batch. Reading stops early if the pipe is
+  closed.
+  """
+  def Discard(record):
+    return ('Node-path' in record.headers
+            and paths.IsExcluded(record.headers['Node-path']))
+
+  try:
+    batch = []
+    size = 0
+    record = read_record(discard_text=Discard)
+    while record is not None:
+      if pipe.IsBatchFull(batch, size) or 'Revision-number' in record.headers:
+        if not pipe.Put(batch, size):
+          return
+        batch = []
+        size = 0
+      batch.append(record)
+      size += record.HeldTextSize()
+      record = read_record(discard_text=Discard)
+    if pipe.Put(batch, size):
+      pipe.Put(None)
+  except Exception:
+    pipe.Put(_Failure(sys.exc_info()))
+
+
+def _MakePipeReader(pipe):
+  """Make a read_record function that takes Records from _ReadStage."""
+  batches = [[]]
+
+  def ReadRecord(discard_text=None):
+    del discard_text  # Already applied by _ReadStage
+    while batches[0] is not None and not batches[0]:
+      batch = pipe.Get()
+      if isinstance(batch, _Failure):
+        batch.Raise()
+      batches[0] = collections.deque(batch) if batch is not None else None
+    return batches[0].popleft() if batches[0] is not None else None
+
+  return ReadRecord
+
+
+class _PipeWriter(object):
+  """Hands Records to a writer thread in place of an svndump.RecordWriter."""
+
+  def __init__(self, writer, depth, memory=None):
+    """Create a new _PipeWriter.
+
+    Args:
+      writer: the svndump.RecordWriter that the thread writes with
+      depth: the number of batches the queue to the thread holds
+      memory: the most bytes of text content the queue holds, or None for no
+              limit
+    """
+    self.pipe = _Pipe(depth, memory)
+    self._writer = writer
+    self._batch = []
+    self._size = 0
+    self._failure = None
+    self._thread = _StartThread(self._WriteStage)
+
+  def Write(self, record, revmap):
+    """Queue a Record to be written.
+
+    Raises:
+      the exception that the thread failed with, if it has failed
+    """
+    # The repository roots that copies and externals are read from are only
+    # used on the filter thread.
+    record.LoadRepositoryText()
+    self._batch.append((record, revmap))
+    self._size += record.HeldTextSize()
+    if self.pipe.IsBatchFull(self._batch, self._size):
+      self._Put(self._batch, self._size)
+      self._batch = []
+      self._size = 0
+
+  def Close(self):
+    """Write every Record given so far and wait for the thread to finish."""
+    if self.pipe.Put(self._batch, self._size):
+      self.pipe.Put(None)
+    self._batch = []
+    self._size = 0
+    self._thread.join()
+    if self._failure is not None:
+      self._failure.Raise()
+
+  def _Put(self, batch, size):
+    self.pipe.Put(batch, size)
+    if self._failure is not None:
+      self._failure.Raise()
+
+  def _WriteStage(self):
+    try:
+      batch = self.pipe.Get()
+      while batch is not None:
+        for record, revmap in batch:
+          self._writer.Write(record, revmap)
+        batch = self.pipe.Get()
+      self._writer.Close()
+    except Exception:
+      self._failure = _Failure(sys.exc_info())
+      # Wake the filter stage if it is waiting for room in the queue
+      self.pipe.Close()
+
+
+class _Lookahead(object):
+  """Reads Records ahead of the Filter so their needs can be prefetched."""
+
+  def __init__(self, read_record, revisions, visit):
+    """Create a new _Lookahead.
+
+    Args:
+      read_record: the function used to read Records from input_stream
+      revisions: the number of revisions to read ahead of the Record last
+                 returned by Read
+      visit: a callable that is passed the revision number and each Record
+             of a revision (its header included) when it is read ahead
+    """
+    self._read_record = read_record
+    self._revisions = revisions
+    self._visit = visit
+    self._records = collections.deque()
+    # Number of revision headers in _records
+    self._headers = 0
+    self._revision_number = None
+    self._eof = False
+
+  def Read(self, discard_text=None):
+    """Return the next Record, like read_record."""
+    while not self._eof and self._headers <= self._revisions:
+      record = self._read_record(discard_text=discard_text)
+      if record is None:
+        self._eof = True
+        break
+      if 'Revision-number' in record.headers:
+        self._headers += 1
+        self._revision_number = int(record.headers['Revision-number'])
+      if self._revision_number is not None:
+        self._visit(self._revision_number, record)
+      self._records.append(record)
+    if not self._records:
+      return None
+    record = self._records.popleft()
+    if 'Revision-number' in record.headers:
+      self._headers -= 1
+    return record
+
+
+# The externals_map and util.PathFilter of the Filter, set in each worker
+# process by _InitPrefetchWorker so that they are not sent with every task
+_PREFETCH_EXTERNALS_MAP = None
+_PREFETCH_PATHS = None
+
+
+def _InitPrefetchWorker(externals_map, paths):
+  """Prepare a worker process forked to prefetch externals.
+
+  Args:
+    externals_map: the externals_map of the Filter
+    paths: the util.PathFilter of the Filter
+  """
+  global _PREFETCH_EXTERNALS_MAP, _PREFETCH_PATHS
+  # Repository handles must not be shared with the parent process
+  svndump.CloseRepositories()
+  externals.DetachSourceExistsCache()
+  _PREFETCH_EXTERNALS_MAP = externals_map
+  _PREFETCH_PATHS = paths
+
+
+def _PrefetchExternals(repo, revision_number, path, prev_value, new_value):
+  """Do the repository lookups needed to internalize a change to externals.
+
+  Args:
+    repo: the repository that produced the dump file
+    revision_number: the revision in which svn:externals was changed
+    path: the path on which svn:externals is set
+    prev_value: the value of svn:externals before revision_number, or None
+    new_value: the value of svn:externals in revision_number, or None
+
+  Returns:
+    a tuple (prev_externals, new_externals, diffs, trees, source_exists):
+      prev_externals, new_externals: the parsed values, as returned by
+                                     externals.Parse
+      diffs: {(old srcpath, old srcrev, new srcpath, new srcrev):
+              svn_util.Diff result} for the changed externals
+      trees: {(srcrepo, srcrev, srcpath): svn_util.ListNodes result} for the
+             externals that must be added from another repository
+      source_exists: the answers that parsing looked up and that the worker
+                     could not store in the --externals-cache file (see
+                     externals.PopUnstoredSourceExists)
+
+  This runs in a worker process (see Filter._QueuePrefetch), so everything it
+  returns can be pickled.
+  """
+  externals_map = _PREFETCH_EXTERNALS_MAP
+  paths = _PREFETCH_PATHS
+  if prev_value:
+    prev_externals = externals.Parse(repo, revision_number - 1, path,
+                                     prev_value, externals_map)
+  else:
+    prev_externals = {}
+  if new_value:
+    new_externals = externals.Parse(repo, revision_number, path, new_value,
+                                    externals_map)
+  else:
+    new_externals = {}
+  added, changed, unused_deleted = externals.Diff(prev_externals,
+                                                  new_externals)
+  diffs = {}
+  for old, new in changed:
+    if old.srcrev is None or (new.srcrepo == repo and
+                              paths.IsIncluded(new.srcpath)):
+      # The Filter replaces the external instead (see _InternalizeExternals)
+      added.append(new)
+    elif new.srcrev is not None:
+      diffs[old.srcpath, old.srcrev, new.srcpath, new.srcrev] = svn_util.Diff(
+          new.srcrepo, old.srcpath, old.srcrev, new.srcpath, new.srcrev)
+  trees = {}
+  for description in added:
+    if description.srcrev is None or (description.srcrepo == repo and
+                                      paths.IsIncluded(description.srcpath)):
+      continue
+    trees[description.srcrepo, description.srcrev, description.srcpath] = (
+        svn_util.ListNodes(description.srcrepo, description.srcrev,
+                           description.srcpath))
+  return (prev_externals, new_externals, diffs, trees,
+          externals.PopUnstoredSourceExists())
+
+
+def _IsInSubtree(path, root):
+  """Is path root or below it?"""
+  return not root or path == root or path.startswith(root + '/')
+
+
+class _WrittenPaths(object):
+  """The paths that Records streamed out of a revision can no longer reach.
+
+  Two kinds of path are kept:
+  - the paths of Records that were written one at a time
+  - the roots of subtrees that _FilterRecord added Records to (e.g. by
+    importing a copy or an external), all of whose paths are unreachable
+  The Records of _Expansions are not remembered one at a time, since their
+  paths are all below such a root. The memory used therefore grows with the
+  number of Records read from the revision, not with the size of the trees
+  that copies and externals import.
+  """
+
+  def __init__(self):
+    self._paths = set()
+    self._roots = set()
+
+  def __contains__(self, path):
+    if path in self._paths:
+      return True
+    while path not in self._roots:
+      if not path:
+        return False
+      path = path.rpartition('/')[0]
+    return True
+
+  def Add(self, record):
+    """Remember a written Record's path."""
+    self._paths.add(record.headers['Node-path'])
+
+  def AddRoot(self, root):
+    """Remember that a subtree's Records have all been written."""
+    self._roots.add(root)
+
+
+class _Expansion(object):
+  """Records that add a tree, generated as they are needed.
+
+  Attributes:
+    root: the path of the tree. Every Record generated is at or below it.
+    records: an iterator of the Records, parents before children, with one
+             Record per path
+
+  Copies and externals can add huge trees. _FilterRecord returns them as
+  _Expansions so that _StreamRev can write their Records without holding them
+  all in memory at once.
+  """
+  __slots__ = ('root', 'records')
+
+  def __init__(self, root, records):
+    self.root = root
+    self.records = iter(records)
+
+
+def _IterRecords(items):
+  """Generate the Records of a list of Records and _Expansions, in order."""
+  for item in items:
+    if isinstance(item, _Expansion):
+      for record in item.records:
+        yield record
+    else:
+      yield item
+
+
+def _PlanFlush(items):
+  """Plan how to write held Records without generating _Expansions up front.
+
+  Args:
+    items: a list of Records and _Expansions held back by Filter._StreamRev
+
+  Returns:
+    a list of steps, or None if the _Expansions have to be generated in full
+    for the Records to be merged. Each step is either:
+    - a list of Records, to be merged and written together
+    - a tuple (expansion, held) where held is an OrderedDict {path: (before,
+      after)} of the other Records below the root of the _Expansion, from
+      before and after it. They are merged with the Record that the _Expansion
+      generates for the same path, if any, and the rest are written right
+      after the _Expansion.
+
+  Filter._FlattenMultipleActions only merges Records with the same path, and
+  an _Expansion generates Records below its root only, so its Records can be
+  merged as they are generated if all other Records below its root are
+  known. This is the case unless:
+  - the roots of two _Expansions overlap
+  - a Record before an _Expansion is below its root but not at it, or it is
+    at the root but the _Expansion does not start with the root
+  - a path outside the _Expansions has Records both before and after one
+  Dump files list the changes to a directory before changes to its contents,
+  so in practice only a delete of the root comes before an _Expansion.
+  """
+  expansions = [item for item in items if isinstance(item, _Expansion)]
+  if not expansions:
+    return [items]
+  for i, expansion in enumerate(expansions):
+    for other in expansions[:i]:
+      if (_IsInSubtree(expansion.root, other.root)
+          or _IsInSubtree(other.root, expansion.root)):
+        return None
+  held_by_root = dict((expansion.root, collections.OrderedDict())
+                      for expansion in expansions)
+  passed = set()
+  steps = []
+  segment = []
+  for item in items:
+    if isinstance(item, _Expansion):
+      steps.append(segment)
+      steps.append((item, held_by_root[item.root]))
+      passed.add(item.root)
+      segment = []
+      continue
+    path = item.headers['Node-path']
+    for expansion in expansions:
+      if _IsInSubtree(path, expansion.root):
+        before, after = held_by_root[expansion.root].setdefault(path,
+                                                                ([], []))
+        if expansion.root in passed:
+          after.append(item)
+        elif path == expansion.root:
+          before.append(item)
+        else:
+          return None
+        break
+    else:
+      segment.append(item)
+  steps.append(segment)
+  # Records outside the _Expansions are only merged within a step
+  step_of_path = {}
+  for index, step in enumerate(steps):
+    if isinstance(step, list):
+      for record in step:
+        path = record.headers['Node-path']
+        if step_of_path.setdefault(path, index) != index:
+          return None
+  # Records before an _Expansion are merged with its first Record
+  for expansion in expansions:
+    held = held_by_root[expansion.root]
+    if expansion.root in held and held[expansion.root][0]:
+      first = next(expansion.records, None)
+      if first is None:
+        return None
+      expansion.records = itertools.chain([first], expansion.records)
+      if first.headers['Node-path'] != expansion.root:
+        return None
+  return [step for step in steps if not isinstance(step, list) or step]
+
+
 # Higher-level class that makes use of the above to filter dump
 # file fragments a whole revision at a time.
 class Filter(object):
@@ -237,7 +849,16 @@ class Filter(object):
                delete_properties=None,
                truncate_revs=None,
                drop_actions=None,
-               force_delete=None):
+               force_delete=None,
+               buffer_revisions=False,
+               memory_budget=None,
+               write_buffer_size=svndump.WRITE_BUFFER_SIZE,
+               checksum_threads=0,
+               pipeline=False,
+               pipeline_depth=PIPELINE_DEPTH,
+               pipeline_memory=PIPELINE_MEMORY,
+               prefetch_revisions=0,
+               prefetch_workers=PREFETCH_WORKERS):
     """Create a new Filter with the given attributes.
 
     Args:
@@ -273,11 +894,58 @@ class Filter(object):
       force_delete: a dict of lists where the keys of the dict are revision
                     numbers (int) and the items in the list are paths to add
                     delete actions for in those revisions.
+      buffer_revisions: if True, every revision is read into memory before it
+                        is filtered instead of being streamed (see
+                        _StreamRev).
+      memory_budget: the most text content, in bytes, to hold in memory for
+                     Records that are held back while filtering a revision.
+                     Beyond that, it is moved to a temporary file. None means
+                     no limit.
+      write_buffer_size: the size, in bytes, of the buffer in which output is
+                         collected before it is written to output_stream
+                         (see svndump.RecordWriter)
+      checksum_threads: the number of threads computing missing checksums of
+                        large text content while other Records are filtered
+                        (see svndump.RecordWriter)
+      pipeline: if True, reading and writing are done by their own threads
+                while the calling thread filters (see Filter). pipeline_waits
+                then tells how long each stage waited for the others.
+      pipeline_depth: the number of batches of Records that each queue between
+                      pipeline stages holds
+      pipeline_memory: the most text content, in bytes, that each queue
+                       between pipeline stages holds in memory (unless a
+                       single batch holds more). None means no limit.
+      prefetch_revisions: if positive and internalizing externals is enabled,
+                          Records are read this many revisions ahead and the
+                          repository lookups needed for their changes to
+                          svn:externals are done by worker processes while
+                          the calling thread filters (see _QueuePrefetch)
+      prefetch_workers: the number of worker processes prefetching externals
     """
     self.repo = repo
     self.paths = paths
+    # Generated Records must be filtered too if included directories can
+    # contain excluded paths
+    self._prune = paths.IsExcluded if paths.HasExcludes() else None
     self.input_stream = input_stream
     self.output_stream = output_stream
+    self._writer = svndump.RecordWriter(output_stream, write_buffer_size,
+                                        checksum_threads)
+    self.pipeline = pipeline
+    self.pipeline_depth = pipeline_depth
+    self.pipeline_memory = pipeline_memory
+    # {stage: seconds spent waiting}, filled in by Filter in pipeline mode
+    self.pipeline_waits = None
+    # svn:externals of every path as of the Records read so far, tracked by
+    # Filter if internalizing externals is enabled
+    self._externals_state = None
+    self.prefetch_revisions = prefetch_revisions
+    self.prefetch_workers = prefetch_workers
+    # State of prefetching externals (see _QueuePrefetch)
+    self._prefetch_pool = None
+    self._prefetch_state = None
+    # {(revision number, path): (prev_value, new_value, AsyncResult)}
+    self._prefetched = {}
     self.drop_empty_revs = drop_empty_revs
     self.revmap = revmap
     self.externals_map = externals_map
@@ -285,59 +953,397 @@ class Filter(object):
     self.truncate_revs = set(truncate_revs) if truncate_revs else set()
     self.drop_actions = drop_actions if drop_actions else dict()
     self.force_delete = force_delete if force_delete else dict()
+    self.buffer_revisions = buffer_revisions
+    self.memory_budget = memory_budget
+    # State of the revision being written (see _WriteRecords)
+    self._current_output_rev = 0
+    self._revhdr = None
+    self._revhdr_written = False
 
   def Filter(self):
     """Filter the entire dump file in input_stream.
 
     Output is written to output_stream.
+
+    In pipeline mode, a reader thread reads Records and a writer thread writes
+    them, each connected to the filter stage on the calling thread by a queue
+    of batches of Records (bounded by pipeline_depth and pipeline_memory), so
+    that I/O overlaps with filtering and repository lookups. Regular files are
+    memory-mapped so that text content is still only read when it is written.
     """
+    if self.externals_map and self.prefetch_revisions > 0:
+      # Fork the workers before the pipeline (or RecordWriter) starts any
+      # threads, since a forked process only gets a copy of the calling thread
+      self._prefetch_pool = mp_pool.Pool(
+          self.prefetch_workers, _InitPrefetchWorker,
+          (self.externals_map, self.paths.Copy()))
+    read_pipe = None
+    try:
+      if self.pipeline:
+        read_pipe, writer = self._StartPipeline()
+        read_record = _MakePipeReader(read_pipe)
+      else:
+        read_record = svndump.MakeRecordReader(self.input_stream)
+      if self._prefetch_pool is not None:
+        read_record = _Lookahead(read_record, self.prefetch_revisions,
+                                 self._QueuePrefetch).Read
+      self._FilterRevisions(read_record)
+    finally:
+      if read_pipe is not None:
+        # Let the reader thread stop if filtering failed
+        read_pipe.Close()
+      try:
+        if self._prefetch_pool is not None:
+          self._prefetch_pool.terminate()
+          self._prefetch_pool.join()
+          self._prefetch_pool = None
+          self._prefetched.clear()
+      finally:
+        self._writer.Close()
+    if self.pipeline:
+      self.pipeline_waits = collections.OrderedDict([
+          ('reader', read_pipe.put_wait),
+          ('filter', read_pipe.get_wait + writer.pipe.put_wait),
+          ('writer', writer.pipe.get_wait),
+          ])
+
+  def _FilterRevisions(self, read_record):
+    """Filter every revision read by read_record and write the output."""
     # Pass the dump-file header through unchanged
-    record = svndump.ReadRecord(self.input_stream)
+    record = read_record()
     while 'Revision-number' not in record.headers:
-      record.Write(self.output_stream, self.revmap)
-      record = svndump.ReadRecord(self.input_stream)
+      self._writer.Write(record, self.revmap)
+      record = read_record()
 
     revhdr = record
+    if self.externals_map and revhdr is not None:
+      self._externals_state = externals.ExternalsState(
+          int(revhdr.headers['Revision-number']))
 
-    current_output_rev = 0
     while revhdr is not None:
       # Read revision header.
       assert 'Revision-number' in revhdr.headers
-      contents = []
-      # Read revision contents.
-      while True:
-        record = svndump.ReadRecord(self.input_stream)
-        if record is None or 'Revision-number' in record.headers:
-          newrevhdr = record
+      revision_number = int(revhdr.headers['Revision-number'])
+      self._revhdr = revhdr
+      self._revhdr_written = False
+      self._DropPrefetched(revision_number)
+
+      if (self.buffer_revisions
+          or revision_number in self.truncate_revs
+          or revision_number in self.force_delete):
+        # Read revision contents.
+        contents = []
+        spill = svndump.TextSpill(self.memory_budget)
+        while True:
+          record = read_record(discard_text=self._IsExcludedNode)
+          if record is None or 'Revision-number' in record.headers:
+            break
+          self._TrackExternals(revision_number, record)
+          spill.Add(record)
+          contents.append(record)
+        # Alter the contents of the revision and write them out.
+        self._WriteRecords(self._FilterRev(revhdr, contents))
+      else:
+        record = self._StreamRev(revision_number, read_record)
+
+      # Write out the header of an empty revision, if that's what we've
+      # decided to do.
+      if not self._revhdr_written:
+        if not self.drop_empty_revs:
+          self._WriteRevHeader()
+        elif self.revmap is not None:
+          # current_output_rev still points to the last revision we dumped.
+          self.revmap[revision_number] = self._current_output_rev
+
+      # And loop round again.
+      revhdr = record
+
+  def _StartPipeline(self):
+    """Start the reader and writer threads of pipeline mode.
+
+    Returns:
+      read_pipe: the _Pipe that the reader thread fills
+      writer: the _PipeWriter that now replaces self._writer
+    """
+    # Text that ReadRecord leaves in a seekable stream would be read on other
+    # threads while the reader thread is using the stream, but any thread can
+    # read text that is left in a mapping of it.
+    mapping = self.input_stream
+    if not isinstance(mapping, mmap.mmap):
+      try:
+        mapping = svndump.MapFile(self.input_stream)
+        mapping.seek(self.input_stream.tell())
+      except (AttributeError, EnvironmentError, ValueError):
+        # Not a regular file (e.g. a pipe or an in-memory stream)
+        mapping = None
+    if mapping is not None:
+      read_record = svndump.MakeRecordReader(mapping)
+    else:
+      read_record = svndump.RecordScanner(self.input_stream).ReadRecord
+    read_pipe = _Pipe(self.pipeline_depth, self.pipeline_memory)
+    _StartThread(_ReadStage, read_record, self.paths.Copy(), read_pipe)
+    writer = _PipeWriter(self._writer, self.pipeline_depth,
+                         self.pipeline_memory)
+    self._writer = writer
+    return read_pipe, writer
+
+  def _WriteRecords(self, records):
+    """Write Records of the current revision, after its header if need be.
+
+    The revision header is only written before the first Record, so that
+    empty revisions can be dropped after their contents have been streamed.
+    """
+    for record in records:
+      if not self._revhdr_written:
+        self._WriteRevHeader()
+      self._writer.Write(record, self.revmap)
+
+  def _WriteRevHeader(self):
+    """Write the header of the current revision and number it."""
+    # We only update the current_output_rev if we're actually going to write
+    # something.
+    self._current_output_rev += 1
+    # Update our revmap with information about this revision.
+    if self.drop_empty_revs and self.revmap is not None:
+      revision_number = int(self._revhdr.headers['Revision-number'])
+      self.revmap[revision_number] = self._current_output_rev
+    self._writer.Write(self._revhdr, self.revmap)
+    self._revhdr_written = True
+
+  def _QueuePrefetch(self, revision_number, record):
+    """Start prefetching for a Record that was read ahead of the Filter.
+
+    Args:
+      revision_number: the number of the revision the Record belongs to
+      record: a Record
+
+    If the Record changes svn:externals, the externals it defines before and
+    after the change are parsed, and the diffs and trees needed to apply the
+    change are fetched, by a worker process (see _PrefetchExternals). The
+    result is kept until _InternalizeExternals takes it for the same Record.
+    """
+    if 'Revision-number' in record.headers:
+      if self._prefetch_state is None:
+        # Track svn:externals from the same revision as Filter does
+        self._prefetch_state = externals.ExternalsState(revision_number)
+      return
+    self._prefetch_state.Update(revision_number, record)
+    if record.DoesNotAffectExternals():
+      return
+    path = record.headers['Node-path']
+    if not self.paths.IsIncluded(path):
+      # _FilterRecord drops excluded paths and strips the properties of
+      # PARENTs, so their externals are never internalized
+      return
+    prev_value = self._prefetch_state.Lookup(path, revision_number - 1)
+    if prev_value is externals.UNKNOWN:
+      return
+    new_value = record.props.get('svn:externals') or None
+    result = self._prefetch_pool.apply_async(
+        _PrefetchExternals,
+        (self.repo, revision_number, path, prev_value or None, new_value))
+    self._prefetched[revision_number, path] = (prev_value or None, new_value,
+                                              result)
+
+  def _TakePrefetched(self, revision_number, record):
+    """Get what was prefetched for a Record, if it is still valid.
+
+    Args:
+      revision_number: the number of the revision being filtered
+      record: a Record with an svn:externals property to be fixed
+
+    Returns:
+      a tuple (prev_externals, new_externals, diffs, trees) as returned by
+      _PrefetchExternals, or None if nothing was prefetched for the same
+      values of svn:externals
+    """
+    path = record.headers['Node-path']
+    try:
+      prev_value, new_value, result = self._prefetched.pop(
+          (revision_number, path))
+    except KeyError:
+      return None
+    if (new_value != (record.props.get('svn:externals') or None)
+        or prev_value != (self._externals_state.Lookup(
+            path, revision_number - 1) or None)):
+      return None
+    prev_externals, new_externals, diffs, trees, source_exists = result.get()
+    # Only this process may write to the --externals-cache file
+    externals.StoreSourceExists(source_exists)
+    return prev_externals, new_externals, diffs, trees
+
+  def _DropPrefetched(self, revision_number):
+    """Forget results prefetched for Records before a revision."""
+    for key in [key for key in self._prefetched if key[0] < revision_number]:
+      del self._prefetched[key]
+
+  def _StreamRev(self, revision_number, read_record):
+    """Filter and write a revision's Records as they are read.
+
+    Args:
+      revision_number: the number of the revision being filtered
+      read_record: the function used to read Records from input_stream
+
+    Returns:
+      the header of the next revision or None at EOF
+
+    Raises:
+      UnstreamableRevision: if a path has Records that are too far apart in
+                            the revision to be merged (see below)
+
+    This does the same as _FilterRev, but without holding the whole revision
+    in memory. Records are only held back while _FlattenMultipleActions might
+    still have to merge them with Records that have not been read yet:
+    - A Record is held until a Record for a different path is read, since
+      dump files list the actions for a path (e.g. a delete and an add)
+      together.
+    - If _FilterRecord turns a Record into Records for other paths (e.g. by
+      importing a copy or an external), they are all held until a Record
+      outside of its path is read, since dump files list the changes to a
+      directory before changes to its contents. The Records of whole trees
+      (_Expansions) are only generated once they are written, though.
+    Revisions with force_delete actions are always filtered by _FilterRev.
+    Written paths are only remembered as far as _WrittenPaths needs them to
+    detect Records that come too late to be merged.
+    """
+    LOGGER.debug('Filtering r%s', revision_number)
+    pending = []
+    spill = svndump.TextSpill(self.memory_budget)
+    # Stack of paths whose subtrees may have Records to merge with pending
+    subtrees = []
+    # Paths that subtrees held back since the last flush
+    roots = []
+    last_path = None
+    # Paths written so far (Records for them can no longer be merged)
+    written = _WrittenPaths()
+    while True:
+      record = read_record(discard_text=self._IsExcludedNode)
+      if record is None or 'Revision-number' in record.headers:
+        break
+      self._TrackExternals(revision_number, record)
+      path = record.headers['Node-path']
+      while subtrees and not _IsInSubtree(path, subtrees[-1]):
+        subtrees.pop()
+      if pending and not subtrees and path != last_path:
+        self._FlushRecords(revision_number, pending, written, roots)
+        pending = []
+        roots = []
+        spill = svndump.TextSpill(self.memory_budget)
+      last_path = path
+      if self._IsDroppedAction(revision_number, record):
+        continue
+      items = self._FilterRecord(revision_number, record)
+      for item in items:
+        if (isinstance(item, _Expansion)
+            or item.headers['Node-path'] != path):
+          subtrees.append(path)
+          roots.append(path)
           break
-        contents.append(record)
+      for item in items:
+        if not isinstance(item, _Expansion):
+          spill.Add(item)
+      pending.extend(items)
+    self._FlushRecords(revision_number, pending, written, roots)
+    return record
 
-      revision_number = int(revhdr.headers['Revision-number'])
+  def _FlushRecords(self, revision_number, items, written, roots):
+    """Merge, finish and write Records held back by _StreamRev.
 
-      # Alter the contents of the revision.
-      contents = self._FilterRev(revhdr, contents)
+    Args:
+      revision_number: the number of the revision being filtered
+      items: the Records held back and _Expansions generating more of them
+      written: the _WrittenPaths of the revision, updated with the Records
+      roots: the roots of the subtrees the Records were held back for
+
+    The Records of _Expansions are written as they are generated, following
+    _PlanFlush. If that is not possible, they are all generated first and
+    merged with the other Records as _FilterRev does.
+    """
+    plan = _PlanFlush(items)
+    if plan is None:
+      plan = [list(_IterRecords(items))]
+    for step in plan:
+      if isinstance(step, list):
+        self._WriteMerged(revision_number, step, written)
+        continue
+      expansion, held = step
+      # Every path below the root of the _Expansion is covered by one of
+      # roots once the flush is done, so its paths need not be remembered
+      for record in expansion.records:
+        same_path = held.pop(record.headers['Node-path'], None)
+        if same_path is None:
+          self._WriteMerged(revision_number, [record], written,
+                            remember=False)
+        else:
+          before, after = same_path
+          self._WriteMerged(revision_number, before + [record] + after,
+                            written, remember=False)
+      self._WriteMerged(revision_number,
+                        [record for before, after in held.itervalues()
+                         for record in before + after],
+                        written)
+    for root in roots:
+      written.AddRoot(root)
+
+  def _WriteMerged(self, revision_number, records, written, remember=True):
+    """Merge, finish and write Records for _FlushRecords.
 
-      # Determine whether we should output this revision.  We only
-      # update the current_output_rev if we're actually going to write
-      # something.
-      should_write = contents or not self.drop_empty_revs
-      if should_write:
-        current_output_rev += 1
+    Args:
+      revision_number: the number of the revision being filtered
+      records: the Records to merge with each other
+      written: the _WrittenPaths of the revision
+      remember: whether to add the paths of the Records to written
+    """
+    if len(records) > 1:
+      self._FlattenMultipleActions(revision_number, records)
+    for record in records:
+      path = record.headers['Node-path']
+      if path in written:
+        raise UnstreamableRevision('Found actions for path %s in r%s too far'
+                                   ' apart to merge; use --buffer-revisions'
+                                   % (path, revision_number))
+    if remember:
+      for record in records:
+        written.Add(record)
+    self._DeleteProperties(records)
+    self._WriteRecords(records)
+
+  def _TrackExternals(self, revision_number, record):
+    """Follow changes to svn:externals made by a Record read from the dump."""
+    if self._externals_state is not None:
+      self._externals_state.Update(revision_number, record)
+
+  def _PreviousExternals(self, revision_number, path):
+    """Get the externals defined on a path in the previous revision.
 
-      # Update our revmap with information about this revision.  Note that
-      # if this revision won't be written, current_output_rev still points
-      # to the last version we dumped.
-      if self.drop_empty_revs and self.revmap is not None:
-        self.revmap[revision_number] = current_output_rev
+    Args:
+      revision_number: the number of the revision being filtered
+      path: the path on which svn:externals may be set
 
-      # Write out this revision, if that's what we've decided to do.
-      if should_write:
-        revhdr.Write(self.output_stream, self.revmap)
-        for record in contents:
-          record.Write(self.output_stream, self.revmap)
+    Returns:
+      a dict mapping path to ExternalsDescription, like externals.FromRev
 
-      # And loop round again.
-      revhdr = newrevhdr
+    The value of svn:externals is taken from the Records read so far. The
+    repository is only asked for it if it comes from before the first
+    revision of the dump (or if no dump is being read).
+    """
+    prev_rev = revision_number - 1
+    if self._externals_state is None:
+      value = externals.UNKNOWN
+    else:
+      value = self._externals_state.Lookup(path, prev_rev)
+    if value is externals.UNKNOWN:
+      return externals.FromRev(self.repo, prev_rev, path, self.externals_map)
+    elif value:
+      return externals.Parse(self.repo, prev_rev, path, value,
+                             self.externals_map)
+    else:
+      return {}
+
+  def _IsExcludedNode(self, record):
+    """Will _FilterRecord drop this Record without looking at its text?"""
+    return ('Node-path' in record.headers
+            and self.paths.IsExcluded(record.headers['Node-path']))
 
   def _FilterRev(self, revhdr, contents):
     """Filter all Records in a revision."""
@@ -350,12 +1356,10 @@ class Filter(object):
 
     new_contents = []
     for record in contents:
-      # Skip actions specified in drop_actions
-      if (revision_number in self.drop_actions
-          and record.headers['Node-path']
-          in self.drop_actions[revision_number]):
+      if self._IsDroppedAction(revision_number, record):
         continue
-      new_contents.extend(self._FilterRecord(revision_number, record))
+      new_contents.extend(
+          _IterRecords(self._FilterRecord(revision_number, record)))
 
     self._FlattenMultipleActions(revision_number, new_contents)
 
@@ -365,13 +1369,23 @@ class Filter(object):
 
     # Property removal must occur after all artificially generated Records have
     # been added to ensure we have a chance to remove their properties.
+    self._DeleteProperties(new_contents)
+
+    return new_contents
+
+  def _IsDroppedAction(self, revision_number, record):
+    """Is this Record one of the actions specified in drop_actions?"""
+    return (revision_number in self.drop_actions
+            and record.headers['Node-path']
+            in self.drop_actions[revision_number])
+
+  def _DeleteProperties(self, records):
+    """Delete the properties in delete_properties from Records."""
     if self.delete_properties:
-      for record in new_contents:
+      for record in records:
         for prop in self.delete_properties:
           record.DeleteProperty(prop)
 
-    return new_contents
-
   def _FilterRecord(self, revision_number, record):
     """Filter a single Record by path; import dangling copies and externals.
 
@@ -380,7 +1394,7 @@ class Filter(object):
       record: a Record
 
     Returns:
-      a list of zero or more Records
+      a list of zero or more Records and _Expansions
 
     An util.PathFilter is used to filter out excluded paths. Paths determined
     to be potential PARENTs of included paths are forced to be propertyless
@@ -420,17 +1434,43 @@ class Filter(object):
     else:
       copyless_records = (record,)
 
+    # Internalizing externals is enabled if externals_map is populated
+    if not self.externals_map:
+      return list(copyless_records)
     output = []
     for copyless_record in copyless_records:
-      # Internalizing externals is enabled if externals_map is populated
-      if not self.externals_map or copyless_record.DoesNotAffectExternals():
-        # Externals are not affected or internalizing externals is not enabled
+      if isinstance(copyless_record, _Expansion):
+        # Any copied Record may set svn:externals
+        output.append(_Expansion(
+            copyless_record.root,
+            self._IterInternalized(revision_number, copyless_record.records)))
+      elif copyless_record.DoesNotAffectExternals():
+        # Externals are not affected
         output.append(copyless_record)
       else:
         output.extend(
             self._InternalizeExternals(revision_number, copyless_record))
     return output
 
+  def _IterInternalized(self, revision_number, records):
+    """Generate copied Records along with the externals they internalize.
+
+    Args:
+      revision_number: the number of the revision being operated on
+      records: an iterator of the Records of a copied tree
+
+    _InternalizeExternals is only called for each Record as it is generated,
+    so the tree is never held in memory. It only looks up externals as of the
+    previous revision, so it does not matter how late that is.
+    """
+    for record in records:
+      if record.DoesNotAffectExternals():
+        yield record
+      else:
+        for internalized in _IterRecords(
+            self._InternalizeExternals(revision_number, record)):
+          yield internalized
+
   def _FixCopyFrom(self, record):
     """Replace copies from excluded paths with adds.
 
@@ -438,16 +1478,20 @@ class Filter(object):
      record: a Record that represents a copy operation
 
     Returns:
-      a list of one or more Records
+      a list of one or more Records and _Expansions
 
-    For a longer discussion, see svndump.MakeRecordsFromPath.
+    Copies from included paths are also replaced if their trees contain
+    excluded paths (see _CopyHasExcludes).
+
+    For a longer discussion, see svndump.IterRecordsFromPath.
     """
     # Is the copy valid given our path filters?
     srcrev = int(record.headers['Node-copyfrom-rev'])
     srcpath = record.headers['Node-copyfrom-path']
     dstpath = record.headers['Node-path']
 
-    if self.paths.IsIncluded(srcpath):
+    if (self.paths.IsIncluded(srcpath)
+        and not self._CopyHasExcludes(srcrev, srcpath, dstpath)):
       # Copy is valid, leave it as is.
       return (record,)
 
@@ -465,8 +1509,9 @@ class Filter(object):
     output = []
     if self.paths.IsIncluded(dstpath):
       # The entire destination path is included, grab it all!
-      output.extend(svndump.MakeRecordsFromPath(self.repo, srcrev, srcpath,
-                                                dstpath, svndump.Record.COPY))
+      output.append(_Expansion(dstpath, svndump.IterRecordsFromPath(
+          self.repo, srcrev, srcpath, dstpath, svndump.Record.COPY,
+          self._prune)))
     else:
       # The destination itself is not included, but some included paths may
       # be created by this copy operation
@@ -476,12 +1521,15 @@ class Filter(object):
         output.append(svndump.Record(kind='dir', action='add', path=dir_name,
                                      source=svndump.Record.COPY))
       for dir_name in recursive_dirs:
-        output.extend(svndump.MakeRecordsFromPath(self.repo,
-                                                  srcrev,
-                                                  srcpath + '/' + dir_name,
-                                                  dstpath + '/' + dir_name,
-                                                  svndump.Record.COPY))
-    if record.text is not None:
+        output.append(_Expansion(dstpath + '/' + dir_name,
+                                 svndump.IterRecordsFromPath(
+                                     self.repo,
+                                     srcrev,
+                                     srcpath + '/' + dir_name,
+                                     dstpath + '/' + dir_name,
+                                     svndump.Record.COPY,
+                                     self._prune)))
+    if record.HasText():
       # This was a copyfrom _plus_ some sort of
       # delta or new contents, which means that
       # having done the copy we now also need a
@@ -503,7 +1551,8 @@ class Filter(object):
 
     Returns:
       a list of Records including the original Record passed in and any Records
-      generated in order to pull in externals
+      generated in order to pull in externals; trees pulled in from other
+      repositories are _Expansions
 
     Triggered by --externals-map
     """
@@ -511,23 +1560,13 @@ class Filter(object):
     output = [record]
     # Get the root of the externals
     path = record.headers['Node-path']
-    # Parse the new value of svn:externals
-    if record.props.get('svn:externals'):
-      # TODO: change svn:externals to exclude the externals being
-      # internalized.
-      # The property is set
-      new_externals = externals.Parse(
-          self.repo, revision_number, path,
-          record.props['svn:externals'], self.externals_map)
+    prefetched = self._TakePrefetched(revision_number, record)
+    if prefetched is not None:
+      prev_externals, new_externals, diffs, trees = prefetched
     else:
-      # The property is absent or it is set to None, signifying it is being
-      # deleted with Props-delta: true. Therefore we must check if the previous
-      # revision has any externals that we should delete.
-      new_externals = {}
-    # Get the previous value of svn:externals
-    prev_rev = revision_number - 1
-    prev_externals = externals.FromRev(self.repo, prev_rev, path,
-                                       self.externals_map)
+      prev_externals, new_externals = self._ParseExternals(revision_number,
+                                                           record)
+      diffs = trees = {}
     # Check how the externals descriptions have changed since last revision
     added, changed, deleted = externals.Diff(prev_externals, new_externals)
     LOGGER.debug('Changed externals for %s\n'
@@ -558,7 +1597,9 @@ class Filter(object):
       if new.srcrev is None:
         LOGGER.warning('Can\'t guess rev # for external repo %s', new)
         continue
-      output.extend(self._ApplyExternalsChange(path, old, new))
+      output.extend(self._ApplyExternalsChange(
+          path, old, new,
+          diffs.get((old.srcpath, old.srcrev, new.srcpath, new.srcrev))))
     # Delete former externals paths
     for description in deleted:
       # TODO: if dstpath contains '/', introspect the source
@@ -590,51 +1631,97 @@ class Filter(object):
           LOGGER.warning('Can\'t guess rev # for externals repo %s',
                          description)
           continue
-        output.extend(
-            svndump.MakeRecordsFromPath(description.srcrepo,
-                                        description.srcrev,
-                                        description.srcpath,
-                                        path + '/' + description.dstpath,
-                                        svndump.Record.EXTERNALS))
+        nodes = trees.get((description.srcrepo, description.srcrev,
+                           description.srcpath))
+        if nodes is None:
+          records = svndump.IterRecordsFromPath(
+              description.srcrepo,
+              description.srcrev,
+              description.srcpath,
+              path + '/' + description.dstpath,
+              svndump.Record.EXTERNALS,
+              self._prune)
+        else:
+          # The tree was walked by a prefetch worker
+          records = svndump.IterRecordsFromNodes(
+              description.srcrepo,
+              description.srcrev,
+              description.srcpath,
+              path + '/' + description.dstpath,
+              svndump.Record.EXTERNALS,
+              nodes,
+              self._prune)
+        output.append(_Expansion(path + '/' + description.dstpath, records))
     return output
 
-  def _ApplyExternalsChange(self, path, old, new):
+  def _ParseExternals(self, revision_number, record):
+    """Parse the externals defined by a Record and before it.
+
+    Args:
+      revision_number: the number of the revision being operated on
+      record: a Record with an svn:externals property to be fixed
+
+    Returns:
+      a tuple (prev_externals, new_externals) of dicts mapping path to
+      ExternalsDescription, for the previous revision and for the Record
+    """
+    path = record.headers['Node-path']
+    # Parse the new value of svn:externals
+    if record.props.get('svn:externals'):
+      # TODO: change svn:externals to exclude the externals being
+      # internalized.
+      # The property is set
+      new_externals = externals.Parse(
+          self.repo, revision_number, path,
+          record.props['svn:externals'], self.externals_map)
+    else:
+      # The property is absent or it is set to None, signifying it is being
+      # deleted with Props-delta: true. Therefore we must check if the previous
+      # revision has any externals that we should delete.
+      new_externals = {}
+    # Get the previous value of svn:externals
+    prev_externals = self._PreviousExternals(revision_number, path)
+    return prev_externals, new_externals
+
+  def _ApplyExternalsChange(self, path, old, new, paths_changed=None):
     """Make Records to simulate the change from old to new ExternalsDescription.
 
     Args:
       path: the path on which the svn:externals property is set
       old: the ExternalsDescription from the previous revision
       new: an ExternalsDescription from the new revision
+      paths_changed: the result of svn_util.Diff for old and new, if it was
+                     prefetched
 
     Returns:
       a list of zero or more Records that convert the contents of the path
       referenced by old into the contents of the path referenced by new
 
     Raises:
-      RuntimeError: if unsupported operations are shown in the svn diff output
+      RuntimeError: if unsupported operations are returned by svn_util.Diff
 
     This is only possible if both descriptions refer to the same repository.
 
-    Diff is called to find out which paths have changed, whether their
-    properties, contents, or both have changed, and whether each path is a file
-    or a directory. Records are generated to perform all deletes, then
-    svndump.MakeRecordsFromPath is called to get Records creating the new state.
-    The resulting Records are filtered through the list of changes, changing the
-    action from add to change and deleting the properties or text content blocks
-    if only the other is being changed. Records for paths listed as adds are
-    passed through unchanged and Records not mentioned as deleted, changed, or
-    added are dropped.
+    svn_util.Diff is called to find out which paths have changed and whether
+    their properties, contents, or both have changed. Records are generated to
+    perform all deletes, then a Record is made for each path that was added or
+    changed. Only the parts of a node that changed are read from the
+    repository: the text of files whose contents were added or modified and
+    the properties of nodes that were added or had their properties modified.
+    The cost therefore depends on the size of the change rather than the size
+    of the external.
     """
     # Sanity check
     assert old.srcrepo == new.srcrepo
     output = []
 
     # Get a list of changes between the old and new revisions
-    paths_changed = svn_util.Diff(new.srcrepo,
-                                  old.srcpath,
-                                  old.srcrev,
-                                  new.srcpath,
-                                  new.srcrev)
+    if paths_changed is None:
+      paths_changed = svn_util.Diff(new.srcrepo,
+                                    old.srcpath,
+                                    old.srcrev,
+                                    new.srcpath,
+                                    new.srcrev)
 
     # If nothing changed, we're done
     if not paths_changed:
@@ -651,47 +1738,101 @@ class Filter(object):
             action='delete',
             source=svndump.Record.EXTERNALS))
 
-    # Grab Records to create the new version
-    add_records = svndump.MakeRecordsFromPath(new.srcrepo,
-                                              new.srcrev,
-                                              new.srcpath,
-                                              path + '/' + new.dstpath,
-                                              svndump.Record.EXTERNALS)
-
-    # Filter the Records to create a change instead of an add
-    for add_record in add_records:
-      record_path = add_record.headers['Node-path']
-      # Strip off the dstpath
-      record_path = record_path[len(path) + len(new.dstpath) + 2:]
-      # Check if the path changed
-      if record_path not in paths_changed:
-        # Ignore paths that haven't changed
+    # Make Records for adds and changes, parents before children
+    dstroot = path + '/' + new.dstpath
+    pruned = {}
+    for chpath in sorted(paths_changed):
+      contents_op, props_op = paths_changed[chpath]
+      if contents_op == 'delete':
         continue
-
-      # Find out what changed
-      contents_op, props_op = paths_changed[record_path]
-
-      # Handle contents_op
-      if contents_op == 'add':
-        # If it's an add, pass through unchanged
-        pass
-      elif contents_op == 'modify':
-        add_record.headers['Node-action'] = 'change'
-      elif contents_op is None:
-        # Drop text contents - they haven't changed
-        add_record.text = None
+      elif contents_op == 'add':
+        action = 'add'
+      elif contents_op in ('modify', None):
+        action = 'change'
       else:
-        raise RuntimeError('Unexpected contents operation %s in svn diff'
+        raise RuntimeError('Unexpected contents operation %s in diff'
                            % contents_op)
+      if self._IsPrunedExternal(dstroot, chpath, pruned):
+        continue
+      if new.srcpath and chpath:
+        srcpath = new.srcpath + '/' + chpath
+      else:
+        srcpath = new.srcpath or chpath
+      output.append(svndump.MakeRecordFromNode(
+          new.srcrepo,
+          new.srcrev,
+          srcpath,
+          (dstroot + '/' + chpath) if chpath else dstroot,
+          svndump.Record.EXTERNALS,
+          action=action,
+          text=contents_op is not None,
+          props=contents_op == 'add' or props_op is not None))
+    return output
 
-      # Handle props_op
-      if props_op is None and contents_op != 'add':
-        # Drop props - they haven't changed
-        add_record.props = None
+  def _IsPrunedExternal(self, dstroot, chpath, pruned):
+    """Check whether a path in an external is excluded by the path filter.
 
-      # This Record has lived to see another day...
-      output.append(add_record)
-    return output
+    Args:
+      dstroot: the path that the external is internalized to
+      chpath: a path relative to dstroot
+      pruned: a dict {chpath: bool} of answers already given for this
+              external, which is updated
+
+    Returns:
+      True if the path or any of its parents within the external is excluded,
+      like the subtrees skipped by svndump.IterRecordsFromPath
+    """
+    if self._prune is None:
+      return False
+    try:
+      return pruned[chpath]
+    except KeyError:
+      pass
+    if chpath:
+      parent = chpath.rpartition('/')[0]
+      result = (self._IsPrunedExternal(dstroot, parent, pruned)
+                or self._prune(dstroot + '/' + chpath))
+    else:
+      result = self._prune(dstroot)
+    pruned[chpath] = result
+    return result
+
+  def _CopyHasExcludes(self, srcrev, srcpath, dstpath):
+    """Does a copy of an included path involve excluded paths?
+
+    Args:
+      srcrev: source revision
+      srcpath: source path
+      dstpath: destination path
+
+    Returns:
+      True if a node of the copied tree is excluded at its source path (so it
+      is missing from the filtered source) or at its destination path (so the
+      copy must not bring it along)
+
+    Such a copy cannot be kept as a copy and has to be turned into adds. Only
+    the parts of the tree in which an exclude pattern could match are walked.
+    """
+    if not self.paths.HasExcludes():
+      return False
+    found = []
+
+    def Visit(path, unused_kind):
+      if found:
+        return False
+      may_exclude = False
+      for root in (srcpath, dstpath):
+        full_path = (root + '/' + path) if path else root
+        if self.paths.IsExcluded(full_path):
+          found.append(full_path)
+          return False
+        may_exclude = may_exclude or self.paths.MayExcludeBelow(full_path)
+      return may_exclude
+
+    # The trie alone may show that no exclude pattern can match in the tree
+    if Visit('', 'dir'):
+      svn_util.WalkTree(self.repo, srcrev, srcpath, Visit)
+    return bool(found)
 
   def _FilterPaths(self, srcrev, srcpath, dstpath):
     """Determine paths to import, either recursively or as empty directories.
@@ -719,25 +1860,9 @@ class Filter(object):
     should be copied recursively, and which should be discarded in order to get
     the correct contents of trunk/foo after the copy.
     """
-    empty_dirs = []
-    recursive_dirs = []
-    # Get a list of paths
-    paths = svn_util.ExtractNodeKinds(self.repo, srcrev, srcpath)
-    # Sort to ensure directories come before their children
-    for path in sorted(paths):
-      full_path = dstpath + '/' + path if path else dstpath
-      interest = self.paths.CheckPath(full_path)
-      if interest is util.PathFilter.PARENT:
-        empty_dirs.append(path)
-      elif interest is util.PathFilter.YES:
-        include_me = True
-        for parent_dir in recursive_dirs:
-          if path.startswith(parent_dir + '/'):
-            include_me = False
-            break
-        if include_me:
-          recursive_dirs.append(path)
-    return empty_dirs, recursive_dirs
+    return _PlanCopy(self.paths, dstpath,
+                     functools.partial(svn_util.WalkTree, self.repo, srcrev,
+                                       srcpath))
 
   def _FlattenMultipleActions(self, revision_number, contents):
     """Fix multiple actions for a single path in one revision.
@@ -801,15 +1926,19 @@ class Filter(object):
       svn:externals property in the same revision (so Subversion does not know
       that the delete must preceed the property change).
     """
-    paths = collections.defaultdict(list)
+    paths = collections.defaultdict(collections.deque)
     for record in contents:
       path = record.headers['Node-path']
       paths[path].append(record)
+    if len(paths) == len(contents):
+      return  # One action per path
+    indexed = _IndexedRecords(contents)
     for path, records in paths.iteritems():
       while len(records) > 1:
-        data = self._ActionPairFlattener(self.repo, revision_number, contents,
+        data = self._ActionPairFlattener(self.repo, revision_number, indexed,
                                          path, records)
         data.Flatten()
+    contents[:] = indexed
 
   class _ActionPairFlattener(object):
     """Helper for _FlattenMultipleActions."""
@@ -820,9 +1949,9 @@ class Filter(object):
       Args:
         repo: the source repo of the dump file being filtered
         revision_number: the revision currently being filtered
-        contents: a list of all Records in the current revision
+        contents: an _IndexedRecords of all Records in the current revision
         path: the path whose actions are to be flattened
-        records: a list of all Records in the current revision for path
+        records: a deque of all Records in the current revision for path
 
       self.first and self.second are set to the first two items in records for
       convenience.
@@ -841,13 +1970,15 @@ class Filter(object):
       This function delegates to a number of helpers to do the action merge,
       depending on the types of the two actions. Each helper must be careful to
       make the appropriate changes to self.contents and self.records:
-      - self.contents is the actual list of Records that will be output for the
+      - self.contents holds the actual Records that will be output for the
         current revision. If a Record is deleted or the order is changed, that
         modification must be made to self.contents.
-      - self.records is the list of all Records for the same path. If a Record
+      - self.records is the deque of all Records for the same path. If a Record
         is deleted or the order is changed, that modification must also be made
         to self.records so that merging can proceed in the correct order, and
         without trying to merge the same two Records again.
+      Both changes take constant time, so flattening stays linear in the size
+      of the revision.
 
       Raises:
         UnsupportedActionPair: if an action pair is encountered for which no
@@ -883,27 +2014,28 @@ class Filter(object):
     def DropExtraneousAdd(self):
       LOGGER.warning('Found (add,add) - deleting first for path %s in r%s',
                      self.path, self.revision_number)
-      self.contents.remove(self.first)
-      self.records.remove(self.first)
+      self.contents.Remove(self.first)
+      self.records.popleft()
 
     def MergeChange(self, first_action):
       """Apply a change action to an add|change|replace for the same path."""
       LOGGER.warning('Found (%s, change) - merging for path %s in r%s',
                      first_action, self.path, self.revision_number)
-      if self.second.text is not None:
+      if self.second.HasText():
         if self.second.headers.get('Text-delta', 'false') == 'true':
           raise UnsupportedActionPair('Cannot merge (%s, change) when'
                                       ' Text-delta is set to true for path %s'
                                       ' in r%s'
                                       % (first_action, self.path,
                                          self.revision_number))
-        self.first.text = self.second.text
+        self.first.CopyTextFrom(self.second)
         self.first.DeleteHeader('Text-delta')
-        new_md5 = self.second.headers.get('Text-content-md5')
-        if new_md5:
-          self.first.headers['Text-content-md5'] = new_md5
-        else:
-          self.first.DeleteHeader('Text-content-md5')
+        for header in ('Text-content-md5', 'Text-content-sha1'):
+          new_checksum = self.second.headers.get(header)
+          if new_checksum:
+            self.first.headers[header] = new_checksum
+          else:
+            self.first.DeleteHeader(header)
       if self.second.props is not None:
         if self.first.props is None:
           self.first.props = self.second.props
@@ -916,8 +2048,9 @@ class Filter(object):
                 del self.first.props[key]
         else:
           self.first.props = self.second.props
-      self.contents.remove(self.second)
-      self.records.remove(self.second)
+      self.contents.Remove(self.second)
+      self.records.popleft()
+      self.records[0] = self.first
 
     def MoveDeleteToBeforeAdd(self):
       """Move a delete action to before an add for the same path."""
@@ -925,9 +2058,8 @@ class Filter(object):
                      ' moving the delete before the add for path %s in r%s',
                      self.path, self.revision_number)
       # Remove the delete Record, then insert it before the add.
-      self.contents.remove(self.second)
-      index = self.contents.index(self.first)
-      self.contents.insert(index, self.second)
+      self.contents.Remove(self.second)
+      self.contents.InsertBefore(self.second, self.first)
       # Reprocess this as (delete, add) by putting them back on the deque
       # in the new order. self.first and self.second are convenience copies of
       # self.records[0] and self.records[1] so we can rearrange them easily.
@@ -937,17 +2069,17 @@ class Filter(object):
     def DropAddDeletePair(self):
       LOGGER.warning('Found (add, delete) - dropping both for path %s in r%s',
                      self.path, self.revision_number)
-      self.contents.remove(self.first)
-      self.contents.remove(self.second)
-      self.records.remove(self.first)
-      self.records.remove(self.second)
+      self.contents.Remove(self.first)
+      self.contents.Remove(self.second)
+      self.records.popleft()
+      self.records.popleft()
 
     def ConvertDeleteAndAddIntoReplace(self):
       LOGGER.warning('Converting (del, add) to replace for path %s in r%s',
                      self.path, self.revision_number)
       self.second.headers['Node-action'] = 'replace'
-      self.contents.remove(self.first)
-      self.records.remove(self.first)
+      self.contents.Remove(self.first)
+      self.records.popleft()
 
 
 def main(argv):
@@ -968,6 +2100,27 @@ def main(argv):
                       metavar='REGEXP',
                       help='Only include paths that match this regular'
                       ' expression (may be used multiple times).')
+  parser.add_argument('--include-from',
+                      action='append',
+                      default=[],
+                      type=file,
+                      metavar='FILE',
+                      help='Read --include regular expressions from a file, one'
+                      ' per line (may be used multiple times).')
+  parser.add_argument('--exclude',
+                      action='append',
+                      default=[],
+                      metavar='REGEXP',
+                      help='Exclude paths that match this regular expression,'
+                      ' even if they are included (may be used multiple'
+                      ' times).')
+  parser.add_argument('--exclude-from',
+                      action='append',
+                      default=[],
+                      type=file,
+                      metavar='FILE',
+                      help='Read --exclude regular expressions from a file, one'
+                      ' per line (may be used multiple times).')
   parser.add_argument('--repo',
                       metavar='PATH',
                       help='Path of the SVN repo that produced the dump file.')
@@ -977,6 +2130,11 @@ def main(argv):
                       help='File mapping URLs used to reference externals to'
                       ' path of local copy of referenced repository. Format is'
                       ' one local path per line:  PATH [URL [URL ...]].')
+  parser.add_argument('--externals-cache',
+                      metavar='FILE',
+                      help='Remember in this file which locations referenced'
+                      ' by externals exist, so that later runs do not have to'
+                      ' look them up again.')
   parser.add_argument('--delete-property',
                       action='append',
                       metavar='PROPNAME',
@@ -1014,6 +2172,57 @@ def main(argv):
                       ' revision numbers. This should only be used when'
                       ' filtering the entire history at once, e.g. not using'
                       ' the -r option of svnadmin dump or svnrdump.')
+  parser.add_argument('--buffer-revisions',
+                      action='store_true',
+                      help='Read each revision into memory before filtering it'
+                      ' instead of streaming it. Only needed for dump files'
+                      ' that list the actions for a path far apart within a'
+                      ' revision.')
+  parser.add_argument('--memory-budget',
+                      type=int,
+                      metavar='MB',
+                      help='Keep at most this many megabytes of file contents'
+                      ' in memory while a revision is held back; the rest is'
+                      ' moved to a temporary file (default is no limit).')
+  parser.add_argument('--mmap',
+                      action='store_true',
+                      help='Memory-map the dump file instead of reading it.'
+                      ' Text content is passed through to the output without'
+                      ' being copied. Requires stdin to be a regular file,'
+                      ' not a pipe.')
+  parser.add_argument('--write-buffer-size',
+                      type=int,
+                      default=svndump.WRITE_BUFFER_SIZE >> 10,
+                      metavar='KB',
+                      help='Collect this many kilobytes of output before'
+                      ' writing it (default is %(default)s).')
+  parser.add_argument('--checksum-threads',
+                      type=int,
+                      default=2,
+                      metavar='N',
+                      help='Compute missing checksums of large files on this'
+                      ' many threads while filtering continues, or 0 to'
+                      ' compute them on the main thread (default is'
+                      ' %(default)s).')
+  parser.add_argument('--pipeline',
+                      action='store_true',
+                      help='Read and write on separate threads while filtering,'
+                      ' and report how long each stage waited for the others.')
+  parser.add_argument('--prefetch-externals',
+                      type=int,
+                      default=0,
+                      metavar='REVS',
+                      help='With --externals-map, read this many revisions'
+                      ' ahead and fetch the externals they change from the'
+                      ' repositories in worker processes while filtering'
+                      ' continues (default is %(default)s, to fetch them when'
+                      ' they are needed).')
+  parser.add_argument('--prefetch-workers',
+                      type=int,
+                      default=PREFETCH_WORKERS,
+                      metavar='N',
+                      help='Number of worker processes used by'
+                      ' --prefetch-externals (default is %(default)s).')
   parser.add_argument('--debug', action='store_true',
                       help='Log verbosely to stderr.')
 
@@ -1069,18 +2278,56 @@ def main(argv):
   else:
     force_delete = None
 
+  if options.mmap:
+    try:
+      input_stream = svndump.MapFile(sys.stdin)
+    except (EnvironmentError, ValueError) as e:
+      parser.error('--mmap requires a regular file on stdin: %s' % e)
+  else:
+    input_stream = sys.stdin
+
+  includes = list(options.include)
+  for pattern_file in options.include_from:
+    includes.extend(util.ReadPatterns(pattern_file))
+    pattern_file.close()
+  excludes = list(options.exclude)
+  for pattern_file in options.exclude_from:
+    excludes.extend(util.ReadPatterns(pattern_file))
+    pattern_file.close()
+  if excludes and not options.repo:
+    # Copies of included trees are checked for excluded paths in the repo
+    parser.error('--exclude and --exclude-from require --repo')
+
   # Create a Filter
   filt = Filter(os.path.abspath(options.repo) if options.repo else None,
-                util.PathFilter(options.include),
+                util.PathFilter(includes, excludes),
+                input_stream=input_stream,
                 drop_empty_revs=options.drop_empty_revs,
                 revmap=revmap,
                 externals_map=externals_map,
                 delete_properties=options.delete_property,
                 truncate_revs=options.truncate_rev,
                 drop_actions=drop_actions,
-                force_delete=force_delete)
-
-  filt.Filter()
+                force_delete=force_delete,
+                buffer_revisions=options.buffer_revisions,
+                memory_budget=(options.memory_budget << 20
+                               if options.memory_budget is not None else None),
+                write_buffer_size=options.write_buffer_size << 10,
+                checksum_threads=options.checksum_threads,
+                pipeline=options.pipeline,
+                prefetch_revisions=options.prefetch_externals,
+                prefetch_workers=options.prefetch_workers)
+
+  if options.externals_cache:
+    externals.OpenSourceExistsCache(options.externals_cache)
+  try:
+    filt.Filter()
+  finally:
+    externals.CloseSourceExistsCache()
+  if filt.pipeline_waits is not None:
+    sys.stderr.write('Time spent waiting: %s\n'
+                     % ', '.join('%s %.1fs' % item
+                                 for item in filt.pipeline_waits.iteritems()))
 
 
 if __name__ == '__main__':
@@ -8,18 +8,418 @@
 
 from __future__ import absolute_import
 
+import collections
+import io
+import os
+import shutil
+import StringIO
+import tempfile
+import threading
 import unittest
 
 import mock
 
 from svndumpmultitool import svndump
 from svndumpmultitool import svndumpmultitool_cli as svndumpmultitool
+from svndumpmultitool import test_utils
 from svndumpmultitool import util
 
 # Static data
 MAIN_REPO = '/svn/zoo'
 MAIN_REPO_REV = 5
 
+DUMP_HEADER = ('SVN-fs-dump-format-version: 2\n\n'
+               'UUID: 00000000-0000-0000-0000-000000000000\n\n')
+
+
+def _Revision(number):
+  return ('Revision-number: %d\n'
+          'Prop-content-length: 10\n'
+          'Content-length: 10\n\n'
+          'PROPS-END\n\n' % number)
+
+
+def _FileAdd(path, text):
+  return ('Node-path: %s\n'
+          'Node-kind: file\n'
+          'Node-action: add\n'
+          'Text-content-length: %d\n'
+          'Text-content-md5: 0123456789abcdef0123456789abcdef\n'
+          'Content-length: %d\n\n'
+          '%s\n\n' % (path, len(text), len(text), text))
+
+
+class _PipeStream(io.BytesIO):
+  """A stream that can't seek, like stdin when it is a pipe."""
+
+  def tell(self):
+    raise IOError('Illegal seek')
+
+  def seek(self, *unused_args):
+    raise IOError('Illegal seek')
+
+
+class FilterFilterTest(unittest.TestCase):
+  DUMP = (DUMP_HEADER
+          + _Revision(1)
+          + _FileAdd('trunk/foo/kept', 'kept text')
+          + _FileAdd('trunk/bar/dropped', 'dropped text')
+          + _Revision(2)
+          + _FileAdd('trunk/bar/dropped2', 'more dropped text'))
+
+  def RunFilter(self, input_stream, paths=None, **kwargs):
+    output_stream = StringIO.StringIO()
+    if paths is None:
+      paths = util.PathFilter(['trunk/foo'])
+    filt = svndumpmultitool.Filter(MAIN_REPO, paths,
+                                   input_stream=input_stream,
+                                   output_stream=output_stream,
+                                   **kwargs)
+    filt.Filter()
+    return output_stream.getvalue()
+
+  def testSeekable(self):
+    output = self.RunFilter(StringIO.StringIO(self.DUMP))
+    self.assertEqual(output, (DUMP_HEADER
+                              + _Revision(1)
+                              + _FileAdd('trunk/foo/kept', 'kept text')))
+
+  def testPipe(self):
+    output = self.RunFilter(_PipeStream(self.DUMP))
+    self.assertEqual(output, (DUMP_HEADER
+                              + _Revision(1)
+                              + _FileAdd('trunk/foo/kept', 'kept text')))
+
+  def testExclude(self):
+    output = self.RunFilter(StringIO.StringIO(self.DUMP),
+                            paths=util.PathFilter([], ['trunk/bar']))
+    self.assertEqual(output, (DUMP_HEADER
+                              + _Revision(1)
+                              + _FileAdd('trunk/foo/kept', 'kept text')))
+
+  def testRenumberRevs(self):
+    dump = self.DUMP + _Revision(3) + _FileAdd('trunk/foo/new', 'new text')
+    revmap = {}
+    output = self.RunFilter(_PipeStream(dump), revmap=revmap)
+    self.assertEqual(output, (DUMP_HEADER
+                              + _Revision(1)
+                              + _FileAdd('trunk/foo/kept', 'kept text')
+                              + _Revision(2)
+                              + _FileAdd('trunk/foo/new', 'new text')))
+    self.assertEqual(revmap, {1: 1, 2: 1, 3: 2})
+
+  def testBufferRevisions(self):
+    output = self.RunFilter(_PipeStream(self.DUMP), buffer_revisions=True)
+    self.assertEqual(output, (DUMP_HEADER
+                              + _Revision(1)
+                              + _FileAdd('trunk/foo/kept', 'kept text')))
+
+  def testMemoryBudget(self):
+    for buffer_revisions in (False, True):
+      output = self.RunFilter(_PipeStream(self.DUMP), memory_budget=4,
+                              buffer_revisions=buffer_revisions)
+      self.assertEqual(output, (DUMP_HEADER
+                                + _Revision(1)
+                                + _FileAdd('trunk/foo/kept', 'kept text')))
+
+  def testSmallWriteBuffer(self):
+    output = self.RunFilter(_PipeStream(self.DUMP), write_buffer_size=16)
+    self.assertEqual(output, (DUMP_HEADER
+                              + _Revision(1)
+                              + _FileAdd('trunk/foo/kept', 'kept text')))
+
+  def testPipeline(self):
+    for input_stream in (StringIO.StringIO(self.DUMP),
+                         _PipeStream(self.DUMP)):
+      output = self.RunFilter(input_stream, pipeline=True, pipeline_depth=1)
+      self.assertEqual(output, (DUMP_HEADER
+                                + _Revision(1)
+                                + _FileAdd('trunk/foo/kept', 'kept text')))
+
+  @mock.patch.object(svndumpmultitool, 'PIPELINE_BATCH', 1)
+  def testPipelineWaits(self):
+    output_stream = StringIO.StringIO()
+    filt = svndumpmultitool.Filter(MAIN_REPO, util.PathFilter(['trunk/foo']),
+                                   input_stream=_PipeStream(self.DUMP),
+                                   output_stream=output_stream,
+                                   pipeline=True)
+    filt.Filter()
+    self.assertEqual(filt.pipeline_waits.keys(),
+                     ['reader', 'filter', 'writer'])
+    self.assertEqual(output_stream.getvalue(),
+                     (DUMP_HEADER
+                      + _Revision(1)
+                      + _FileAdd('trunk/foo/kept', 'kept text')))
+
+  def testPipelineMapsRegularFile(self):
+    with tempfile.TemporaryFile() as input_stream:
+      input_stream.write(self.DUMP)
+      input_stream.seek(0)
+      with mock.patch.object(svndump, 'RecordScanner') as scanner:
+        output = self.RunFilter(input_stream, pipeline=True)
+    self.assertFalse(scanner.called)
+    self.assertEqual(output, (DUMP_HEADER
+                              + _Revision(1)
+                              + _FileAdd('trunk/foo/kept', 'kept text')))
+
+  def testPipelineMemory(self):
+    output = self.RunFilter(_PipeStream(self.DUMP), pipeline=True,
+                            pipeline_memory=1)
+    self.assertEqual(output, (DUMP_HEADER
+                              + _Revision(1)
+                              + _FileAdd('trunk/foo/kept', 'kept text')))
+
+  def testPipelineReadError(self):
+    with self.assertRaises(EOFError):
+      self.RunFilter(_PipeStream(self.DUMP[:-10]), pipeline=True)
+
+  @mock.patch.object(svndumpmultitool.mp_pool, 'Pool')
+  def testPrefetchPoolStartsFirst(self, pool):
+    filt = svndumpmultitool.Filter(MAIN_REPO, util.PathFilter(['trunk/foo']),
+                                   input_stream=_PipeStream(self.DUMP),
+                                   output_stream=StringIO.StringIO(),
+                                   externals_map={'file:///svn/lib': '/lib'},
+                                   prefetch_revisions=1, pipeline=True)
+    def StartThread(*unused_args):
+      self.assertTrue(pool.called)
+      raise RuntimeError('no more threads')
+    with mock.patch.object(svndumpmultitool, '_StartThread', StartThread):
+      with mock.patch.object(filt, '_writer') as writer:
+        with self.assertRaises(RuntimeError):
+          filt.Filter()
+    # Torn down despite the error
+    pool.return_value.terminate.assert_called_once_with()
+    writer.Close.assert_called_once_with()
+
+  def testKeepEmptyRevs(self):
+    output = self.RunFilter(_PipeStream(self.DUMP), drop_empty_revs=False)
+    self.assertEqual(output, (DUMP_HEADER
+                              + _Revision(1)
+                              + _FileAdd('trunk/foo/kept', 'kept text')
+                              + _Revision(2)))
+
+
+class FilterStreamRevTest(unittest.TestCase):
+  def setUp(self):
+    self.output = StringIO.StringIO()
+    # Without a write buffer, output_sizes shows when Records are written
+    self.filter = svndumpmultitool.Filter(MAIN_REPO, util.PathFilter([]),
+                                          output_stream=self.output,
+                                          write_buffer_size=0)
+    self.filter._revhdr = svndump.Record()
+    self.filter._revhdr.headers['Revision-number'] = '1'
+    self.output_sizes = []
+
+  def Reader(self, records):
+    """Make a read_record function that notes the output size at each call."""
+    records = iter(records)
+
+    def ReadRecord(discard_text=None):
+      self.output_sizes.append(self.output.tell())
+      return next(records, None)
+
+    return ReadRecord
+
+  def Paths(self):
+    return [line[len('Node-path: '):] for line
+            in self.output.getvalue().split('\n')
+            if line.startswith('Node-path: ')]
+
+  def testRecordsAreWrittenAsTheyAreRead(self):
+    records = [svndump.Record(path='a', action='add', kind='dir'),
+               svndump.Record(path='b', action='add', kind='dir'),
+               svndump.Record(path='c', action='add', kind='dir')]
+    self.assertIsNone(self.filter._StreamRev(1, self.Reader(records)))
+    self.assertEquals(self.Paths(), ['a', 'b', 'c'])
+    # Nothing is written before 'b' is read, then one Record at a time
+    self.assertEquals(self.output_sizes[:2], [0, 0])
+    self.assertLess(self.output_sizes[1], self.output_sizes[2])
+    self.assertLess(self.output_sizes[2], self.output_sizes[3])
+
+  def testNextRevisionHeaderIsReturned(self):
+    revhdr = svndump.Record()
+    revhdr.headers['Revision-number'] = '2'
+    records = [svndump.Record(path='a', action='add', kind='dir'), revhdr]
+    self.assertIs(self.filter._StreamRev(1, self.Reader(records)), revhdr)
+    self.assertEquals(self.Paths(), ['a'])
+
+  def testAdjacentActionsAreMerged(self):
+    records = [svndump.Record(path='a', action='delete'),
+               svndump.Record(path='a', action='add', kind='dir')]
+    self.filter._StreamRev(1, self.Reader(records))
+    self.assertEquals(self.Paths(), ['a'])
+    self.assertIn('Node-action: replace', self.output.getvalue())
+
+  def testGeneratedRecordsAreHeldForTheirSubtree(self):
+    def FilterRecord(unused_revision_number, record):
+      if record.headers['Node-path'] == 'a':
+        # Like a copy from an excluded path
+        return [record, svndump.Record(path='a/b', action='add', kind='dir')]
+      return [record]
+
+    records = [svndump.Record(path='a', action='add', kind='dir'),
+               svndump.Record(path='a/b', action='change'),
+               svndump.Record(path='c', action='add', kind='dir')]
+    records[1].SetProperty('foo', 'bar')
+    with mock.patch.object(self.filter, '_FilterRecord',
+                           side_effect=FilterRecord):
+      self.filter._StreamRev(1, self.Reader(records))
+    self.assertEquals(self.Paths(), ['a', 'a/b', 'c'])
+    self.assertNotIn('Node-action: change', self.output.getvalue())
+    self.assertIn('foo', self.output.getvalue())
+
+  def testActionsTooFarApart(self):
+    records = [svndump.Record(path='a', action='delete'),
+               svndump.Record(path='b', action='add', kind='dir'),
+               svndump.Record(path='a', action='add', kind='dir')]
+    with self.assertRaises(svndumpmultitool.UnstreamableRevision):
+      self.filter._StreamRev(1, self.Reader(records))
+
+  def testAddAndChangeTooFarApart(self):
+    records = [svndump.Record(path='a', action='add', kind='file'),
+               svndump.Record(path='b', action='add', kind='dir'),
+               svndump.Record(path='a', action='change', kind='file')]
+    with self.assertRaises(svndumpmultitool.UnstreamableRevision):
+      self.filter._StreamRev(1, self.Reader(records))
+
+  def testActionsOnOnePathAreMerged(self):
+    records = [svndump.Record(path='a', action='delete'),
+               svndump.Record(path='a', action='add', kind='dir'),
+               svndump.Record(path='b', action='add', kind='dir')]
+    self.filter._StreamRev(1, self.Reader(records))
+    self.assertIn('Node-path: b', self.output.getvalue())
+
+  def testSubtreeActionsTooFarApart(self):
+    def FilterRecord(unused_revision_number, record):
+      if record.headers['Node-path'] == 'a':
+        return [record, svndump.Record(path='a/b', action='add', kind='dir')]
+      return [record]
+
+    records = [svndump.Record(path='a', action='add', kind='dir'),
+               svndump.Record(path='c', action='add', kind='dir'),
+               svndump.Record(path='a/b', action='change')]
+    with mock.patch.object(self.filter, '_FilterRecord',
+                           side_effect=FilterRecord):
+      with self.assertRaises(svndumpmultitool.UnstreamableRevision):
+        self.filter._StreamRev(1, self.Reader(records))
+
+  def testExpansionsAreWrittenAsTheyAreGenerated(self):
+    generated = []
+
+    def Generate():
+      for path in ('a/b', 'a/b/c', 'a/b/d'):
+        generated.append(self.output.tell())
+        yield svndump.Record(path=path, action='add', kind='dir')
+
+    def FilterRecord(unused_revision_number, record):
+      if record.headers['Node-path'] == 'a/b' and record.headers[
+          'Node-action'] == 'add':
+        # Like a copy from an excluded path
+        return [svndumpmultitool._Expansion('a/b', Generate())]
+      return [record]
+
+    records = [svndump.Record(path='a/b', action='delete'),
+               svndump.Record(path='a/b', action='add', kind='dir'),
+               svndump.Record(path='a/b/c', action='change'),
+               svndump.Record(path='e', action='add', kind='dir')]
+    records[2].SetProperty('foo', 'bar')
+    with mock.patch.object(self.filter, '_FilterRecord',
+                           side_effect=FilterRecord):
+      self.filter._StreamRev(1, self.Reader(records))
+    self.assertEquals(self.Paths(), ['a/b', 'a/b/c', 'a/b/d', 'e'])
+    output = self.output.getvalue()
+    # Merged with the delete before and the change after the expansion
+    self.assertIn('Node-action: replace', output)
+    self.assertNotIn('Node-action: change', output)
+    self.assertIn('foo', output)
+    # Each Record was written before the next one was generated
+    self.assertLess(generated[0], generated[1])
+    self.assertLess(generated[1], generated[2])
+
+  def testOverlappingExpansionsAreMerged(self):
+    def FilterRecord(unused_revision_number, record):
+      path = record.headers['Node-path']
+      return [svndumpmultitool._Expansion(path, [
+          svndump.Record(path=path, action='add', kind='dir'),
+          svndump.Record(path=path + '/x', action='add', kind='dir')])]
+
+    records = [svndump.Record(path='a', action='add', kind='dir'),
+               svndump.Record(path='a/x', action='add', kind='dir')]
+    with mock.patch.object(self.filter, '_FilterRecord',
+                           side_effect=FilterRecord):
+      self.filter._StreamRev(1, self.Reader(records))
+    # The first add of a/x is dropped in favor of the second
+    self.assertEquals(self.Paths(), ['a', 'a/x', 'a/x/x'])
+
+
+class PlanFlushTest(unittest.TestCase):
+  def Record(self, path, action='add'):
+    return svndump.Record(path=path, action=action, kind='dir')
+
+  def Expansion(self, root, *paths):
+    return svndumpmultitool._Expansion(
+        root, [self.Record(path) for path in (root,) + paths])
+
+  def testNoExpansions(self):
+    items = [self.Record('a'), self.Record('b')]
+    self.assertEquals(svndumpmultitool._PlanFlush(items), [items])
+
+  def testHeldRecords(self):
+    delete = self.Record('a/b', 'delete')
+    expansion = self.Expansion('a/b', 'a/b/c')
+    change = self.Record('a/b/c', 'change')
+    add = self.Record('a/b/d')
+    other = self.Record('a/e')
+    plan = svndumpmultitool._PlanFlush([delete, other, expansion, change, add])
+    self.assertEquals(len(plan), 2)
+    self.assertEquals(plan[0], [other])
+    self.assertIs(plan[1][0], expansion)
+    self.assertEquals(plan[1][1].items(), [('a/b', ([delete], [])),
+                                           ('a/b/c', ([], [change])),
+                                           ('a/b/d', ([], [add]))])
+    # The Record peeked at is still generated
+    self.assertEquals([r.headers['Node-path'] for r in expansion.records],
+                      ['a/b', 'a/b/c'])
+
+  def testOverlappingRoots(self):
+    self.assertIsNone(svndumpmultitool._PlanFlush(
+        [self.Expansion('a'), self.Expansion('a/b')]))
+
+  def testRecordBelowRootBeforeExpansion(self):
+    self.assertIsNone(svndumpmultitool._PlanFlush(
+        [self.Record('a/b'), self.Expansion('a')]))
+
+  def testExpansionNotStartingAtRoot(self):
+    expansion = svndumpmultitool._Expansion('a', [self.Record('a/b')])
+    self.assertIsNone(svndumpmultitool._PlanFlush(
+        [self.Record('a', 'delete'), expansion]))
+    self.assertEquals(
+        [r.headers['Node-path'] for r in expansion.records], ['a/b'])
+
+  def testPathAcrossExpansion(self):
+    self.assertIsNone(svndumpmultitool._PlanFlush(
+        [self.Record('b'), self.Expansion('a'), self.Record('b', 'change')]))
+
+
+class WrittenPathsTest(unittest.TestCase):
+  def testPathsAndRoots(self):
+    written = svndumpmultitool._WrittenPaths()
+    for record in (svndump.Record(path='added', action='add', kind='dir'),
+                   svndump.Record(path='changed', action='change'),
+                   svndump.Record(path='deleted', action='delete')):
+      written.Add(record)
+    written.AddRoot('root')
+    for path in ('added', 'changed', 'deleted', 'root', 'root/x/y'):
+      self.assertIn(path, written)
+    for path in ('added/x', 'rootx', ''):
+      self.assertNotIn(path, written)
+
+  def testRepositoryRoot(self):
+    written = svndumpmultitool._WrittenPaths()
+    written.AddRoot('')
+    self.assertIn('', written)
+    self.assertIn('a/b', written)
+
 
 class FilterFilterRecordTest(unittest.TestCase):
   def setUp(self):
@@ -96,6 +496,42 @@ class FilterFilterRecordTest(unittest.TestCase):
     internalize_externals.assert_called_once_with(10, record)
     self.assertEquals(output, internalize_externals.return_value)
 
+  @mock.patch.object(svndumpmultitool.Filter, '_InternalizeExternals')
+  @mock.patch.object(svndumpmultitool.Filter, '_FixCopyFrom')
+  def testCopyWithExternalsIsLazy(self, fix_copy_from, internalize_externals):
+    """Copied Records are only internalized as the copy is generated."""
+    self.filter.externals_map = {'foo': 'bar'}
+    generated = []
+    def CopiedRecords():
+      for path, externals_value in (('trunk/foo', None),
+                                    ('trunk/foo/bar', 'lib foo')):
+        record = svndump.Record(kind='dir', action='add', path=path)
+        if externals_value is not None:
+          record.SetProperty('svn:externals', externals_value)
+        generated.append(record)
+        yield record
+    fix_copy_from.return_value = [
+        svndumpmultitool._Expansion('trunk/foo', CopiedRecords())]
+    external = svndump.Record(kind='dir', action='add',
+                              path='trunk/foo/bar/lib')
+    nested = svndump.Record(kind='file', action='add',
+                            path='trunk/foo/bar/lib/file')
+    internalize_externals.side_effect = lambda _, record: [
+        record, external,
+        svndumpmultitool._Expansion('trunk/foo/bar/lib', [nested])]
+    record = svndump.Record(kind='dir', action='add', path='trunk/foo')
+    record.headers['Node-copyfrom-path'] = 'branches/bar'
+    record.headers['Node-copyfrom-rev'] = '1'
+    output = self.filter._FilterRecord(10, record)
+    self.assertEquals(len(output), 1)
+    self.assertIsInstance(output[0], svndumpmultitool._Expansion)
+    self.assertEquals(output[0].root, 'trunk/foo')
+    self.assertEquals(generated, [])
+    self.assertFalse(internalize_externals.called)
+    records = list(output[0].records)
+    self.assertEquals(records, generated + [external, nested])
+    internalize_externals.assert_called_once_with(10, generated[1])
+
   @mock.patch.object(svndumpmultitool.Filter, '_InternalizeExternals')
   def testPathWithExternalsDisabled(self, internalize_externals):
     """_InternalizeExternals must not be called when no externals map exists."""
@@ -106,12 +542,434 @@ class FilterFilterRecordTest(unittest.TestCase):
     self.assertEquals(output, [record])
 
 
+class FilterPreviousExternalsTest(unittest.TestCase):
+  def setUp(self):
+    self.filter = svndumpmultitool.Filter(MAIN_REPO, util.PathFilter([]),
+                                          externals_map={'x': '/svn/x'})
+
+  @mock.patch.object(svndumpmultitool.externals, 'FromRev')
+  @mock.patch.object(svndumpmultitool.externals, 'Parse')
+  def testTracked(self, parse, from_rev):
+    self.filter._externals_state = svndumpmultitool.externals.ExternalsState(1)
+    record = svndump.Record(path='trunk', action='add', kind='dir')
+    record.SetProperty('svn:externals', 'x/a a')
+    self.filter._TrackExternals(3, record)
+    self.assertEqual(self.filter._PreviousExternals(3, 'trunk'), {})
+    self.assertEqual(self.filter._PreviousExternals(4, 'trunk'),
+                     parse.return_value)
+    parse.assert_called_once_with(MAIN_REPO, 3, 'trunk', 'x/a a',
+                                  {'x': '/svn/x'})
+    self.assertFalse(from_rev.called)
+
+  @mock.patch.object(svndumpmultitool.externals, 'FromRev')
+  def testBeforeDump(self, from_rev):
+    self.filter._externals_state = svndumpmultitool.externals.ExternalsState(
+        10)
+    self.assertEqual(self.filter._PreviousExternals(10, 'trunk'),
+                     from_rev.return_value)
+    from_rev.assert_called_once_with(MAIN_REPO, 9, 'trunk', {'x': '/svn/x'})
+
+  @mock.patch.object(svndumpmultitool.externals, 'FromRev')
+  def testAddedInIncrementalDump(self, from_rev):
+    self.filter._externals_state = svndumpmultitool.externals.ExternalsState(
+        10)
+    self.filter._TrackExternals(
+        10, svndump.Record(path='new', action='add', kind='dir'))
+    self.assertEqual(self.filter._PreviousExternals(11, 'new'), {})
+    self.assertFalse(from_rev.called)
+
+
+class FilterApplyExternalsChangeTest(unittest.TestCase):
+  OLD = {
+      '': ('dir', None, {}),
+      'lib': ('dir', None, {}),
+      'lib/same': ('file', 'a', {}),
+      'lib/text': ('file', 'a', {'p': 'v'}),
+      'lib/props': ('file', 'a', {}),
+      'lib/gone': ('dir', None, {}),
+      'lib/gone/file': ('file', 'a', {}),
+      'lib/tests': ('dir', None, {}),
+      'lib/tests/file': ('file', 'a', {}),
+      }
+  NEW = {
+      '': ('dir', None, {}),
+      'lib': ('dir', None, {}),
+      'lib/same': ('file', 'a', {}),
+      'lib/text': ('file', 'b', {'p': 'v'}),
+      'lib/props': ('file', 'a', {'p': 'v'}),
+      'lib/new': ('dir', None, {}),
+      'lib/new/file': ('file', 'a', {}),
+      'lib/tests': ('dir', None, {}),
+      'lib/tests/file': ('file', 'b', {}),
+      'lib/tests/added': ('file', 'a', {}),
+      }
+
+  def setUp(self):
+    svndump.CloseRepositories()
+    svndumpmultitool.svn_util._DIFFS.clear()
+
+  def tearDown(self):
+    svndump.CloseRepositories()
+    svndumpmultitool.svn_util._DIFFS.clear()
+
+  def Describe(self, rev):
+    return svndumpmultitool.externals.ExternalsDescription(
+        'ext', '/svn/lib', rev, 'lib', None)
+
+  def Summarize(self, records):
+    return [(record.headers['Node-path'],
+             record.headers['Node-action'],
+             'Text-content-md5' in record.headers,
+             record.props is not None)
+            for record in records]
+
+  @test_utils.PatchSvn(svndump, svndumpmultitool.svn_util)
+  def testOnlyChangesAreMade(self, fs, unused_repos, core):
+    test_utils.MockRevisions(fs, core, {1: self.OLD, 2: self.NEW})
+    fs.file_md5_checksum.return_value = 'checksum'
+    filt = svndumpmultitool.Filter(MAIN_REPO, util.PathFilter([]))
+    records = filt._ApplyExternalsChange('trunk', self.Describe(1),
+                                         self.Describe(2))
+    self.assertEquals(self.Summarize(records), [
+        ('trunk/ext/gone', 'delete', False, False),
+        ('trunk/ext/new', 'add', False, True),
+        ('trunk/ext/new/file', 'add', True, True),
+        ('trunk/ext/props', 'change', False, True),
+        ('trunk/ext/tests/added', 'add', True, True),
+        ('trunk/ext/tests/file', 'change', True, False),
+        ('trunk/ext/text', 'change', True, False),
+        ])
+    # Nothing is read for the paths that did not change
+    read = [args[1] for args, _ in fs.node_proplist.call_args_list
+            + fs.file_md5_checksum.call_args_list]
+    self.assertNotIn('lib/same', read)
+    self.assertNotIn('lib/text', [args[1] for args, _
+                                  in fs.node_proplist.call_args_list])
+
+  @test_utils.PatchSvn(svndump, svndumpmultitool.svn_util)
+  def testPrune(self, fs, unused_repos, core):
+    test_utils.MockRevisions(fs, core, {1: self.OLD, 2: self.NEW})
+    fs.file_md5_checksum.return_value = 'checksum'
+    filt = svndumpmultitool.Filter(
+        MAIN_REPO, util.PathFilter(['trunk'], ['trunk/ext/tests']))
+    records = filt._ApplyExternalsChange('trunk', self.Describe(1),
+                                         self.Describe(2))
+    self.assertNotIn('trunk/ext/tests/added',
+                     [record.headers['Node-path'] for record in records])
+    self.assertNotIn('trunk/ext/tests/file',
+                     [record.headers['Node-path'] for record in records])
+    self.assertIn('trunk/ext/text',
+                  [record.headers['Node-path'] for record in records])
+
+  @test_utils.PatchSvn(svndump, svndumpmultitool.svn_util)
+  def testNothingChanged(self, fs, unused_repos, core):
+    test_utils.MockRevisions(fs, core, {1: self.OLD, 2: self.OLD})
+    filt = svndumpmultitool.Filter(MAIN_REPO, util.PathFilter([]))
+    self.assertEquals(filt._ApplyExternalsChange('trunk', self.Describe(1),
+                                                 self.Describe(2)), [])
+
+
+def _DirWithExternals(path, action, value):
+  props = 'K 13\nsvn:externals\nV %d\n%s\nPROPS-END\n' % (len(value), value)
+  return ('Node-path: %s\n'
+          'Node-kind: dir\n'
+          'Node-action: %s\n'
+          'Prop-content-length: %d\n'
+          'Content-length: %d\n\n'
+          '%s\n' % (path, action, len(props), len(props), props))
+
+
+class FilterPrefetchExternalsTest(unittest.TestCase):
+  LIB = {
+      '': ('dir', None, {}),
+      'lib': ('dir', None, {}),
+      'lib/a': ('file', 'a', {}),
+      'lib/sub': ('dir', None, {}),
+      'lib/sub/b': ('file', 'b', {'p': 'v'}),
+      }
+  DUMP = (DUMP_HEADER
+          + _Revision(1)
+          + _DirWithExternals('trunk', 'add', 'file:///svn/lib/lib@1 ext')
+          + _Revision(2)
+          + _FileAdd('trunk/x', 'x')
+          + _Revision(3)
+          + _DirWithExternals('trunk', 'change', 'file:///svn/lib/lib@3 ext'))
+
+  def setUp(self):
+    svndump.CloseRepositories()
+    svndumpmultitool.svn_util._DIFFS.clear()
+    svndumpmultitool.externals._SOURCE_EXISTS.clear()
+    lib3 = dict(self.LIB)
+    lib3['lib/a'] = ('file', 'changed', {})
+    lib3['lib/c'] = ('file', 'c', {})
+    del lib3['lib/sub/b']
+    self.revisions = {1: self.LIB, 2: self.LIB, 3: lib3}
+
+  def tearDown(self):
+    svndump.CloseRepositories()
+
+  def Run(self, fs, core, prefetch_revisions):
+    test_utils.MockRevisions(fs, core, self.revisions)
+    core.SubversionException = svndumpmultitool.externals.Error
+    core.svn_stream_read = lambda stream, size: stream.read(size)
+    fs.file_md5_checksum.side_effect = lambda root, path: root[path][1]
+    fs.file_length.side_effect = lambda root, path: len(root[path][1])
+    fs.file_contents.side_effect = lambda root, path: io.BytesIO(
+        root[path][1])
+    output = StringIO.StringIO()
+    filt = svndumpmultitool.Filter(
+        MAIN_REPO, util.PathFilter(['trunk']),
+        input_stream=io.BytesIO(self.DUMP), output_stream=output,
+        externals_map={'file:///svn/lib': '/svn/lib'},
+        prefetch_revisions=prefetch_revisions, prefetch_workers=2)
+    filt.Filter()
+    return self.Revisions(output.getvalue())
+
+  def Revisions(self, dump):
+    """List the Records of each revision in dump, in order."""
+    read_record = svndump.MakeRecordReader(io.BytesIO(dump))
+    revisions = []
+    record = read_record()
+    while record is not None:
+      output = StringIO.StringIO()
+      record.Write(output, None)
+      if 'Node-path' in record.headers:
+        revisions[-1][1].append((record.headers['Node-path'],
+                                 output.getvalue()))
+      else:
+        revisions.append((output.getvalue(), []))
+      record = read_record()
+    return revisions
+
+  @test_utils.PatchSvn(svndump, svndumpmultitool.svn_util,
+                       svndumpmultitool.externals)
+  def testSameOutput(self, fs, unused_repos, core):
+    expected = self.Run(fs, core, 0)
+    self.assertEquals(sorted(path for path, _ in expected[-1][1]),
+                      ['trunk', 'trunk/ext/a', 'trunk/ext/c',
+                       'trunk/ext/sub/b'])
+    svndump.CloseRepositories()
+    svndumpmultitool.svn_util._DIFFS.clear()
+    svndumpmultitool.externals._SOURCE_EXISTS.clear()
+    fs.reset_mock()
+    self.assertEquals(self.Run(fs, core, 2), expected)
+    # The worker processes walked and compared the trees instead of the Filter
+    self.assertFalse(fs.dir_entries.called)
+    self.assertFalse(fs.compare_ids.called)
+
+  @test_utils.PatchSvn(svndump, svndumpmultitool.svn_util,
+                       svndumpmultitool.externals)
+  def testCacheFileIsFilled(self, fs, unused_repos, core):
+    fs.get_uuid.return_value = 'uuid'
+    tmpdir = tempfile.mkdtemp()
+    try:
+      svndumpmultitool.externals.OpenSourceExistsCache(
+          os.path.join(tmpdir, 'cache'))
+      self.Run(fs, core, 2)
+      # The workers looked up the sources, but the Filter stored the answers
+      self.assertEquals(
+          sorted(svndumpmultitool.externals._SOURCE_EXISTS_DB[0].keys()),
+          ['uuid@1:lib', 'uuid@3:lib'])
+    finally:
+      svndumpmultitool.externals.CloseSourceExistsCache()
+      shutil.rmtree(tmpdir)
+
+  def testOnlyIncludedPathsArePrefetched(self):
+    filt = svndumpmultitool.Filter(MAIN_REPO, util.PathFilter(['trunk/foo']),
+                                   externals_map={'file:///svn/lib': '/lib'})
+    filt._prefetch_pool = mock.Mock()
+    revhdr = svndump.Record()
+    revhdr.headers['Revision-number'] = '1'
+    filt._QueuePrefetch(1, revhdr)
+    for path in ('trunk', 'branches', 'trunk/foo'):
+      record = svndump.Record(path=path, kind='dir', action='add')
+      record.props = {'svn:externals': 'file:///svn/lib ext'}
+      filt._QueuePrefetch(1, record)
+    self.assertEquals(filt._prefetched.keys(), [(1, 'trunk/foo')])
+    self.assertEquals(filt._prefetch_pool.apply_async.call_count, 1)
+    # The externals map and path filter were given to the workers up front
+    self.assertEquals(filt._prefetch_pool.apply_async.call_args[0][1],
+                      (MAIN_REPO, 1, 'trunk/foo', None,
+                       'file:///svn/lib ext'))
+
+
+class PipeTest(unittest.TestCase):
+
+  def StartPut(self, pipe, item, size):
+    results = []
+    thread = threading.Thread(
+        target=lambda: results.append(pipe.Put(item, size)))
+    thread.daemon = True
+    thread.start()
+    thread.join(0.05)
+    return thread, results
+
+  def testMemoryBound(self):
+    pipe = svndumpmultitool._Pipe(4, memory=10)
+    self.assertTrue(pipe.Put('a', 6))
+    thread, results = self.StartPut(pipe, 'b', 6)
+    self.assertTrue(thread.is_alive())
+    self.assertEqual(pipe.Get(), 'a')
+    thread.join()
+    self.assertEqual(results, [True])
+    self.assertEqual(pipe.Get(), 'b')
+
+  def testItemLargerThanMemory(self):
+    pipe = svndumpmultitool._Pipe(4, memory=10)
+    self.assertTrue(pipe.Put('a', 20))
+    self.assertTrue(pipe.Put('b', 0))
+    self.assertEqual(pipe.Get(), 'a')
+
+  def testDepthBound(self):
+    pipe = svndumpmultitool._Pipe(1)
+    self.assertTrue(pipe.Put('a'))
+    thread, unused_results = self.StartPut(pipe, 'b', 0)
+    self.assertTrue(thread.is_alive())
+    self.assertEqual(pipe.Get(), 'a')
+    thread.join()
+    self.assertEqual(pipe.Get(), 'b')
+
+  def testCloseWakesPut(self):
+    pipe = svndumpmultitool._Pipe(1)
+    self.assertTrue(pipe.Put('a'))
+    thread, results = self.StartPut(pipe, 'b', 0)
+    pipe.Close()
+    thread.join()
+    self.assertEqual(results, [False])
+    self.assertFalse(pipe.Put('c'))
+
+  def testIsBatchFull(self):
+    pipe = svndumpmultitool._Pipe(4, memory=100)
+    self.assertFalse(pipe.IsBatchFull(['record'], 24))
+    self.assertTrue(pipe.IsBatchFull(['record'], 25))
+    self.assertTrue(pipe.IsBatchFull(
+        ['record'] * svndumpmultitool.PIPELINE_BATCH, 0))
+    self.assertFalse(svndumpmultitool._Pipe(4).IsBatchFull(['record'],
+                                                           1 << 40))
+
+
+class ReadStageTest(unittest.TestCase):
+
+  def testStopsWhenPipeIsClosed(self):
+    records = []
+    def ReadRecord(discard_text=None):
+      records.append(svndump.Record())
+      records[-1].headers['Revision-number'] = str(len(records))
+      return records[-1]
+    pipe = svndumpmultitool._Pipe(1)
+    pipe.Close()
+    svndumpmultitool._ReadStage(ReadRecord, util.PathFilter(['trunk']), pipe)
+    self.assertEqual(len(records), 1)
+
+
+class PipeWriterTest(unittest.TestCase):
+
+  @mock.patch.object(svndumpmultitool, 'PIPELINE_BATCH', 1)
+  def testWriterFailureIsRaisedByWrite(self):
+    writer = mock.Mock()
+    writer.Write.side_effect = IOError('disk full')
+    pipe_writer = svndumpmultitool._PipeWriter(writer, 1)
+    record = svndump.Record(path='file', action='delete')
+    with self.assertRaises(IOError):
+      for unused_i in xrange(10):
+        pipe_writer.Write(record, None)
+    self.assertEqual(writer.Write.call_count, 1)
+    with self.assertRaises(IOError):
+      pipe_writer.Close()
+
+  @mock.patch.object(svndump, 'svn_core')
+  @mock.patch.object(svndump, 'svn_fs')
+  def testRepositoryTextIsReadOnCallingThread(self, fs, core):
+    threads = []
+    def FileContents(unused_root, unused_path):
+      threads.append(threading.current_thread())
+      return io.BytesIO('foo')
+    fs.file_length.return_value = 3
+    fs.file_contents.side_effect = FileContents
+    core.svn_stream_read = lambda stream, size: stream.read(size)
+    record = svndump.Record(path='file', action='add', kind='file')
+    record.text = svndump._SVNFileText('root', 'file')
+    output_stream = StringIO.StringIO()
+    writer = svndumpmultitool._PipeWriter(
+        svndump.RecordWriter(output_stream), 1)
+    writer.Write(record, None)
+    writer.Close()
+    self.assertEqual(threads, [threading.current_thread()])
+    self.assertTrue(output_stream.getvalue().endswith('foo\n\n'))
+
+
+class LookaheadTest(unittest.TestCase):
+  def setUp(self):
+    self.records = []
+    for revision_number in (1, 2, 3):
+      revhdr = svndump.Record()
+      revhdr.headers['Revision-number'] = str(revision_number)
+      self.records.append(revhdr)
+      self.records.append(svndump.Record(path='r%d' % revision_number))
+    self.read = []
+    self.visited = []
+
+  def ReadRecord(self, discard_text=None):
+    if len(self.read) == len(self.records):
+      return None
+    self.read.append(self.records[len(self.read)])
+    return self.read[-1]
+
+  def Visit(self, revision_number, record):
+    self.visited.append((revision_number, record))
+
+  def testReadsAhead(self):
+    lookahead = svndumpmultitool._Lookahead(self.ReadRecord, 1, self.Visit)
+    self.assertIs(lookahead.Read(), self.records[0])
+    self.assertEquals(len(self.read), 3)
+    self.assertEquals(self.visited, list(zip((1, 1, 2), self.read)))
+    # While r1 is filtered, all of r2 has been read
+    self.assertIs(lookahead.Read(), self.records[1])
+    self.assertEquals(len(self.read), 5)
+    self.assertIs(lookahead.Read(), self.records[2])
+    self.assertEquals(len(self.read), 5)
+    self.assertIs(lookahead.Read(), self.records[3])
+    self.assertEquals(len(self.read), 6)
+
+  def testAllRecordsAreReturned(self):
+    lookahead = svndumpmultitool._Lookahead(self.ReadRecord, 5, self.Visit)
+    records = []
+    record = lookahead.Read()
+    while record is not None:
+      records.append(record)
+      record = lookahead.Read()
+    self.assertEquals(records, self.records)
+    self.assertEquals(len(self.visited), len(self.records))
+    self.assertIsNone(lookahead.Read())
+
+
+class FilterIsExcludedNodeTest(unittest.TestCase):
+  def setUp(self):
+    self.filter = svndumpmultitool.Filter(MAIN_REPO,
+                                          util.PathFilter(['trunk/foo']))
+
+  def testExcluded(self):
+    record = svndump.Record(path='trunk/bar')
+    self.assertTrue(self.filter._IsExcludedNode(record))
+
+  def testIncluded(self):
+    record = svndump.Record(path='trunk/foo/bar')
+    self.assertFalse(self.filter._IsExcludedNode(record))
+    record = svndump.Record(path='trunk')
+    self.assertFalse(self.filter._IsExcludedNode(record))
+
+  def testNotANode(self):
+    record = svndump.Record()
+    record.headers['Revision-number'] = '1'
+    self.assertFalse(self.filter._IsExcludedNode(record))
+
+
 class FilterFixCopyFromTest(unittest.TestCase):
   # TODO: complete test coverage of _FixCopyFrom
 
   @mock.patch.object(util.PathFilter, 'CheckPath',
                      return_value=util.PathFilter.PARENT)
-  @mock.patch.object(svndump, 'MakeRecordsFromPath')
+  @mock.patch.object(svndump, 'IterRecordsFromPath')
   def testCopyParentToParent(self, grab_records, _):
     filt = svndumpmultitool.Filter(MAIN_REPO, util.PathFilter([]))
     record = svndump.Record(action='add', path='foo', kind='dir')
@@ -125,6 +983,119 @@ class FilterFixCopyFromTest(unittest.TestCase):
     self.assertFalse(grab_records.called)
 
 
+class FilterCopyHasExcludesTest(unittest.TestCase):
+  NODES = {
+      '': 'dir',
+      'trunk': 'dir',
+      'trunk/old': 'dir',
+      'trunk/old/src': 'dir',
+      'trunk/old/src/a': 'file',
+      'trunk/old/vendor': 'dir',
+      'trunk/old/vendor/b': 'file',
+      }
+
+  def setUp(self):
+    svndump.CloseRepositories()
+
+  def CopyHasExcludes(self, fs, core, excludes, dstpath):
+    test_utils.MockTree(fs, core, self.NODES)
+    filt = svndumpmultitool.Filter(MAIN_REPO,
+                                   util.PathFilter(['trunk'], excludes))
+    return filt._CopyHasExcludes(MAIN_REPO_REV, 'trunk/old', dstpath)
+
+  @test_utils.PatchSvn(svndump, svndumpmultitool.svn_util)
+  def testExcludedAtDestination(self, fs, unused_repos, core):
+    self.assertTrue(self.CopyHasExcludes(fs, core, ['trunk/new/vendor'],
+                                         'trunk/new'))
+    # Nothing below an excluded path is walked
+    self.assertNotIn(mock.call(mock.ANY, 'trunk/old/vendor'),
+                     fs.dir_entries.call_args_list)
+
+  @test_utils.PatchSvn(svndump, svndumpmultitool.svn_util)
+  def testExcludedAtSource(self, fs, unused_repos, core):
+    self.assertTrue(self.CopyHasExcludes(fs, core, ['trunk/old/src/a'],
+                                         'trunk/new'))
+
+  @test_utils.PatchSvn(svndump, svndumpmultitool.svn_util)
+  def testNoExcludedPaths(self, fs, unused_repos, core):
+    self.assertFalse(self.CopyHasExcludes(fs, core, ['trunk/new/vendor/c'],
+                                          'trunk/new'))
+    # Subtrees in which no exclude pattern could match are not walked
+    self.assertEquals(fs.dir_entries.call_args_list,
+                      [mock.call(mock.ANY, 'trunk/old'),
+                       mock.call(mock.ANY, 'trunk/old/vendor')])
+
+  @test_utils.PatchSvn(svndump, svndumpmultitool.svn_util)
+  def testNoExcludesBelowCopy(self, fs, unused_repos, core):
+    self.assertFalse(self.CopyHasExcludes(fs, core, ['branches/x'],
+                                          'trunk/new'))
+    # The tree is not even opened
+    self.assertFalse(fs.is_dir.called)
+    self.assertFalse(fs.dir_entries.called)
+
+  @test_utils.PatchSvn(svndump, svndumpmultitool.svn_util)
+  def testNoExcludes(self, fs, unused_repos, core):
+    self.assertFalse(self.CopyHasExcludes(fs, core, [], 'trunk/new'))
+    self.assertFalse(fs.dir_entries.called)
+
+  @test_utils.PatchSvn(svndump, svndumpmultitool.svn_util)
+  def testCopyIsExpanded(self, fs, unused_repos, core):
+    test_utils.MockTree(fs, core, self.NODES)
+    core.svn_node_none = 'none'
+    fs.check_path.side_effect = lambda root, path: self.NODES[path]
+    fs.file_md5_checksum.return_value = '0' * 16
+    fs.node_proplist.return_value = {}
+    filt = svndumpmultitool.Filter(
+        MAIN_REPO, util.PathFilter(['trunk'], ['trunk/new/vendor']))
+    record = svndump.Record(action='add', path='trunk/new', kind='dir')
+    record.headers['Node-copyfrom-rev'] = str(MAIN_REPO_REV)
+    record.headers['Node-copyfrom-path'] = 'trunk/old'
+    result = list(svndumpmultitool._IterRecords(filt._FixCopyFrom(record)))
+    self.assertEquals(sorted(r.headers['Node-path'] for r in result),
+                      ['trunk/new', 'trunk/new/src', 'trunk/new/src/a'])
+    for new_record in result:
+      self.assertNotIn('Node-copyfrom-path', new_record.headers)
+
+
+class FilterFilterPathsTest(unittest.TestCase):
+  def setUp(self):
+    svndump.CloseRepositories()
+
+  @test_utils.PatchSvn(svndump, svndumpmultitool.svn_util)
+  def testOnlyIncludedPartIsWalked(self, fs, unused_repos, core):
+    test_utils.MockTree(fs, core, {
+        '': 'dir',
+        'branches': 'dir',
+        'branches/bar': 'dir',
+        'branches/bar/foo': 'dir',
+        'branches/bar/foo/a': 'file',
+        'branches/bar/foo/sub': 'dir',
+        'branches/bar/huge': 'dir',
+        'branches/bar/huge/b': 'file',
+        'branches/bar/x': 'dir',
+        'branches/bar/x/y': 'dir',
+        'branches/bar/x/z': 'dir',
+        })
+    filt = svndumpmultitool.Filter(
+        MAIN_REPO, util.PathFilter(['trunk/foo', 'trunk/x/y']))
+    empty_dirs, recursive_dirs = filt._FilterPaths(MAIN_REPO_REV,
+                                                   'branches/bar', 'trunk')
+    self.assertEquals(empty_dirs, ['', 'x'])
+    self.assertEquals(recursive_dirs, ['foo', 'x/y'])
+    listed = [call[0][1] for call in fs.dir_entries.call_args_list]
+    self.assertEquals(sorted(listed), ['branches/bar', 'branches/bar/x'])
+
+
+class PlanCopyTest(unittest.TestCase):
+  def testSortedLikePaths(self):
+    def Walk(visit):
+      # Visited in the order that svndump.WalkTree would visit them
+      for path in ('', 'a', 'a/b', 'a.b', 'a.b/c'):
+        visit(path, 'dir')
+    plan = svndumpmultitool._PlanCopy(util.PathFilter(['x/a.*/.*']), 'x', Walk)
+    self.assertEquals(plan, (['', 'a', 'a.b'], ['a.b/c', 'a/b']))
+
+
 class FilterFlattenMultipleActionsTest(unittest.TestCase):
 
   # Autospec causes the mock to receive self as its first arg
@@ -143,8 +1114,7 @@ class FilterFlattenMultipleActionsTest(unittest.TestCase):
     contents.append(svndump.Record(path='bar', action='delete', kind='dir'))
     contents.append(svndump.Record(path='baz', action='add', kind='dir'))
     def Flatten(self):
-      self.records.pop(0)
-      self.contents.pop(0)
+      self.contents.Remove(self.records.popleft())
     flatten.side_effect = Flatten
     filt._FlattenMultipleActions(MAIN_REPO_REV, contents)
     self.assertEqual(len(contents), 3)
@@ -178,6 +1148,47 @@ class FilterFlattenMultipleActionsTest(unittest.TestCase):
     self.assertEqual(len(contents), 1)
     self.assertEqual(contents[0].headers['Node-action'], 'replace')
 
+  def testOrderIsKept(self):
+    filt = svndumpmultitool.Filter(MAIN_REPO, util.PathFilter([]))
+    contents = []
+    for i in xrange(3):
+      contents.append(svndump.Record(path='f%d' % i, action='add', kind='file'))
+    for i in xrange(3):
+      contents.append(svndump.Record(path='f%d' % i, action='change',
+                                     kind='file'))
+    deleted = svndump.Record(path='ext', action='delete')
+    added = svndump.Record(path='ext', action='add', kind='dir',
+                           source=svndump.Record.EXTERNALS)
+    contents.extend([added, deleted])
+    expected = contents[:3] + [added]
+    filt._FlattenMultipleActions(MAIN_REPO_REV, contents)
+    self.assertEqual([r.headers['Node-path'] for r in contents],
+                     ['f0', 'f1', 'f2', 'ext'])
+    for record, expected_record in zip(contents, expected):
+      self.assertIs(record, expected_record)
+    self.assertEqual(added.headers['Node-action'], 'replace')
+
+
+class IndexedRecordsTest(unittest.TestCase):
+  def testRemoveAndInsertBefore(self):
+    records = [svndump.Record(path=str(i)) for i in xrange(4)]
+    indexed = svndumpmultitool._IndexedRecords(records)
+    indexed.Remove(records[3])
+    indexed.InsertBefore(records[3], records[1])
+    indexed.Remove(records[0])
+    self.assertEqual(list(indexed), [records[3], records[1], records[2]])
+    self.assertEqual(len(indexed), 3)
+
+  def testEqualRecordsInOneSlot(self):
+    records = [svndump.Record(path='foo', action='delete') for _ in xrange(3)]
+    indexed = svndumpmultitool._IndexedRecords(records[:2])
+    indexed.InsertBefore(records[2], records[1])
+    indexed.Remove(records[1])
+    self.assertEqual([id(r) for r in indexed], [id(records[0]), id(records[2])])
+    indexed.InsertBefore(records[1], records[2])
+    indexed.Remove(records[2])
+    self.assertEqual([id(r) for r in indexed], [id(records[0]), id(records[1])])
+
 
 class FilterActionPairFlattenerTest(unittest.TestCase):
   def testConstructor(self):
@@ -200,8 +1211,8 @@ class FilterActionPairFlattenerTest(unittest.TestCase):
       second = svndump.Record(path='foo', action=action2)
     else:
       second = svndump.Record(path='foo', kind='file', action=action2)
-    contents = [first, second]
-    records = [first, second]
+    contents = svndumpmultitool._IndexedRecords([first, second])
+    records = collections.deque([first, second])
     apf = svndumpmultitool.Filter._ActionPairFlattener(MAIN_REPO, MAIN_REPO_REV,
                                                      contents, 'trunk', records)
     return apf
@@ -211,7 +1222,7 @@ class FilterActionPairFlattenerTest(unittest.TestCase):
     apf = self.MakeActionPairFlattener('add', 'add')
     apf.Flatten()
     self.assertEqual(len(apf.contents), 1)
-    self.assertIs(apf.contents[0], apf.second)
+    self.assertIs(list(apf.contents)[0], apf.second)
 
   def testMergeChangeIntoAddWithText(self):
     apf = self.MakeActionPairFlattener('add', 'change')
@@ -220,7 +1231,7 @@ class FilterActionPairFlattenerTest(unittest.TestCase):
     apf.second.headers['Text-content-md5'] = 'bar-checksum'
     apf.Flatten()
     self.assertEqual(len(apf.contents), 1)
-    result = apf.contents[0]
+    result = list(apf.contents)[0]
     self.assertEqual(result.headers['Node-action'], 'add')
     self.assertEqual(result.headers['Text-content-md5'], 'bar-checksum')
     self.assertEqual(result.text, 'bar')
@@ -230,11 +1241,13 @@ class FilterActionPairFlattenerTest(unittest.TestCase):
     apf.first.text = 'foo'
     apf.second.text = 'bar'
     apf.first.headers['Text-content-md5'] = 'bar-checksum'
+    apf.first.headers['Text-content-sha1'] = 'bar-checksum'
     apf.Flatten()
     self.assertEqual(len(apf.contents), 1)
-    result = apf.contents[0]
+    result = list(apf.contents)[0]
     self.assertEqual(result.headers['Node-action'], 'add')
     self.assertNotIn('Text-content-md5', result.headers)
+    self.assertNotIn('Text-content-sha1', result.headers)
     self.assertEqual(result.text, 'bar')
 
   def testMergeChangeIntoAddWithoutText(self):
@@ -242,7 +1255,7 @@ class FilterActionPairFlattenerTest(unittest.TestCase):
     apf.first.text = 'foo'
     apf.Flatten()
     self.assertEqual(len(apf.contents), 1)
-    result = apf.contents[0]
+    result = list(apf.contents)[0]
     self.assertEqual(result.headers['Node-action'], 'add')
     self.assertEqual(result.text, 'foo')
 
@@ -260,7 +1273,7 @@ class FilterActionPairFlattenerTest(unittest.TestCase):
     apf.second.props = {'bar': 'baz'}
     apf.Flatten()
     self.assertEqual(len(apf.contents), 1)
-    result = apf.contents[0]
+    result = list(apf.contents)[0]
     self.assertEqual(result.headers['Node-action'], 'add')
     self.assertEqual(result.props, {'bar': 'baz'})
 
@@ -269,7 +1282,7 @@ class FilterActionPairFlattenerTest(unittest.TestCase):
     apf.second.props = {'bar': 'baz'}
     apf.Flatten()
     self.assertEqual(len(apf.contents), 1)
-    result = apf.contents[0]
+    result = list(apf.contents)[0]
     self.assertEqual(result.headers['Node-action'], 'add')
     self.assertEqual(result.props, {'bar': 'baz'})
 
@@ -278,7 +1291,7 @@ class FilterActionPairFlattenerTest(unittest.TestCase):
     apf.first.props = {'foo': 'bar'}
     apf.Flatten()
     self.assertEqual(len(apf.contents), 1)
-    result = apf.contents[0]
+    result = list(apf.contents)[0]
     self.assertEqual(result.headers['Node-action'], 'add')
     self.assertEqual(result.props, {'foo': 'bar'})
 
@@ -289,7 +1302,7 @@ class FilterActionPairFlattenerTest(unittest.TestCase):
     apf.second.headers['Prop-delta'] = 'true'
     apf.Flatten()
     self.assertEqual(len(apf.contents), 1)
-    result = apf.contents[0]
+    result = list(apf.contents)[0]
     self.assertEqual(result.headers['Node-action'], 'add')
     self.assertEqual(result.props, {'p1': 'v4', 'p3': 'v3', 'p4': 'v5'})
 
@@ -304,7 +1317,7 @@ class FilterActionPairFlattenerTest(unittest.TestCase):
     apf.second.text = 'second-text'
     apf.Flatten()
     self.assertEqual(len(apf.contents), 1)
-    result = apf.contents[0]
+    result = list(apf.contents)[0]
     self.assertEqual(result.headers['Node-action'], 'change')
     self.assertNotIn('Text-delta', result.headers)
     self.assertEqual(result.props, {'p1': None, 'p2': 'v3', 'p3': None,
@@ -315,7 +1328,7 @@ class FilterActionPairFlattenerTest(unittest.TestCase):
     apf = self.MakeActionPairFlattener('add', 'delete')
     apf.first.source = svndump.Record.EXTERNALS
     apf.Flatten()
-    self.assertEqual(apf.contents, [apf.second, apf.first])
+    self.assertEqual(list(apf.contents), [apf.second, apf.first])
 
   def testDropAddDeletePair(self):
     apf = self.MakeActionPairFlattener('add', 'delete')
@@ -327,7 +1340,7 @@ class FilterActionPairFlattenerTest(unittest.TestCase):
     apf.second.text = 'foo-text'
     apf.Flatten()
     self.assertEquals(len(apf.contents), 1)
-    result = apf.contents[0]
+    result = list(apf.contents)[0]
     self.assertEquals(result.headers['Node-path'], 'foo')
     self.assertEquals(result.headers['Node-kind'], 'file')
     self.assertEquals(result.headers['Node-action'], 'replace')
@@ -405,5 +1418,13 @@ class FilterFilterRevTest(unittest.TestCase):
     self.assertEqual(result, [])
 
 
+class MainTest(unittest.TestCase):
+  @mock.patch('sys.stderr', new_callable=StringIO.StringIO)
+  def testExcludeRequiresRepo(self, stderr):
+    with self.assertRaises(SystemExit):
+      svndumpmultitool.main(['--include=trunk', '--exclude=trunk/vendor'])
+    self.assertIn('require --repo', stderr.getvalue())
+
+
 if __name__ == '__main__':
   unittest.main()
@@ -9,9 +9,12 @@
 from __future__ import absolute_import
 
 import contextlib
+import functools
 import io
 import subprocess
 
+import mock
+
 
 class MockPopen(object):
   """Mock class for replacing subprocess.Popen.
@@ -138,3 +141,124 @@ class MockPopen(object):
     def close(self):
       assert not self.read(), 'All stream output must be read before close()'
       io.BytesIO.close(self)
+
+
+def MockTree(fs, core, nodes):
+  """Make mocks of the svn.fs and svn.core modules serve a directory tree.
+
+  Args:
+    fs: mock of svn.fs
+    core: mock of svn.core
+    nodes: {path: kind} where kind is 'dir' or 'file', including every
+           directory ('' for the repository root)
+
+  Only the functions used to walk a tree (is_dir and dir_entries) are mocked.
+  """
+  core.svn_node_dir = 'dir'
+  core.svn_node_file = 'file'
+  fs.is_dir.side_effect = lambda _, path: nodes[path] == 'dir'
+
+  def DirEntries(unused_root, path):
+    prefix = (path + '/') if path else ''
+    entries = {}
+    for node_path, kind in nodes.iteritems():
+      name = node_path[len(prefix):]
+      if node_path.startswith(prefix) and name and '/' not in name:
+        entries[name] = mock.Mock(kind=kind)
+    return entries
+
+  fs.dir_entries.side_effect = DirEntries
+
+
+def MockRevisions(fs, core, revisions):
+  """Make mocks of the svn.fs and svn.core modules serve several revisions.
+
+  Args:
+    fs: mock of svn.fs
+    core: mock of svn.core
+    revisions: {revision number: {path: (kind, text, props)}} where kind is
+               'dir' or 'file', text is the contents of a file (None for a
+               directory) and props is a dict. Every directory must be listed
+               ('' for the repository root).
+
+  The functions used to compare trees and to make Records of single nodes
+  are mocked. The root of a revision is
+  its dict of nodes, and the ID of a node is a snapshot of its subtree, so
+  nodes have the same ID exactly when their subtrees are identical.
+  """
+  core.svn_node_dir = 'dir'
+  core.svn_node_file = 'file'
+  core.svn_node_none = 'none'
+  fs.youngest_rev.return_value = max(revisions)
+  fs.revision_root.side_effect = lambda _, rev: revisions[rev]
+  fs.check_path.side_effect = (
+      lambda root, path: root[path][0] if path in root else 'none')
+  fs.is_dir.side_effect = lambda root, path: root[path][0] == 'dir'
+
+  def Subtree(root, path):
+    prefix = (path + '/') if path else ''
+    return sorted((node_path[len(prefix):],
+                   (kind, text, sorted(props.iteritems())))
+                  for node_path, (kind, text, props) in root.iteritems()
+                  if node_path == path or node_path.startswith(prefix))
+
+  def DirEntries(root, path):
+    prefix = (path + '/') if path else ''
+    entries = {}
+    for node_path, node in root.iteritems():
+      name = node_path[len(prefix):]
+      if node_path.startswith(prefix) and name and '/' not in name:
+        entries[name] = mock.Mock(kind=node[0])
+    return entries
+
+  fs.node_id.side_effect = Subtree
+  fs.compare_ids.side_effect = lambda id1, id2: 0 if id1 == id2 else 1
+  fs.dir_entries.side_effect = DirEntries
+  fs.contents_changed.side_effect = (
+      lambda root1, path1, root2, path2: root1[path1][1] != root2[path2][1])
+  fs.props_changed.side_effect = (
+      lambda root1, path1, root2, path2: root1[path1][2] != root2[path2][2])
+  fs.node_proplist.side_effect = lambda root, path: root[path][2]
+
+
+class PatchSvn(object):
+  """Patch the svn modules imported by several modules with the same mocks.
+
+  Example:
+    @test_utils.PatchSvn(svndump, svn_util)
+    def testWalk(self, fs, repos, core):
+      ...
+
+  Used as a decorator, the mocks of svn.fs, svn.repos and svn.core are passed
+  to the test like mock.patch does. Used as a context manager, they are
+  returned by __enter__. Modules that use the revision roots of svndump must be
+  patched together with it, so that they see the roots that their mocks serve.
+  """
+
+  NAMES = ('svn_fs', 'svn_repos', 'svn_core')
+
+  def __init__(self, *modules):
+    self.modules = modules
+    self._patchers = None
+
+  def __enter__(self):
+    mocks = tuple(mock.MagicMock() for _ in self.NAMES)
+    self._patchers = [mock.patch.object(module, name, module_mock)
+                      for module in self.modules
+                      for name, module_mock in zip(self.NAMES, mocks)
+                      if hasattr(module, name)]
+    for patcher in self._patchers:
+      patcher.start()
+    return mocks
+
+  def __exit__(self, *unused_exc_info):
+    for patcher in reversed(self._patchers):
+      patcher.stop()
+    self._patchers = None
+
+  def __call__(self, test):
+    @functools.wraps(test)
+    def Wrapper(*args):
+      with self as mocks:
+        return test(*(args + mocks))
+    return Wrapper
@@ -8,6 +8,8 @@
 
 from __future__ import absolute_import
 
+import collections
+import copy
 import logging
 import os
 import re
@@ -105,6 +107,9 @@ class PathFilter(object):
   (included) and PARENT (not explicitly included, but it might contain children
   that are included).
 
+  Exclude patterns are matched the same way. A path that matches an exclude
+  pattern (or whose ancestor does) is NO, whatever the include patterns say.
+
   Examples:
     pattern: foo/bar
       foo/bar/baz: YES
@@ -116,6 +121,9 @@ class PathFilter(object):
       foooooooooo/boppity: NO
       fooooo/bop: YES
       foo/bop/de/bop: YES
+    pattern: foo, exclude pattern: foo/vendor
+      foo/bar: YES
+      foo/vendor/bar: NO
   """
   # Not included
   NO = 0
@@ -124,22 +132,20 @@ class PathFilter(object):
   # Directly included
   YES = 2
 
-  def __init__(self, includes):
+  def __init__(self, includes, excludes=()):
     """Create a new PathFilter.
 
     Args:
       includes: an iterable of regexp patterns (strings)
+      excludes: an iterable of regexp patterns (strings)
 
     See PathFilter for details.
 
-    Note: if includes is empty, the resulting PathFilter will include all paths.
+    Note: if includes is empty, the resulting PathFilter will include all paths
+    that are not excluded.
     """
-    self._includes = []
-    # Split include paths on directory separators and compile as regexps
-    for include in includes:
-      include = include.strip('/')
-      self._includes.append([re.compile(r'\A%s\Z' % regex)
-                             for regex in include.split('/')])
+    self._includes = _PatternTrie(includes)
+    self._excludes = _PatternTrie(excludes)
 
   def CheckPath(self, path):
     """Check if a path is included, excluded, or a potential parent of included.
@@ -154,52 +160,65 @@ class PathFilter(object):
     tried in succession. Path components are matched against the corresponding
     regexp components. The path is only considered to match a path regexp if all
     of its components match their corresponding regexp components.
-    - If no regexps were passed when this PathFilter was initialized, YES is
-      returned.
+    - If the path matches an excluded path regexp the same way (all of the
+      regexp's components), NO is returned.
+    - If no include regexps were passed when this PathFilter was initialized,
+      YES is returned.
     - If all components match and the path was long enough to use all components
       of the path regexp (or more), YES is returned.
     - If all components match, but the path ran out of components with path
       regexp components left over, the path is tentatively a PARENT unless one
       of the remaining path regexps causes it to be marked as a YES.
     - If no path regexp matches the path, NO is returned.
+
+    The path regexps are stored as tries of their components, so rather than
+    trying each one, the path's components are matched against the tries one
+    at a time. The state reached for each directory is cached, so checking a
+    path usually only needs its last component to be matched, however many
+    regexps there are.
     """
+    path = _NormalizePath(path)
+    if self._excludes and self._excludes.Match(path)[0]:
+      return self.NO
     # No includes means everything is included
     if not self._includes:
       return self.YES
-    path = os.path.normpath(path)
-    # Normpath converts the empty string to .
-    if path == '.':
-      path = ''
-    parts = filter(None, path.split('/'))
-    result = self.NO
-    for include in self._includes:
-      match_me = True
-      # Compare each path segment with its corresponding regexp.
-      # - If there are more path segments than regexps, ignore the extras
-      #   (effectively checking the path's parent directory, which is good
-      #   enough because if the parent is included, so is the child).
-      # - If there are more regexps than path segments, again ignore the extras,
-      #   but count matches as PARENT because this path may have children that
-      #   are and/or that are not included.
-      # - zip() ignores extras on either side automatically, but we have to
-      #   compare the lengths if there's a match to see if it's a full match or
-      #   just a PARENT.
-      for part, regex in zip(parts, include):
-        if not regex.match(part):
-          match_me = False
-          break
-      if match_me:
-        # If the path matched the whole include path or more, it's a YES so stop
-        # looking
-        if len(parts) >= len(include):
-          result = self.YES
-          break
-        # If the path ended but matched however much of the include it could,
-        # it's a PARENT of an interesting path, but keep checking to see if it's
-        # a YES for another pattern
-        else:
-          result = self.PARENT
-    return result
+    is_yes, nodes = self._includes.Match(path)
+    if is_yes:
+      return self.YES
+    elif nodes:
+      return self.PARENT
+    else:
+      return self.NO
+
+  def Copy(self):
+    """Return an equal PathFilter that can be used on another thread.
+
+    The compiled patterns are shared; only the caches are not.
+    """
+    other = copy.copy(self)
+    other._includes = self._includes.Copy()
+    other._excludes = self._excludes.Copy()
+    return other
+
+  def HasExcludes(self):
+    """Can a path be NO even though its parent directory is YES?"""
+    return bool(self._excludes)
+
+  def MayExcludeBelow(self, path):
+    """Could an exclude pattern match a path below path, but not path itself?
+
+    Args:
+      path: a path
+
+    Returns:
+      False if every path below path is excluded exactly when path is, so a
+      tree below it need not be searched for excluded paths
+    """
+    if not self._excludes:
+      return False
+    matched, nodes = self._excludes.Match(_NormalizePath(path))
+    return not matched and bool(nodes)
 
   def IsIncluded(self, path):
     return self.CheckPath(path) is self.YES
@@ -209,3 +228,176 @@ class PathFilter(object):
 
   def IsExcluded(self, path):
     return self.CheckPath(path) is self.NO
+
+
+def ReadPatterns(stream):
+  """Read path regexps from a pattern file.
+
+  Args:
+    stream: a file-like object with one regexp per line
+
+  Returns:
+    a list of the regexps; blank lines and lines starting with # are skipped
+  """
+  patterns = []
+  for line in stream:
+    line = line.rstrip('\r\n')
+    if line and not line.startswith('#'):
+      patterns.append(line)
+  return patterns
+
+
+class _PatternTrie(object):
+  """The components of a set of path regexps, matched one at a time."""
+
+  # Number of directories whose match state is remembered
+  CACHE_SIZE = 10000
+
+  def __init__(self, patterns):
+    self._root = _PatternNode()
+    self._empty = True
+    # Split paths on directory separators and add them to the trie
+    for pattern in patterns:
+      self._empty = False
+      node = self._root
+      for regex in pattern.strip('/').split('/'):
+        node = node.Child(regex)
+      node.terminal = True
+    self._root.Compile()
+    # {normalized path: Match(path)} from least to most recently used
+    self._cache = collections.OrderedDict()
+
+  def __nonzero__(self):
+    return not self._empty
+
+  def Copy(self):
+    """Return a _PatternTrie sharing the same nodes with an empty cache."""
+    other = copy.copy(self)
+    other._cache = collections.OrderedDict()
+    return other
+
+  def Match(self, path):
+    """Match a normalized path against the trie.
+
+    Args:
+      path: a path as returned by _NormalizePath
+
+    Returns:
+      (matched, nodes): whether the path (or its ancestor) matched a whole
+      path regexp, and the trie nodes matched by the path if it did not
+    """
+    try:
+      state = self._cache.pop(path)
+    except KeyError:
+      if not path:
+        state = (self._root.terminal, (self._root,))
+      else:
+        slash = path.rfind('/')
+        state = self.Match(path[:slash] if slash >= 0 else '')
+        matched, nodes = state
+        if not matched and nodes:
+          state = _PatternNode.Advance(nodes, path[slash + 1:])
+      if len(self._cache) >= self.CACHE_SIZE:
+        self._cache.popitem(last=False)
+    self._cache[path] = state
+    return state
+
+
+def _NormalizePath(path):
+  """Normalize a path to its components joined by single /'s."""
+  if '//' in path or '/.' in path or path.startswith('.'):
+    path = os.path.normpath(path)
+    # Normpath converts the empty string to .
+    if path == '.':
+      return ''
+    return '/'.join(filter(None, path.split('/')))
+  return path.strip('/')
+
+
+# Characters that make a path component a regexp rather than a literal name
+_REGEX_CHARS = frozenset('.^$*+?{}[]\\|()')
+
+
+class _PatternNode(object):
+  """A node in a _PatternTrie.
+
+  Attributes:
+    terminal: True if an include path ends at this node
+    literals: {str: _PatternNode} children for components that are plain names
+    regexes: {str: (compiled regexp, _PatternNode)} children for all other
+             components
+    combined: a regexp that matches any component that one of regexes
+              without groups matches (possibly more), or None if there is no
+              such regexp
+    grouped: the (compiled regexp, _PatternNode) values of regexes that
+             combined leaves out, since combining regexps renumbers their
+             groups and breaks backreferences
+  """
+  __slots__ = ('terminal', 'literals', 'regexes', 'combined', 'grouped')
+
+  def __init__(self):
+    self.terminal = False
+    self.literals = {}
+    self.regexes = {}
+    self.combined = None
+    self.grouped = ()
+
+  def Child(self, regex):
+    """Return the child for a component, creating it if necessary."""
+    if _REGEX_CHARS.isdisjoint(regex):
+      return self.literals.setdefault(regex, _PatternNode())
+    if regex not in self.regexes:
+      self.regexes[regex] = (re.compile(r'\A%s\Z' % regex), _PatternNode())
+    return self.regexes[regex][1]
+
+  def Compile(self):
+    """Build the combined regexps of this node and its descendants."""
+    ungrouped = [regex for regex, (compiled, _) in self.regexes.iteritems()
+                 if not compiled.groups]
+    self.combined = None
+    self.grouped = ()
+    if len(ungrouped) > 1:
+      try:
+        self.combined = re.compile('|'.join(
+            r'(?:\A%s\Z)' % regex for regex in ungrouped))
+      except (re.error, AssertionError):
+        # Some regexps cannot be combined (e.g. too many of them), so they
+        # are all tried separately instead
+        pass
+      else:
+        self.grouped = tuple(value for value in self.regexes.itervalues()
+                             if value[0].groups)
+    for child in self.literals.itervalues():
+      child.Compile()
+    for _, child in self.regexes.itervalues():
+      child.Compile()
+
+  @staticmethod
+  def Advance(nodes, part):
+    """Match one more path component.
+
+    Args:
+      nodes: the nodes matched so far
+      part: the next path component
+
+    Returns:
+      (matched, nodes) as described in _PatternTrie.Match
+    """
+    matched = []
+    for node in nodes:
+      child = node.literals.get(part)
+      if child is not None:
+        matched.append(child)
+      if node.regexes:
+        if node.combined is None or node.combined.match(part):
+          candidates = node.regexes.itervalues()
+        else:
+          # Only regexps with groups were left out of the combined one
+          candidates = node.grouped
+        for regex, child in candidates:
+          if regex.match(part):
+            matched.append(child)
+    for node in matched:
+      if node.terminal:
+        return (True, ())
+    return (False, tuple(matched))
@@ -8,6 +8,7 @@
 
 from __future__ import absolute_import
 
+import StringIO
 import subprocess
 import unittest
 
@@ -122,6 +123,17 @@ class FileURLTest(unittest.TestCase):
     self.assertEqual(expect, result)
 
 
+class ReadPatternsTest(unittest.TestCase):
+  def testRead(self):
+    stream = StringIO.StringIO('# Comment\n'
+                               'trunk/foo\n'
+                               '\n'
+                               'branches/.*/foo\r\n'
+                               'tags')
+    self.assertEquals(util.ReadPatterns(stream),
+                      ['trunk/foo', 'branches/.*/foo', 'tags'])
+
+
 class PathFilterTest(unittest.TestCase):
   def setUp(self):
     self.ip = util.PathFilter(['/foo/bar', 'zo+/bar/'])
@@ -148,6 +160,82 @@ class PathFilterTest(unittest.TestCase):
     self.assertEquals(self.ip.CheckPath('foo/barz'), self.ip.NO)
     self.assertEquals(self.ip.CheckPath('zoooom/bar'), self.ip.NO)
 
+  def testNormalization(self):
+    self.assertEquals(self.ip.CheckPath('/foo//bar/'), self.ip.YES)
+    self.assertEquals(self.ip.CheckPath('foo/./bar'), self.ip.YES)
+    self.assertEquals(self.ip.CheckPath('foo/baz/../bar'), self.ip.YES)
+    self.assertEquals(self.ip.CheckPath('./foo'), self.ip.PARENT)
+    self.assertEquals(self.ip.CheckPath('.'), self.ip.PARENT)
+
+  def testLiteralAndRegexSiblings(self):
+    ip = util.PathFilter(['trunk/foo/x', 'trunk/f.*/y', 'trunk/(a|b)'])
+    self.assertEquals(ip.CheckPath('trunk/foo'), ip.PARENT)
+    self.assertEquals(ip.CheckPath('trunk/foo/x'), ip.YES)
+    self.assertEquals(ip.CheckPath('trunk/foo/y'), ip.YES)
+    self.assertEquals(ip.CheckPath('trunk/fun/x'), ip.NO)
+    self.assertEquals(ip.CheckPath('trunk/b/c'), ip.YES)
+    self.assertEquals(ip.CheckPath('trunk/c'), ip.NO)
+
+  def testUncombinableRegexes(self):
+    ip = util.PathFilter(['(?P<x>a+)', '(?P<x>b+)'])
+    self.assertEquals(ip.CheckPath('aa'), ip.YES)
+    self.assertEquals(ip.CheckPath('bb/c'), ip.YES)
+    self.assertEquals(ip.CheckPath('ab'), ip.NO)
+
+  def testBackreferences(self):
+    ip = util.PathFilter(['(a)\\1', '(b)\\1', '(c)d', 'x.*', 'y.*'])
+    self.assertEquals(ip.CheckPath('aa'), ip.YES)
+    self.assertEquals(ip.CheckPath('bb'), ip.YES)
+    self.assertEquals(ip.CheckPath('cd'), ip.YES)
+    self.assertEquals(ip.CheckPath('xz'), ip.YES)
+    self.assertEquals(ip.CheckPath('ab'), ip.NO)
+    self.assertEquals(ip.CheckPath('a'), ip.NO)
+
+  def testCacheEviction(self):
+    self.ip._includes.CACHE_SIZE = 2
+    for _ in xrange(2):
+      self.assertEquals(self.ip.CheckPath('foo/bar/baz'), self.ip.YES)
+      self.assertEquals(self.ip.CheckPath('zoo/baz'), self.ip.NO)
+      self.assertEquals(self.ip.CheckPath('zoo'), self.ip.PARENT)
+    self.assertEquals(len(self.ip._includes._cache), 2)
+
+  def testCopy(self):
+    self.assertEquals(self.ip.CheckPath('foo/bar'), self.ip.YES)
+    ip = self.ip.Copy()
+    self.assertEquals(len(ip._includes._cache), 0)
+    self.assertEquals(ip.CheckPath('foo/bar'), ip.YES)
+    self.assertEquals(ip.CheckPath('zoo'), ip.PARENT)
+    self.assertNotIn('zoo', self.ip._includes._cache)
+
+  def testExcludes(self):
+    ip = util.PathFilter(['trunk', 'branches/b1'], ['trunk/vendor/.*', 'b.*'])
+    self.assertFalse(self.ip.HasExcludes())
+    self.assertTrue(ip.HasExcludes())
+    self.assertEquals(ip.CheckPath(''), ip.PARENT)
+    self.assertEquals(ip.CheckPath('trunk'), ip.YES)
+    self.assertEquals(ip.CheckPath('trunk/vendor'), ip.YES)
+    self.assertEquals(ip.CheckPath('trunk/vendor/lib'), ip.NO)
+    self.assertEquals(ip.CheckPath('trunk/vendor/lib/x'), ip.NO)
+    self.assertEquals(ip.CheckPath('branches'), ip.NO)
+    self.assertEquals(ip.CheckPath('branches/b1'), ip.NO)
+
+  def testMayExcludeBelow(self):
+    ip = util.PathFilter(['trunk'], ['trunk/vendor/.*'])
+    self.assertFalse(self.ip.MayExcludeBelow('foo'))
+    self.assertTrue(ip.MayExcludeBelow(''))
+    self.assertTrue(ip.MayExcludeBelow('trunk'))
+    self.assertTrue(ip.MayExcludeBelow('trunk/vendor'))
+    self.assertFalse(ip.MayExcludeBelow('trunk/vendor/lib'))
+    self.assertFalse(ip.MayExcludeBelow('trunk/src'))
+    self.assertFalse(ip.MayExcludeBelow('branches'))
+
+  def testOnlyExcludes(self):
+    ip = util.PathFilter([], ['vendor'])
+    self.assertEquals(ip.CheckPath(''), ip.YES)
+    self.assertEquals(ip.CheckPath('trunk/vendor'), ip.YES)
+    self.assertEquals(ip.CheckPath('vendor'), ip.NO)
+    self.assertEquals(ip.CheckPath('vendor/foo'), ip.NO)
+
   def testNoIncludes(self):
     """No includes means include everything."""
     ip = util.PathFilter([])